@@ -3,7 +3,8 @@ from django.utils.html import format_html
 import hashlib
 from .models import (
     User, Member, Address, ProductCategory, Product, ProductImage,
-    Cart, CartItem, Order, OrderItem, Payment, PasswordResetToken, DeliveryProof
+    Cart, CartItem, Order, OrderItem, Payment, PasswordResetToken, DeliveryProof,
+    NotificationOutbox, StripeEvent, LoyaltyTransaction
 )
 
 
@@ -114,6 +115,14 @@ class MemberAdmin(admin.ModelAdmin):
         spent_str = str(obj.total_spent)
         return format_html('RM <strong>{}</strong>', spent_str)
     get_total_spent.short_description = 'Total Spent'
+    
+    actions = ['rebuild_balances']
+    
+    def rebuild_balances(self, request, queryset):
+        from .loyalty import rebuild_balances
+        drifted = rebuild_balances(queryset=queryset)
+        self.message_user(request, f'Balances rebuilt from the loyalty ledger; {len(drifted)} members corrected.')
+    rebuild_balances.short_description = 'Rebuild selected balances from the loyalty ledger'
 
 
 @admin.register(Address)
@@ -337,7 +346,10 @@ class PaymentAdmin(admin.ModelAdmin):
     mark_as_success.short_description = 'Mark as Success'
     
     def mark_as_failed(self, request, queryset):
-        queryset.update(status='F')
+        # save() per payment so the sales rollups see the status change
+        for payment in queryset:
+            payment.status = 'F'
+            payment.save(update_fields=['status'])
         self.message_user(request, f'{queryset.count()} payments marked as failed.')
     mark_as_failed.short_description = 'Mark as Failed'
 
@@ -382,6 +394,47 @@ class DeliveryProofAdmin(admin.ModelAdmin):
     image_preview.short_description = 'Preview'
 
 
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    list_display = ['id', 'event', 'get_order_number', 'status', 'attempts', 'next_attempt_at', 'sent_at']
+    list_filter = ['status', 'event', 'created_at']
+    search_fields = ['order__order_number', 'dedupe_key']
+    readonly_fields = ['order', 'event', 'dedupe_key', 'payload', 'attempts', 'last_error', 'created_at', 'sent_at']
+    ordering = ['-created_at']
+    
+    def get_order_number(self, obj):
+        return obj.order.order_number
+    get_order_number.short_description = 'Order'
+
+
+@admin.register(LoyaltyTransaction)
+class LoyaltyTransactionAdmin(admin.ModelAdmin):
+    """Read-only: the ledger is append-only (entries come from Member._apply_loyalty)"""
+    list_display = ['created_at', 'member', 'kind', 'points', 'amount_spent', 'order', 'note']
+    list_filter = ['kind', 'created_at']
+    search_fields = ['member__user__email', 'order__order_number']
+    list_select_related = ['member__user', 'order']
+    ordering = ['-created_at']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id', 'type', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['status', 'type', 'received_at']
+    search_fields = ['event_id']
+    readonly_fields = ['event_id', 'type', 'payload', 'attempts', 'last_error', 'received_at', 'processed_at']
+    ordering = ['-received_at']
+
+
 # =====================
 # ADMIN SITE CUSTOMIZATION
 # =====================
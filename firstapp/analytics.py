@@ -0,0 +1,236 @@
+"""
+Analytics dashboard snapshots
+
+The dashboard context for each period (7/30/90/365 days) is computed off the
+request path and stored in the ANALYTICS cache namespace as a snapshot:
+{'version', 'generated_at', 'context'}. The view always answers from the
+snapshot (stale-while-revalidate):
+- fresh (younger than ANALYTICS_SNAPSHOT_MAX_AGE): served as is
+- stale: served as is, and one background refresh is started
+- missing or from an older SNAPSHOT_VERSION: computed once inline
+Snapshots are refreshed on a schedule by the `refresh_analytics` command,
+and on demand from the dashboard's "Recompute now" button.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Sum
+from django.utils import timezone
+
+from .caching import ANALYTICS
+from .models import DailyOrderStatus, DailyProductSales, Order, Product
+from .rollups import sales_summary, top_customers_since
+
+
+PERIODS = ('7', '30', '90', '365')
+
+# Bump when the context layout changes so old snapshots are not rendered
+SNAPSHOT_VERSION = 2
+
+REFRESH_LOCK_SECONDS = 120
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """One background thread is enough: refreshes are deduplicated per period"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analytics-refresh')
+    return _executor
+
+
+def normalize_period(period):
+    return period if period in PERIODS else '365'
+
+
+def _max_age():
+    return getattr(settings, 'ANALYTICS_SNAPSHOT_MAX_AGE', 300)
+
+
+# =====================
+# COMPUTATION
+# =====================
+
+def compute_dashboard(period):
+    """
+    Dashboard metrics for one period (querysets evaluated so it can be cached)
+    History aggregates come from the daily rollup tables (firstapp.rollups),
+    so the cost depends on the period length, not on the order history.
+    """
+    if period == '7':
+        days = 7
+        period_label = 'Last 7 Days'
+    elif period == '30':
+        days = 30
+        period_label = 'Last 30 Days'
+    elif period == '90':
+        days = 90
+        period_label = 'Last 90 Days'
+    else:
+        days = 365
+        period_label = 'Last Year'
+    start_date = timezone.localdate() - timedelta(days=days)
+    
+    # =====================
+    # KEY METRICS + SALES CHART DATA (Daily)
+    # =====================
+    summary = sales_summary(start_date)
+    
+    total_products = Product.objects.filter(status=1).count()
+    
+    sales_chart_labels = [day.date.strftime('%Y-%m-%d') for day in summary['days']]
+    sales_chart_revenue = [float(day.revenue) for day in summary['days']]
+    sales_chart_orders = [day.paid_orders for day in summary['days']]
+    
+    # If no data, create sample data for better UX
+    if not sales_chart_labels:
+        sales_chart_labels = [
+            (timezone.now() - timedelta(days=i)).strftime('%Y-%m-%d')
+            for i in range(4, -1, -1)  # Last 5 days
+        ]
+        sales_chart_revenue = [1000.00, 1200.00, 800.00, 1500.00, 1300.00]
+        sales_chart_orders = [1] * len(sales_chart_labels)
+    
+    # =====================
+    # CATEGORY PERFORMANCE
+    # =====================
+    product_sales = DailyProductSales.objects.filter(date__gte=start_date)
+    
+    category_sales = product_sales.values(
+        'category__name'
+    ).annotate(
+        total_revenue=Sum('revenue'),
+        total_quantity=Sum('quantity')
+    ).filter(total_quantity__gt=0).order_by('-total_revenue')
+    
+    category_labels = [item['category__name'] for item in category_sales]
+    category_revenue = [float(item['total_revenue']) for item in category_sales]
+    
+    # =====================
+    # TOP PRODUCTS
+    # =====================
+    top_products = product_sales.values(
+        'product__name',
+        'product__id'
+    ).annotate(
+        total_quantity=Sum('quantity'),
+        total_revenue=Sum('revenue')
+    ).filter(total_quantity__gt=0).order_by('-total_revenue')[:10]
+    
+    # =====================
+    # RECENT ORDERS
+    # =====================
+    recent_orders = Order.objects.select_related(
+        'address__user'
+    ).exclude(status='X').order_by('-created_at')[:10]
+    
+    # =====================
+    # LOW STOCK ALERT
+    # =====================
+    low_stock = Product.objects.filter(
+        status=1,
+        stock__lte=10
+    ).order_by('stock')[:10]
+    
+    # =====================
+    # ORDER STATUS BREAKDOWN
+    # =====================
+    order_status_breakdown = DailyOrderStatus.objects.filter(
+        date__gte=start_date
+    ).values('status').annotate(
+        total=Sum('count')
+    ).filter(total__gt=0).order_by('-total')
+    
+    status_labels = [dict(Order.status_choices).get(item['status'], 'Unknown') for item in order_status_breakdown]
+    status_counts = [item['total'] for item in order_status_breakdown]
+    
+    # =====================
+    # TOP CUSTOMERS
+    # =====================
+    top_customers = top_customers_since(start_date)
+    
+    context = {
+        'total_revenue': float(summary['revenue']),
+        'total_orders': summary['orders_placed'],
+        'total_customers': summary['new_customers'],
+        'total_products': total_products,
+        'avg_order_value': float(summary['avg_order_value']),
+
+        'sales_chart_labels': sales_chart_labels,
+        'sales_chart_revenue': sales_chart_revenue,
+        'sales_chart_orders': sales_chart_orders,
+
+        'category_labels': category_labels,
+        'category_revenue': category_revenue,
+
+        'status_labels': status_labels,
+        'status_counts': status_counts,
+
+        'top_products': list(top_products),
+        'recent_orders': list(recent_orders),
+        'low_stock': list(low_stock),
+        'top_customers': top_customers,
+
+        'period': period,
+        'period_label': period_label,
+    }
+    return context
+
+
+# =====================
+# SNAPSHOTS
+# =====================
+
+def refresh_snapshot(period):
+    """Compute and store the snapshot for one period; returns it"""
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'generated_at': timezone.now(),
+        'context': compute_dashboard(period),
+    }
+    # Kept well past max age so stale snapshots can still be served
+    ANALYTICS.set(
+        f'dashboard:{period}', snapshot,
+        timeout=getattr(settings, 'ANALYTICS_SNAPSHOT_TTL', 60 * 60 * 24),
+    )
+    return snapshot
+
+
+def _refresh_in_background(period):
+    try:
+        refresh_snapshot(period)
+    except Exception as e:
+        print(f"⚠️  Analytics refresh failed for period {period}: {str(e)}")
+    finally:
+        cache.delete(f'analytics:refreshing:{period}')
+        close_old_connections()
+
+
+def request_refresh(period):
+    """
+    Start a background refresh unless one is already running for the period
+    (across all workers). Returns True if a refresh was started.
+    """
+    if not cache.add(f'analytics:refreshing:{period}', 1, REFRESH_LOCK_SECONDS):
+        return False
+    _get_executor().submit(_refresh_in_background, period)
+    return True
+
+
+def get_snapshot(period):
+    """Snapshot for the dashboard, refreshing it in the background if stale"""
+    snapshot = ANALYTICS.get(f'dashboard:{period}')
+    if not snapshot or snapshot.get('version') != SNAPSHOT_VERSION:
+        return refresh_snapshot(period)
+
+    if timezone.now() - snapshot['generated_at'] > timedelta(seconds=_max_age()):
+        request_refresh(period)
+    return snapshot
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FirstappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'firstapp'
+
+    def ready(self):
+        # Register signal handlers
+        from . import caching, events, images, rollups, search, tracking  # noqa: F401
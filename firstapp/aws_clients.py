@@ -0,0 +1,44 @@
+"""
+Process-wide boto3 clients
+
+Creating a boto3 client loads service models and credentials, which costs
+far more than the API call it is used for. Clients are thread-safe once
+built, so each (service, region, endpoint) gets one shared instance.
+"""
+import threading
+
+import boto3
+from django.conf import settings
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name, region_name=None, endpoint_url=None):
+    """Return the shared boto3 client for a service"""
+    region_name = region_name or settings.AWS_REGION
+    key = (service_name, region_name, endpoint_url)
+    client = _clients.get(key)
+    if client is None:
+        # boto3's default session is not thread-safe while creating clients
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service_name, region_name=region_name, endpoint_url=endpoint_url)
+                _clients[key] = client
+    return client
+
+
+def get_sns_client():
+    """Shared SNS client (AWS_SNS_ENDPOINT_URL points it at a local stub)"""
+    return get_client(
+        'sns',
+        region_name=settings.AWS_SNS_REGION_NAME,
+        endpoint_url=getattr(settings, 'AWS_SNS_ENDPOINT_URL', None),
+    )
+
+
+def get_kms_client():
+    """Shared KMS client (AWS_KMS_ENDPOINT_URL points it at a local stand-in)"""
+    return get_client('kms', endpoint_url=getattr(settings, 'AWS_KMS_ENDPOINT_URL', None))
@@ -0,0 +1,193 @@
+"""
+Two-tier cache with versioned namespaces
+
+- Shared tier: the Django 'default' cache (Redis/memcached in production,
+  a file cache locally), so every gunicorn worker sees the same values.
+- Local tier: a small per-process LRU in front of it that keeps hot keys for
+  CACHE_LOCAL_TTL seconds, saving the network round trip.
+
+Keys live in a namespace whose version number is stored in the shared cache
+and baked into every key ("catalog:v3:home"). invalidate(namespace) bumps the
+version, which orphans all old keys at once (they simply expire) instead of
+deleting them one by one. Other workers pick up the new version within
+CACHE_LOCAL_TTL seconds.
+
+Views use the namespaces below instead of building cache keys by hand.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Product, ProductCategory, ProductImage, User
+
+
+_MISSING = object()
+
+
+class LocalLRU:
+    """Thread-safe per-process LRU with a per-entry expiry"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalLRU(getattr(settings, 'CACHE_LOCAL_MAX_ENTRIES', 512))
+
+
+def _local_ttl():
+    return getattr(settings, 'CACHE_LOCAL_TTL', 5)
+
+
+class CacheNamespace:
+    """A group of keys that can be invalidated together"""
+
+    def __init__(self, name, timeout, use_local=True):
+        self.name = name
+        self.timeout = timeout
+        self.use_local = use_local
+        self.version_key = f'ns:{name}:version'
+
+    # ----- versioning -----
+
+    def version(self):
+        version = local_cache.get(self.version_key) if self.use_local else _MISSING
+        if version is _MISSING:
+            version = cache.get(self.version_key)
+            if version is None:
+                # add() so concurrent first readers agree on the initial version
+                cache.add(self.version_key, 1, None)
+                version = cache.get(self.version_key, 1)
+            if self.use_local:
+                local_cache.set(self.version_key, version, _local_ttl())
+        return version
+
+    def invalidate(self):
+        """Orphan every key in the namespace"""
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            # Version key evicted or never set: start above any cached local copy
+            version = int(time.time())
+            cache.set(self.version_key, version, None)
+        if self.use_local:
+            local_cache.set(self.version_key, version, _local_ttl())
+        return version
+
+    def make_key(self, key):
+        return f'{self.name}:v{self.version()}:{key}'
+
+    # ----- values -----
+
+    def get(self, key, default=None):
+        full_key = self.make_key(key)
+        if self.use_local:
+            value = local_cache.get(full_key)
+            if value is not _MISSING:
+                return value
+        value = cache.get(full_key, _MISSING)
+        if value is _MISSING:
+            return default
+        if self.use_local:
+            local_cache.set(full_key, value, _local_ttl())
+        return value
+
+    def set(self, key, value, timeout=None):
+        full_key = self.make_key(key)
+        cache.set(full_key, value, self.timeout if timeout is None else timeout)
+        if self.use_local:
+            local_cache.set(full_key, value, _local_ttl())
+
+    def delete(self, key):
+        full_key = self.make_key(key)
+        cache.delete(full_key)
+        if self.use_local:
+            local_cache.delete(full_key)
+
+    def get_or_set(self, key, compute, timeout=None):
+        """Return the cached value, calling compute() and storing it on a miss"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value, timeout)
+        return value
+
+
+# =====================
+# NAMESPACES
+# =====================
+
+# Product listings shown on public pages (home, detail, related products)
+CATALOG = CacheNamespace('catalog', timeout=60 * 5)
+
+# Category list used by the navigation and catalog filters
+CATEGORIES = CacheNamespace('categories', timeout=60 * 60)
+
+# Session users' fields by id (firstapp.middleware). Shared tier only, so a
+# changed role or deleted user is seen by every worker at once
+USERS = CacheNamespace('users', timeout=60 * 30, use_local=False)
+
+# Computed admin analytics
+ANALYTICS = CacheNamespace('analytics', timeout=60 * 5)
+
+# Only the version is used: bumped on every product change so each worker's
+# in-memory search index (firstapp.search) knows when to rebuild
+SEARCH_INDEX = CacheNamespace('search_index', timeout=None)
+
+
+# =====================
+# INVALIDATION
+# =====================
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductImage)
+def _invalidate_catalog(sender, **kwargs):
+    CATALOG.invalidate()
+
+
+@receiver([post_save, post_delete], sender=ProductCategory)
+def _invalidate_categories(sender, **kwargs):
+    CATEGORIES.invalidate()
+    CATALOG.invalidate()
+
+
+@receiver([post_save, post_delete], sender=User)
+def _invalidate_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    USERS.delete(user_id)
+    # Again once committed: a request reading the old row meanwhile may have re-cached it
+    transaction.on_commit(lambda: USERS.delete(user_id))
@@ -0,0 +1,98 @@
+"""
+Checkout engine
+
+Turns a cart into an Order + OrderItems + pending Payment in one
+transaction with a fixed number of statements per product:
+- cart lines and products are read in one query
+- stock is taken with one conditional UPDATE per product
+  (stock = stock - qty WHERE stock >= qty), so parallel checkouts on a hot
+  product can never oversell
+- all OrderItem rows are written with one bulk_create
+- the admin notification is queued in the outbox, not sent inline
+Any oversold line or loyalty error rolls the whole order back.
+"""
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import Member, Order, OrderItem, Payment, Product
+from .notifications import queue_admin_notification
+
+
+class CheckoutError(Exception):
+    """Checkout could not be completed; message is safe to show the user"""
+
+
+class OutOfStockError(CheckoutError):
+    def __init__(self, items):
+        self.items = items
+        names = ', '.join(item.product.name for item in items)
+        super().__init__(f'Insufficient stock for: {names}')
+
+
+def place_order(user, cart, address, loyalty_points_used=Decimal('0')):
+    """
+    Create the order for `cart` delivered to `address`
+    Returns (order, payment). Raises CheckoutError without writing anything.
+    """
+    loyalty_points_used = Decimal(str(loyalty_points_used))
+
+    with transaction.atomic():
+        # Sorted by product so concurrent checkouts lock rows in the same order
+        items = list(cart.items.select_related('product').order_by('product_id'))
+        if not items:
+            raise CheckoutError('Cart is empty')
+
+        oversold = [
+            item for item in items
+            if not Product.objects.decrement_stock(item.product_id, item.quantity)
+        ]
+        if oversold:
+            raise OutOfStockError(oversold)
+
+        subtotal = sum((item.get_total_price() for item in items), Decimal('0'))
+
+        if loyalty_points_used > 0 and not user.is_member():
+            raise CheckoutError('Not a member')
+
+        order = Order.objects.create(
+            address=address,
+            subtotal=subtotal,
+            status='X',  # Hidden until a payment method is chosen
+            loyalty_points_used=loyalty_points_used
+        )
+
+        discount_amount = Decimal('0')
+        if loyalty_points_used > 0:
+            # Ledger entry tied to the order, under the member's row lock
+            try:
+                discount_amount = Member(pk=user.pk).redeem_points(loyalty_points_used, order=order)
+            except ValidationError as e:
+                raise CheckoutError(' '.join(e.messages))
+
+        # bulk_create skips OrderItem.save(), so fill its derived fields here
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=item.product,
+                product_name=item.product.name,
+                quantity=item.quantity,
+                unit_price=item.product.price,
+                subtotal=item.product.price * item.quantity,
+            )
+            for item in items
+        ])
+
+        payment = Payment.objects.create(
+            order=order,
+            discount_amount=discount_amount,
+            total_amount=subtotal - discount_amount,
+            method='COD',  # Temporary
+            status='P'
+        )
+
+        # Outbox row commits (or rolls back) together with the order
+        queue_admin_notification(order)
+
+    return order, payment
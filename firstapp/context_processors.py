@@ -1,8 +1,13 @@
-from .models import User, Member, Cart
+from django.utils.functional import SimpleLazyObject
+
+from .models import Cart
+from .middleware import get_session_user, get_user_snapshot
 
 def user_context(request):
     """
     Add user info and cart count to all templates
+    Role flags come from the session snapshot; the user and cart are only
+    queried if a template actually uses them.
     """
     context = {
         'is_logged_in': False,
@@ -11,28 +16,18 @@ def user_context(request):
         'cart_count': 0,
     }
     
-    user_id = request.session.get('user_id')
-    if user_id:
-        try:
-            user = User.objects.get(id=user_id)
-            context['is_logged_in'] = True
-            context['current_user'] = user
-            
-            # Check if admin
-            if user.role == 'A':
-                try:
-                    context['is_admin'] = True
-                except Member.DoesNotExist:
-                    pass
-            
-            # Get cart count
-            try:
-                cart = Cart.objects.get(user=user)
-                context['cart_count'] = cart.get_total_items()
-            except Cart.DoesNotExist:
-                pass
-                
-        except User.DoesNotExist:
-            pass
+    snapshot = get_user_snapshot(request)
+    if snapshot:
+        context['is_logged_in'] = True
+        context['is_admin'] = snapshot.is_admin()
+        
+        # Shares the per-request cached user with the views
+        context['current_user'] = SimpleLazyObject(lambda: get_session_user(request))
+        
+        # Templates call callables, so the cart is only read when rendered
+        def cart_count():
+            cart_id = Cart.objects.filter(user_id=snapshot.id).values_list('id', flat=True).first()
+            return Cart.objects.get_counters(cart_id)[0] if cart_id else 0
+        context['cart_count'] = cart_count
     
-    return context
\ No newline at end of file
+    return context
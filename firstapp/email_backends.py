@@ -1,46 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
 from django.core.mail.backends.base import BaseEmailBackend
-import boto3
 from django.conf import settings
 
+from .aws_clients import get_sns_client
+
+
+SNS_BATCH_SIZE = 10  # PublishBatch limit
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Bounded thread pool shared by every backend instance in the process"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'SNS_PUBLISH_MAX_WORKERS', 8),
+                    thread_name_prefix='sns-publish',
+                )
+    return _executor
+
+
+class SNSPublishError(Exception):
+    """
+    Some messages could not be published; `failures` lists (message, reason)
+    The other `sent` messages already went out, so retry only `messages`.
+    """
+
+    def __init__(self, failures, sent=0):
+        self.failures = failures
+        self.messages = [message for message, _ in failures]
+        self.sent = sent
+        super().__init__(
+            f"{len(failures)} SNS message(s) failed ({sent} sent): {failures[0][1]}"
+        )
+
+
 class SNSEmailBackend(BaseEmailBackend):
     """
     Email backend that sends emails via AWS SNS
+    Messages are grouped into PublishBatch calls of up to 10 and the
+    batches are published concurrently on a shared, bounded thread pool.
     """
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.sns_client = boto3.client('sns', region_name=settings.AWS_SNS_REGION_NAME)
+        self.sns_client = get_sns_client()
+        self.failures = []
+    
+    def _format(self, message):
+        return f"""
+Subject: {message.subject}
+From: {message.from_email}
+To: {', '.join(message.to)}
+
+{message.body}
+                """
+    
+    def _publish_batch(self, batch):
+        """Publish up to 10 messages; returns [(message, reason)] for failures"""
+        try:
+            response = self.sns_client.publish_batch(
+                TopicArn=settings.AWS_SNS_TOPIC_ARN,
+                PublishBatchRequestEntries=[
+                    {
+                        'Id': str(index),
+                        'Subject': message.subject[:100],  # SNS subject limit
+                        'Message': self._format(message),
+                    }
+                    for index, message in enumerate(batch)
+                ]
+            )
+        except Exception as e:
+            return [(message, str(e)) for message in batch]
+        
+        return [
+            (batch[int(entry['Id'])], entry.get('Message') or entry.get('Code', 'Unknown error'))
+            for entry in response.get('Failed', [])
+        ]
     
     def send_messages(self, email_messages):
         """
         Send email messages via SNS
+        Per-message failures are kept in self.failures; on error only those
+        messages are raised (SNSPublishError.messages), the rest were sent.
         """
         if not email_messages:
             return 0
         
-        sent_count = 0
-        for message in email_messages:
-            try:
-                # Create message body
-                body = f"""
-Subject: {message.subject}
-From: {message.from_email}
-To: {', '.join(message.to)}
-
-{message.body}
-                """
-                
-                # Publish to SNS
-                self.sns_client.publish(
-                    TopicArn=settings.AWS_SNS_TOPIC_ARN,
-                    Subject=message.subject[:100],  # SNS subject limit
-                    Message=body
-                )
-                sent_count += 1
-                
-            except Exception as e:
-                if not self.fail_silently:
-                    raise
-                print(f"SNS email error: {e}")
+        email_messages = list(email_messages)
+        batches = [
+            email_messages[i:i + SNS_BATCH_SIZE]
+            for i in range(0, len(email_messages), SNS_BATCH_SIZE)
+        ]
+        
+        self.failures = []
+        for failures in _get_executor().map(self._publish_batch, batches):
+            self.failures.extend(failures)
+        
+        sent = len(email_messages) - len(self.failures)
+        if self.failures:
+            if not self.fail_silently:
+                raise SNSPublishError(self.failures, sent)
+            for message, reason in self.failures:
+                print(f"SNS email error ({message.subject}): {reason}")
         
-        return sent_count
\ No newline at end of file
+        return sent
@@ -1,28 +1,198 @@
-import boto3
+"""
+Field encryption (KMS envelope encryption)
+
+Calling KMS for every value costs a network round trip per field. Instead:
+- one KMS GenerateDataKey gives a 256-bit data key plus its KMS-wrapped copy
+- the wrapped copy is stored once in EncryptionKey; values only carry its key_id
+- values are encrypted locally with AES-GCM while the data key is cached
+  (rotated every ENCRYPTION_DATA_KEY_TTL seconds)
+- decryption unwraps each key_id with KMS once and caches the plaintext key
+
+Stored format: "env1:<key_id>:<base64(nonce + ciphertext)>". Values written
+by the old direct-KMS encrypt_secret (plain base64) still decrypt.
+"""
 import base64
+import hashlib
+import os
+import threading
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from django.conf import settings
+from django.db import connection, transaction
 
-def encrypt_secret(plaintext):
-    """Encrypt sensitive data using AWS KMS (IAM Role based)"""
-    kms = boto3.client(
-        "kms",
-        region_name="us-east-1"  # or your region
-    )
+from .aws_clients import get_kms_client
+from .models import EncryptionKey
 
-    response = kms.encrypt(
-        KeyId="YOUR_KMS_KEY_ID",
-        Plaintext=plaintext.encode()
-    )
 
-    return base64.b64encode(response["CiphertextBlob"]).decode()
+PREFIX = 'env1'
+NONCE_SIZE = 12
+DECRYPT_CACHE_SIZE = 128  # unwrapped data keys kept in memory
 
+_lock = threading.Lock()
+_active_key = None  # (key_id, AESGCM, expires_at)
+_decrypt_keys = {}  # key_id -> AESGCM
+_pending = threading.local()  # key this thread's connection made in its open transaction
 
-def decrypt_secret(ciphertext):
-    """Decrypt sensitive data using AWS KMS (IAM Role based)"""
-    kms = boto3.client("kms", region_name=settings.AWS_REGION)
 
-    response = kms.decrypt(
-        CiphertextBlob=base64.b64decode(ciphertext.encode())
-    )
+def _data_key_ttl():
+    return getattr(settings, 'ENCRYPTION_DATA_KEY_TTL', 3600)
+
+
+def _remember(key_id, aead):
+    if len(_decrypt_keys) >= DECRYPT_CACHE_SIZE:
+        _decrypt_keys.pop(next(iter(_decrypt_keys)))
+    _decrypt_keys[key_id] = aead
+
+
+def _cache_key(key_id, aead, expires_at):
+    global _active_key
+    with _lock:
+        if _active_key is None or _active_key[2] < expires_at:
+            _active_key = (key_id, aead, expires_at)
+        _remember(key_id, aead)
+
+
+def _pending_key():
+    """
+    (key_id, AESGCM) generated earlier in the current transaction, if still usable
+    A rollback of the transaction (or of the savepoint the key was made in)
+    drops its queued on_commit publish, and with it the EncryptionKey row.
+    """
+    pending = getattr(_pending, 'key', None)
+    if pending is None:
+        return None
+    publish, key_id, aead, expires_at = pending
+    if (connection.in_atomic_block and expires_at > time.monotonic()
+            and any(func is publish for _, func, _ in connection.run_on_commit)):
+        return key_id, aead
+    _pending.key = None
+    return None
+
+
+def _get_active_key():
+    """(key_id, AESGCM) for encrypting; generates a new data key when expired"""
+    active = _active_key
+    if active and active[2] > time.monotonic():
+        return active[0], active[1]
+    pending = _pending_key()
+    if pending:
+        return pending
+
+    with _lock:
+        active = _active_key
+        if active and active[2] > time.monotonic():
+            return active[0], active[1]
+
+        response = get_kms_client().generate_data_key(
+            KeyId=settings.AWS_KMS_KEY_ID, KeySpec='AES_256'
+        )
+        wrapped = response['CiphertextBlob']
+        key_id = hashlib.sha256(wrapped).hexdigest()[:32]
+        EncryptionKey.objects.get_or_create(
+            key_id=key_id,
+            defaults={'kms_key_id': response.get('KeyId', settings.AWS_KMS_KEY_ID), 'wrapped_key': wrapped},
+        )
+        aead = AESGCM(response['Plaintext'])
+
+    # The EncryptionKey row is part of the caller's transaction: only share the
+    # key with other requests once it's committed (a rollback would leave the
+    # cache handing out a key_id nothing can unwrap). Runs now in autocommit.
+    # Until then this transaction keeps using it instead of making a key per value.
+    expires_at = time.monotonic() + _data_key_ttl()
+
+    def publish():
+        _pending.key = None
+        _cache_key(key_id, aead, expires_at)
+
+    if connection.in_atomic_block:
+        _pending.key = (publish, key_id, aead, expires_at)
+    transaction.on_commit(publish)
+    return key_id, aead
+
+
+def _get_decrypt_keys(key_ids):
+    """{key_id: AESGCM}, unwrapping (one KMS call each) only keys not cached"""
+    with _lock:
+        keys = {key_id: _decrypt_keys[key_id] for key_id in key_ids if key_id in _decrypt_keys}
+    missing = set(key_ids) - set(keys)
+    if not missing:
+        return keys
+
+    stored = EncryptionKey.objects.filter(key_id__in=missing).values_list('key_id', 'wrapped_key')
+    kms = get_kms_client()
+    for key_id, wrapped in stored:
+        plaintext = kms.decrypt(CiphertextBlob=bytes(wrapped))['Plaintext']
+        keys[key_id] = AESGCM(plaintext)
+        with _lock:
+            _remember(key_id, keys[key_id])
 
+    unknown = missing - set(keys)
+    if unknown:
+        raise ValueError(f"Unknown encryption key: {', '.join(sorted(unknown))}")
+    return keys
+
+
+def _encrypt(key_id, aead, plaintext):
+    nonce = os.urandom(NONCE_SIZE)
+    # key_id is bound as associated data so a value can't be moved to another key
+    ciphertext = aead.encrypt(nonce, plaintext.encode(), key_id.encode())
+    return f"{PREFIX}:{key_id}:{base64.b64encode(nonce + ciphertext).decode()}"
+
+
+def _parse(value):
+    """(key_id, raw bytes) for an envelope value, or None for legacy KMS values"""
+    parts = value.split(':', 2)
+    if len(parts) != 3 or parts[0] != PREFIX:
+        return None
+    return parts[1], base64.b64decode(parts[2].encode())
+
+
+def _decrypt(aead, key_id, raw):
+    return aead.decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], key_id.encode()).decode()
+
+
+def _decrypt_legacy(ciphertext):
+    response = get_kms_client().decrypt(CiphertextBlob=base64.b64decode(ciphertext.encode()))
     return response["Plaintext"].decode()
+
+
+def encrypt_secret(plaintext):
+    """Encrypt one value locally with the cached data key"""
+    key_id, aead = _get_active_key()
+    return _encrypt(key_id, aead, plaintext)
+
+
+def decrypt_secret(ciphertext):
+    """Decrypt one value written by encrypt_secret/encrypt_many"""
+    parsed = _parse(ciphertext)
+    if parsed is None:
+        return _decrypt_legacy(ciphertext)
+    key_id, raw = parsed
+    aead = _get_decrypt_keys([key_id])[key_id]
+    return _decrypt(aead, key_id, raw)
+
+
+def encrypt_many(values):
+    """Encrypt a list of strings with one data key (at most one KMS call)"""
+    key_id, aead = _get_active_key()
+    return [_encrypt(key_id, aead, value) for value in values]
+
+
+def decrypt_many(ciphertexts):
+    """Decrypt a list of values, unwrapping each distinct data key once"""
+    parsed = [_parse(value) for value in ciphertexts]
+    keys = _get_decrypt_keys({p[0] for p in parsed if p is not None})
+    return [
+        _decrypt(keys[p[0]], p[0], p[1]) if p is not None else _decrypt_legacy(value)
+        for value, p in zip(ciphertexts, parsed)
+    ]
+
+
+def clear_key_cache():
+    """Drop cached data keys (next encrypt generates a fresh one)"""
+    global _active_key
+    with _lock:
+        _active_key = None
+        _decrypt_keys.clear()
+    _pending.key = None
@@ -0,0 +1,288 @@
+"""
+Order event push channel (server-sent events)
+
+Instead of polling /api/active-orders/ and /api/driver/orders/ on a timer,
+pages keep one EventSource connection to /api/events/ (views.order_events,
+an async view that needs the ASGI server, firstproject/asgi.py). When an
+order changes, the subscribers of its channels get a small event and then
+refetch through the delta feeds, which answer from one cheap query.
+
+Channels:
+- user:<id>   the customer who placed the order
+- drivers     every driver (they all see the order list)
+
+Events are published after the transaction commits, from the Order /
+DeliveryProof signal receivers below, so every path that changes a status
+(driver updates, proof uploads, payment completion, admin) is covered.
+
+Brokers (EVENT_BROKER):
+- memory: in-process fan-out only; for tests, runserver and single-process
+  deployments
+- redis: published to Redis pub/sub; each ASGI process holds a single
+  pattern subscription and fans events out to its local subscribers
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Address, DeliveryProof, Order
+
+
+SUBSCRIBER_QUEUE_SIZE = 100  # events are hints, so a slow client just misses some
+REDIS_CHANNEL_PREFIX = 'winniecho:events:'
+
+DRIVERS_CHANNEL = 'drivers'
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+# =====================
+# LOCAL FAN-OUT
+# =====================
+
+class Subscription:
+    """One connected client: an asyncio queue bound to its event loop"""
+
+    def __init__(self, channels, loop):
+        self.channels = tuple(channels)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def _offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout):
+        """Next event, or None after `timeout` seconds"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalHub:
+    """Channel -> subscriptions of this process (thread-safe)"""
+
+    def __init__(self):
+        self._channels = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def add(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._channels[channel].add(subscription)
+
+    def remove(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._channels[channel]
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                return len(self._channels.get(channel, ()))
+            return len({s for subscribers in self._channels.values() for s in subscribers})
+
+    def dispatch(self, channel, event):
+        """Deliver to every local subscriber; callable from any thread"""
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        # One thread hop per event loop, not per subscriber
+        by_loop = defaultdict(list)
+        for subscription in subscribers:
+            by_loop[subscription.loop].append(subscription)
+        for loop, group in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_offer_all, group, event)
+            except RuntimeError:
+                pass  # loop closed; the subscription is being torn down
+
+
+def _offer_all(subscriptions, event):
+    for subscription in subscriptions:
+        subscription._offer(event)
+
+
+# =====================
+# BROKERS
+# =====================
+
+class MemoryBroker:
+    """Publish straight into this process' subscribers"""
+
+    def __init__(self):
+        self.hub = LocalHub()
+
+    def publish(self, channel, event):
+        self.hub.dispatch(channel, event)
+
+    async def subscribe(self, channels):
+        subscription = Subscription(channels, asyncio.get_running_loop())
+        self.hub.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.hub.remove(subscription)
+
+
+class RedisBroker(MemoryBroker):
+    """Redis pub/sub between processes, local fan-out within each"""
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self._client = None
+        self._listeners = {}  # event loop -> listener task
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        self._client.publish(REDIS_CHANNEL_PREFIX + channel, json.dumps(event))
+
+    async def subscribe(self, channels):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._listeners.get(loop)
+            if task is None or task.done():
+                self._listeners[loop] = loop.create_task(self._listen())
+        return await super().subscribe(channels)
+
+    async def _listen(self):
+        import redis.asyncio as aioredis
+        while True:
+            client = aioredis.Redis.from_url(self.url)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(REDIS_CHANNEL_PREFIX + '*')
+                    async for message in pubsub.listen():
+                        if message['type'] != 'pmessage':
+                            continue
+                        channel = message['channel'].decode()[len(REDIS_CHANNEL_PREFIX):]
+                        self.hub.dispatch(channel, json.loads(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  Event listener lost Redis connection: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                if getattr(settings, 'EVENT_BROKER', 'memory') == 'redis':
+                    _broker = RedisBroker(settings.REDIS_URL)
+                else:
+                    _broker = MemoryBroker()
+    return _broker
+
+
+# =====================
+# PUBLISHING
+# =====================
+
+def publish(channels, event):
+    broker = get_broker()
+    for channel in channels:
+        try:
+            broker.publish(channel, event)
+        except Exception as e:
+            # Clients still resync on their fallback poll
+            print(f"⚠️  Event publish failed: {str(e)}")
+
+
+def publish_order_event(order, event_type, **extra):
+    """Send an order event to its customer and the drivers once the transaction commits"""
+    if Order.address.is_cached(order):
+        user_id = order.address.user_id
+    else:
+        user_id = Address.objects.filter(pk=order.address_id).values_list('user_id', flat=True).first()
+    event = {
+        'type': event_type,
+        'order_id': str(order.pk),
+        'order_number': order.order_number,
+        'status': order.status,
+        'at': time.time(),
+        **extra,
+    }
+    channels = [DRIVERS_CHANNEL]
+    if user_id:
+        channels.append(user_channel(user_id))
+    transaction.on_commit(lambda: publish(channels, event))
+
+
+@receiver(pre_save, sender=Order)
+def _remember_status(sender, instance, **kwargs):
+    # Read before post_save receivers (firstapp.rollups) move _loaded_status on
+    instance._event_old_status = None if instance._state.adding else getattr(instance, '_loaded_status', None)
+
+
+@receiver(post_save, sender=Order)
+def _order_saved(sender, instance, created, **kwargs):
+    old_status = getattr(instance, '_event_old_status', None)
+    if created or old_status != instance.status:
+        publish_order_event(instance, 'order.status', old_status=old_status)
+
+
+@receiver(post_save, sender=DeliveryProof)
+def _proof_saved(sender, instance, **kwargs):
+    order = Order.objects.filter(pk=instance.order_id).select_related('address').only(
+        'id', 'order_number', 'status', 'address__user_id'
+    ).first()
+    if order:
+        publish_order_event(order, 'order.proof')
+
+
+# =====================
+# STREAM (views.order_events)
+# =====================
+
+def _format(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+async def event_stream(channels):
+    """
+    Async generator of SSE text for `channels`: events as they arrive, a
+    comment line every EVENT_STREAM_HEARTBEAT seconds (keeps proxies from
+    closing the idle connection) and an end after EVENT_STREAM_MAX_AGE so
+    clients reconnect (and rebalance across workers) now and then
+    """
+    heartbeat = getattr(settings, 'EVENT_STREAM_HEARTBEAT', 20)
+    max_age = getattr(settings, 'EVENT_STREAM_MAX_AGE', 600)
+    broker = get_broker()
+    subscription = await broker.subscribe(channels)
+    try:
+        # Reconnect delay for EventSource; also tells the client we're live
+        yield f"retry: 5000\nevent: ready\ndata: {{}}\n\n"
+        deadline = time.monotonic() + max_age
+        while time.monotonic() < deadline:
+            event = await subscription.get(min(heartbeat, max(deadline - time.monotonic(), 0)))
+            yield _format(event) if event is not None else ': keepalive\n\n'
+    finally:
+        # Also runs when the client disconnects (the generator is cancelled)
+        broker.unsubscribe(subscription)
@@ -0,0 +1,209 @@
+"""
+Sales export (CSV / Parquet)
+
+One row per OrderItem with its order, customer, category and latest payment.
+Rows are read in keyset batches of `chunk_size` (WHERE id > last ORDER BY id
+LIMIT n), so memory stays flat however many rows match: MySQL's driver
+buffers whole result sets even with QuerySet.iterator(), batching does not.
+Writers are generators, used both by the StreamingHttpResponse in
+views.export_sales and by the `export_sales` management command.
+
+Parquet needs the optional pyarrow package; each batch becomes one row group.
+"""
+import csv
+from datetime import date, datetime, time, timedelta
+
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Order, OrderItem, Payment
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = pq = None
+
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# (column name, values() lookup)
+COLUMNS = [
+    ('order_item_id', 'id'),
+    ('order_number', 'order__order_number'),
+    ('order_created_at', 'order__created_at'),
+    ('order_status', 'order__status'),
+    ('customer_email', 'order__address__user__email'),
+    ('product_id', 'product_id'),
+    ('product_name', 'product_name'),
+    ('category', 'product__category__name'),
+    ('quantity', 'quantity'),
+    ('unit_price', 'unit_price'),
+    ('subtotal', 'subtotal'),
+    ('payment_method', 'payment_method'),
+    ('payment_status', 'payment_status'),
+    ('payment_total', 'payment_total'),
+]
+
+
+class ExportError(ValueError):
+    """Invalid export request; message is safe to show"""
+
+
+def parse_filters(start=None, end=None, status=None, category=None):
+    """Keyword arguments for sales_queryset() from raw strings (query string or CLI)"""
+    try:
+        start_date = date.fromisoformat(start) if start else None
+        end_date = date.fromisoformat(end) if end else None
+    except ValueError:
+        raise ExportError('Dates must be YYYY-MM-DD')
+    if start_date and end_date and start_date > end_date:
+        raise ExportError('Start date is after end date')
+    statuses = [code.strip().upper() for code in (status or '').split(',') if code.strip()]
+    return {
+        'start_date': start_date,
+        'end_date': end_date,
+        'statuses': statuses,
+        'category': (category or '').strip().upper() or None,
+    }
+
+
+def sales_queryset(start_date=None, end_date=None, statuses=None, category=None):
+    """OrderItems filtered by order date range (local dates, inclusive), order status and category code"""
+    valid_statuses = dict(Order.status_choices)
+    for status in statuses or []:
+        if status not in valid_statuses:
+            raise ExportError(f"Unknown order status: {status}")
+
+    tz = timezone.get_current_timezone()
+    queryset = OrderItem.objects.all()
+    if start_date:
+        queryset = queryset.filter(
+            order__created_at__gte=timezone.make_aware(datetime.combine(start_date, time.min), tz)
+        )
+    if end_date:
+        queryset = queryset.filter(
+            order__created_at__lt=timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min), tz)
+        )
+    if statuses:
+        queryset = queryset.filter(order__status__in=statuses)
+    if category:
+        queryset = queryset.filter(product__category__code=category)
+
+    latest_payment = Payment.objects.filter(order=OuterRef('order_id')).order_by('-created_at', '-id')
+    return queryset.annotate(
+        payment_method=Subquery(latest_payment.values('method')[:1]),
+        payment_status=Subquery(latest_payment.values('status')[:1]),
+        payment_total=Subquery(
+            latest_payment.values('total_amount')[:1], output_field=Payment._meta.get_field('total_amount')
+        ),
+    )
+
+
+def iter_batches(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield lists of row tuples (in COLUMNS order), one keyset page at a time"""
+    lookups = [lookup for _, lookup in COLUMNS]
+    last_id = 0
+    while True:
+        batch = list(
+            queryset.filter(id__gt=last_id).order_by('id').values_list(*lookups)[:chunk_size]
+        )
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+
+
+class _Echo:
+    """File-like object whose write() just returns the line (for csv.writer)"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).isoformat()
+    return value
+
+
+def stream_csv(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield CSV text chunks (header first), one chunk per batch"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in COLUMNS])
+    for batch in iter_batches(queryset, chunk_size):
+        yield ''.join(writer.writerow([_csv_value(value) for value in row]) for row in batch)
+
+
+class _ChunkSink:
+    """Write-only file that hands written bytes back to the generator"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parquet_schema():
+    return pa.schema([
+        ('order_item_id', pa.int64()),
+        ('order_number', pa.string()),
+        ('order_created_at', pa.timestamp('us', tz='UTC')),
+        ('order_status', pa.string()),
+        ('customer_email', pa.string()),
+        ('product_id', pa.int64()),
+        ('product_name', pa.string()),
+        ('category', pa.string()),
+        ('quantity', pa.int64()),
+        ('unit_price', pa.decimal128(10, 2)),
+        ('subtotal', pa.decimal128(10, 2)),
+        ('payment_method', pa.string()),
+        ('payment_status', pa.string()),
+        ('payment_total', pa.decimal128(10, 2)),
+    ])
+
+
+def stream_parquet(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield Parquet bytes; every batch is written as one row group"""
+    if pa is None:
+        raise ExportError('Parquet export requires the pyarrow package')
+
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='snappy')
+    try:
+        for batch in iter_batches(queryset, chunk_size):
+            columns = list(zip(*batch))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()  # footer
+
+
+EXPORT_FORMATS = {
+    'csv': (stream_csv, 'text/csv', 'csv'),
+    'parquet': (stream_parquet, 'application/vnd.apache.parquet', 'parquet'),
+}
@@ -0,0 +1,302 @@
+"""
+Responsive image variants
+
+On save of a ProductImage or DeliveryProof with a new upload, a background
+thread pool (off the request path) builds resized copies of the original:
+- thumb (product grids, cart), detail (product modal), zoom
+- each as WebP and progressive JPEG, EXIF-free and auto-rotated
+Files are named by the SHA-256 of the original's bytes
+(media/variants/ab/<hash>-thumb.webp), so identical uploads share files,
+re-uploads never serve a stale cached variant, and already-built variants
+are reused instead of re-encoded. The row's `variants` field is filled in
+when the files exist (and the CATALOG cache invalidated); templates and the
+products API use it for srcset.
+Originals are still served until then, so they are made EXIF-free first:
+delivery proofs are recompressed to a <=2048px JPEG, product images carrying
+metadata are rewritten without it.
+"""
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+from PIL import Image, ImageOps
+
+from .caching import CATALOG
+from .models import DeliveryProof, ProductImage
+from .tracking import touch_order
+
+
+# Variant name -> max width in px (never upscaled)
+VARIANT_WIDTHS = {
+    'thumb': 320,
+    'detail': 800,
+    'zoom': 1600,
+}
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+VARIANTS_DIR = 'variants'
+
+# Delivery proof originals are phone photos: keep a downscaled, EXIF-free JPEG
+PROOF_MAX_DIMENSION = 2048
+PROOF_JPEG_QUALITY = 85
+
+# Product originals are rewritten in their own format (without EXIF) only when
+# they carry metadata; anything else is rewritten as JPEG
+ORIGINAL_FORMATS = {
+    'JPEG': ('jpg', {'quality': 92, 'optimize': True, 'progressive': True}),
+    'PNG': ('png', {'optimize': True}),
+    'WEBP': ('webp', {'quality': 92}),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Bounded thread pool for image work (Pillow releases the GIL while encoding)"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'IMAGE_VARIANT_WORKERS', 2),
+                    thread_name_prefix='image-variants',
+                )
+    return _executor
+
+
+# =====================
+# URLS
+# =====================
+
+def variant_name(content_hash, variant, fmt):
+    """Storage path of one variant file"""
+    return f'{VARIANTS_DIR}/{content_hash[:2]}/{content_hash}-{variant}.{fmt}'
+
+
+def variant_url(content_hash, variant, fmt='jpeg'):
+    return default_storage.url(variant_name(content_hash, variant, fmt))
+
+
+def build_srcset(variants, fmt='webp'):
+    """'url 320w, url 800w, ...' for a `variants` dict ('' if not built yet)"""
+    widths = (variants or {}).get('widths')
+    if not widths:
+        return ''
+    return ', '.join(
+        f"{variant_url(variants['hash'], variant, fmt)} {width}w"
+        for variant, width in sorted(widths.items(), key=lambda item: item[1])
+    )
+
+
+# =====================
+# GENERATION
+# =====================
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+
+def _flatten(image):
+    """
+    RGB (or L) copy for JPEG. Transparent areas become white: a plain
+    convert('RGB') drops alpha and leaves them black.
+    """
+    if _has_alpha(image):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, 'white')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    if image.mode not in ('RGB', 'L'):
+        return image.convert('RGB')
+    return image
+
+
+def _encode(image, fmt):
+    pil_format, options = FORMATS[fmt]
+    if pil_format == 'JPEG':
+        image = _flatten(image)
+    buffer = io.BytesIO()
+    # No exif= argument: Pillow writes no EXIF/GPS metadata
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def generate_variants(field_file):
+    """
+    Write every variant of an uploaded image to storage.
+    Returns the `variants` dict ({'hash': ..., 'widths': {...}}).
+    """
+    with field_file.open('rb') as source:
+        data = source.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    with Image.open(io.BytesIO(data)) as original:
+        # Apply the EXIF orientation before it is dropped
+        image = ImageOps.exif_transpose(original)
+        if _has_alpha(image):
+            image = image.convert('RGBA')  # WebP keeps it, JPEG gets a white background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        widths = {}
+        for variant, max_width in VARIANT_WIDTHS.items():
+            width = min(max_width, image.width)
+            widths[variant] = width
+
+            names = {fmt: variant_name(content_hash, variant, fmt) for fmt in FORMATS}
+            if all(default_storage.exists(name) for name in names.values()):
+                continue  # Same content already processed
+
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+            for fmt, name in names.items():
+                if not default_storage.exists(name):
+                    default_storage.save(name, ContentFile(_encode(resized, fmt)))
+
+    return {'hash': content_hash, 'widths': widths}
+
+
+def build_variants(model, pk):
+    """Generate variants for one row and record them (runs in the pool)"""
+    try:
+        instance = model.objects.filter(pk=pk).first()
+        if instance is None or not instance.image:
+            return None
+        image_name = instance.image.name
+        variants = generate_variants(instance.image)
+        # Plain UPDATE: no signals, and skipped if the image was replaced meanwhile
+        updated = model.objects.filter(pk=pk, image=image_name).update(variants=variants)
+        if updated and model is ProductImage:
+            CATALOG.invalidate()  # cached product lists still carry the empty variants
+        return variants
+    except Exception as e:
+        print(f"⚠️  Image variants failed for {model.__name__} {pk}: {str(e)}")
+        return None
+    finally:
+        close_old_connections()
+
+
+def _replace_original(model, pk, old_name, content, extension):
+    """
+    Store `content` as the row's new original and delete the old file.
+    Returns False (keeping the old file) if the image was replaced meanwhile.
+    """
+    stem = old_name.rsplit('.', 1)[0]
+    new_name = default_storage.save(f'{stem}.{extension}', ContentFile(content))
+    updated = model.objects.filter(pk=pk, image=old_name).update(image=new_name)
+    if not updated:
+        default_storage.delete(new_name)  # Replaced by a newer upload meanwhile
+        return False
+    default_storage.delete(old_name)
+    if model is DeliveryProof:
+        touch_order(pk)  # proof URL changed
+    else:
+        CATALOG.invalidate()
+    return True
+
+
+def recompress_original(model, pk):
+    """
+    Replace an oversized upload with a downscaled, EXIF-free JPEG.
+    Returns True if the stored original was replaced.
+    """
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not instance.image:
+        return False
+    old_name = instance.image.name
+
+    with instance.image.open('rb') as source:
+        with Image.open(source) as original:
+            image = _flatten(ImageOps.exif_transpose(original))
+            image.thumbnail((PROOF_MAX_DIMENSION, PROOF_MAX_DIMENSION), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=PROOF_JPEG_QUALITY, optimize=True, progressive=True)
+
+    return _replace_original(model, pk, old_name, buffer.getvalue(), 'jpg')
+
+
+def strip_original_metadata(model, pk):
+    """
+    Rewrite an uploaded original that carries EXIF (camera, GPS, ...) without
+    it, in its own format and size, auto-rotated first. The original is still
+    served where no variant exists yet.
+    Returns True if the stored original was replaced.
+    """
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not instance.image:
+        return False
+    old_name = instance.image.name
+
+    with instance.image.open('rb') as source:
+        with Image.open(source) as original:
+            if not original.getexif() and 'exif' not in original.info:
+                return False
+            pil_format = original.format if original.format in ORIGINAL_FORMATS else 'JPEG'
+            extension, options = ORIGINAL_FORMATS[pil_format]
+            icc_profile = original.info.get('icc_profile')  # colour, not metadata: kept
+            image = ImageOps.exif_transpose(original)
+            if pil_format == 'JPEG':
+                image = _flatten(image)
+            buffer = io.BytesIO()
+            if icc_profile:
+                options = {**options, 'icc_profile': icc_profile}
+            image.save(buffer, pil_format, **options)
+
+    return _replace_original(model, pk, old_name, buffer.getvalue(), extension)
+
+
+def process_product_image(model, pk):
+    """Strip the original's metadata, then build its variants"""
+    try:
+        strip_original_metadata(model, pk)
+    except Exception as e:
+        print(f"⚠️  Stripping image metadata failed for {pk}: {str(e)}")
+    return build_variants(model, pk)
+
+
+def process_delivery_proof(model, pk):
+    """Recompress the driver's photo, then build its variants"""
+    try:
+        recompress_original(model, pk)
+    except Exception as e:
+        print(f"⚠️  Proof recompression failed for {pk}: {str(e)}")
+    return build_variants(model, pk)
+
+
+def schedule_variants(instance):
+    """Queue image processing once the current transaction commits"""
+    model, pk = type(instance), instance.pk
+    job = process_delivery_proof if model is DeliveryProof else process_product_image
+    transaction.on_commit(lambda: _get_executor().submit(job, model, pk))
+
+
+# =====================
+# SIGNALS
+# =====================
+
+@receiver(pre_save, sender=ProductImage)
+@receiver(pre_save, sender=DeliveryProof)
+def _reset_variants(sender, instance, **kwargs):
+    # Variants of the previous upload must not be served for the new one
+    if instance.image_changed():
+        instance.variants = {}
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=DeliveryProof)
+def _queue_variants(sender, instance, **kwargs):
+    if instance.image and instance.image_changed():
+        schedule_variants(instance)
+    instance._loaded_image_name = instance.image.name
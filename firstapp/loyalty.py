@@ -0,0 +1,211 @@
+"""
+Loyalty ledger maintenance
+
+Every change to a member's points goes through Member._apply_loyalty: one
+LoyaltyTransaction row plus F() updates of Member.loyalty_points and
+total_spent, under the member's row lock. The two Member columns are
+therefore a cached materialization of the ledger, and rebuild_balances()
+can recompute them from it in bulk:
+- members are processed in chunks (keyset on the primary key)
+- each chunk's member rows are locked, the ledger is summed with one
+  grouped query and the drifted members are set to their ledger sums with
+  one UPDATE (a correlated subquery, not a per-row CASE), so an
+  earn/redeem running at the same time waits instead of being lost
+
+recompute_from_history() goes one step further back, to the orders and
+payments themselves (`manage.py recompute_loyalty`):
+- earned: one earning payment per order (status Success, or a COD
+  payment, which is 'C' while the cash is pending; the first one if an
+  order has several, as add_loyalty_points earns once per order) at
+  RM 1 = 0.01 points, rounded half up per payment like add_loyalty_points
+- redeemed: Order.loyalty_points_used (points are spent when the order is
+  placed and not given back)
+Differences are written as 'A' ledger entries, and the balances are then
+set from the ledger the same way, so it still adds up to them afterwards.
+Every chunk commits on its own, and a run can be limited to a member id
+range (to resume an interrupted one, or split a large one into several).
+"""
+from collections import namedtuple
+from contextlib import closing
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import LoyaltyTransaction, Member, Order, Payment
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+
+EARNING_PAYMENTS = Q(status='S') | Q(method='COD', status='C')
+
+RECOMPUTE_NOTE = 'Recomputed from order history'
+
+# A member whose cached balances differ from what they should be
+Drift = namedtuple('Drift', ['member_id', 'points', 'spent', 'expected_points', 'expected_spent'])
+
+
+def _cents(value):
+    # Quantized to the column precision (SQLite sums decimals as floats)
+    return Decimal(value or 0).quantize(CENT)
+
+
+def _points_earned(amount):
+    # As Member.add_loyalty_points: RM 1 = 0.01 points, rounded half up per payment
+    return (amount * CENT).quantize(CENT, ROUND_HALF_UP)
+
+
+def _locked_chunks(chunk_size, queryset=None, start_id=None, end_id=None):
+    """
+    Members in pk order (all, or those in `queryset`, optionally only those
+    with start_id <= pk <= end_id), chunk by chunk, each chunk locked inside
+    its own transaction
+    """
+    last_pk = None
+    while True:
+        with transaction.atomic():
+            members = Member.objects.select_for_update().order_by('pk').only('pk', *Member.BALANCE_FIELDS)
+            if queryset is not None:
+                members = members.filter(pk__in=queryset.values('pk'))
+            if start_id is not None:
+                members = members.filter(pk__gte=start_id)
+            if end_id is not None:
+                members = members.filter(pk__lte=end_id)
+            if last_pk is not None:
+                members = members.filter(pk__gt=last_pk)
+            members = list(members[:chunk_size])
+            if not members:
+                return
+            last_pk = members[-1].pk
+            yield members
+
+
+def ledger_totals(member_ids):
+    """{member_id: (points, amount_spent)} summed from the ledger"""
+    rows = (
+        LoyaltyTransaction.objects.filter(member_id__in=member_ids)
+        .values('member_id')
+        .annotate(points=Sum('points'), spent=Sum('amount_spent'))
+        .values_list('member_id', 'points', 'spent')
+    )
+    return {member_id: (_cents(points), _cents(spent)) for member_id, points, spent in rows}
+
+
+def history_totals(first_pk, last_pk):
+    """
+    {member_id: (points, amount_spent)} recomputed from payments and orders,
+    for the users with first_pk <= pk <= last_pk (a member's pk is its user's)
+    """
+    # The ledger earns once per order, so only each order's first earning
+    # payment counts (a retried checkout can leave two). Picked here: a chunk
+    # has a few thousand, and a MIN(pk) subquery made SQLite scan every payment.
+    earning = (
+        Payment.objects.filter(
+            EARNING_PAYMENTS, order__address__user__gte=first_pk, order__address__user__lte=last_pk
+        )
+        .order_by()
+        .values_list('order_id', 'pk', 'order__address__user_id', 'total_amount')
+    )
+    first_payments = {}
+    for order_id, pk, user_id, amount in earning:
+        if order_id not in first_payments or pk < first_payments[order_id][0]:
+            first_payments[order_id] = (pk, user_id, _cents(amount))
+
+    redeemed = (
+        Order.objects.filter(address__user__gte=first_pk, address__user__lte=last_pk, loyalty_points_used__gt=0)
+        .values('address__user_id')
+        .annotate(used=Sum('loyalty_points_used'))
+        .values_list('address__user_id', 'used')
+    )
+
+    totals = {}
+    for _, user_id, amount in first_payments.values():
+        points, spent = totals.get(user_id, (ZERO, ZERO))
+        totals[user_id] = (points + _points_earned(amount), spent + amount)
+    for user_id, used in redeemed:
+        points, spent = totals.get(user_id, (ZERO, ZERO))
+        totals[user_id] = (points - _cents(used), spent)
+    return totals
+
+
+def _set_balances_from_ledger(member_ids):
+    """One UPDATE setting each member's cached balances to its ledger sums"""
+    entries = LoyaltyTransaction.objects.filter(member=OuterRef('pk')).values('member')
+    Member.objects.filter(pk__in=member_ids).update(
+        loyalty_points=Coalesce(Subquery(entries.annotate(total=Sum('points')).values('total')), ZERO),
+        total_spent=Coalesce(Subquery(entries.annotate(total=Sum('amount_spent')).values('total')), ZERO),
+    )
+
+
+def rebuild_balances(chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False, queryset=None):
+    """
+    Recompute every member's cached balances from the ledger (or only those
+    of the members in `queryset`).
+    Returns the drifted members as Drift tuples.
+    """
+    drifted = []
+    chunks = _locked_chunks(chunk_size, queryset)
+    with closing(chunks):  # an error rolls the open chunk back now, not when the generator is collected
+        for members in chunks:
+            totals = ledger_totals([member.pk for member in members])
+            changed = []
+            for member in members:
+                points, spent = totals.get(member.pk, (ZERO, ZERO))
+                if (member.loyalty_points, member.total_spent) != (points, spent):
+                    drifted.append(Drift(member.pk, member.loyalty_points, member.total_spent, points, spent))
+                    changed.append(member.pk)
+            if changed and not dry_run:
+                _set_balances_from_ledger(changed)
+    return drifted
+
+
+def recompute_from_history(chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False, start_id=None, end_id=None,
+                           on_commit=None):
+    """
+    Recompute every member's balances from order / payment history (or only
+    those with start_id <= pk <= end_id).
+    A balance that would go negative (points redeemed that the history
+    doesn't show being earned) is set to zero.
+    `on_commit(last_id)` is called once each chunk has committed, so an
+    interrupted run can be resumed from start_id=last_id + 1.
+    Returns the drifted members as Drift tuples.
+    """
+    drifted = []
+    done_id = None
+    chunks = _locked_chunks(chunk_size, start_id=start_id, end_id=end_id)
+    with closing(chunks):
+        for members in chunks:
+            # Asking for this chunk committed the previous one
+            if on_commit and done_id is not None:
+                on_commit(done_id)
+            done_id = members[-1].pk
+            history = history_totals(members[0].pk, members[-1].pk)
+            ledger = ledger_totals([member.pk for member in members])
+            changed = []
+            adjustments = []
+            for member in members:
+                points, spent = history.get(member.pk, (ZERO, ZERO))
+                points = max(points, ZERO)
+                if (member.loyalty_points, member.total_spent) != (points, spent):
+                    drifted.append(Drift(member.pk, member.loyalty_points, member.total_spent, points, spent))
+                    changed.append(member.pk)
+
+                ledger_points, ledger_spent = ledger.get(member.pk, (ZERO, ZERO))
+                if (ledger_points, ledger_spent) != (points, spent):
+                    adjustments.append(LoyaltyTransaction(
+                        member_id=member.pk, kind='A', note=RECOMPUTE_NOTE,
+                        points=points - ledger_points, amount_spent=spent - ledger_spent,
+                    ))
+            if not dry_run:
+                if adjustments:
+                    LoyaltyTransaction.objects.bulk_create(adjustments)
+                if changed:
+                    # The adjustments above make the ledger sum to the history
+                    _set_balances_from_ledger(changed)
+    if on_commit and done_id is not None:
+        on_commit(done_id)
+    return drifted
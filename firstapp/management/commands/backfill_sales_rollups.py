@@ -0,0 +1,40 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from firstapp.models import Order
+from firstapp.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily sales rollup tables used by the analytics dashboard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='First day to rebuild (YYYY-MM-DD); default: first order')
+        parser.add_argument('--until', help='Last day to rebuild (YYYY-MM-DD); default: today')
+        parser.add_argument(
+            '--chunk-days', type=int, default=31,
+            help='Days rebuilt per transaction',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            until = date.fromisoformat(options['until']) if options['until'] else timezone.localdate()
+            if options['since']:
+                since = date.fromisoformat(options['since'])
+            else:
+                first = Order.objects.order_by('created_at').values_list('created_at', flat=True).first()
+                since = timezone.localdate(first) if first else until
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        days = 0
+        chunk_start = since
+        while chunk_start <= until:
+            chunk_end = min(chunk_start + timedelta(days=options['chunk_days'] - 1), until)
+            days += rebuild_rollups(chunk_start, chunk_end)
+            self.stdout.write(f"Rebuilt {chunk_start} .. {chunk_end}")
+            chunk_start = chunk_end + timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(f'Rollups rebuilt: {days} day(s) with activity'))
@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from firstapp.images import build_variants
+from firstapp.models import DeliveryProof, ProductImage
+
+
+class Command(BaseCommand):
+    help = 'Build missing resized WebP/JPEG variants for product images and delivery proofs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Rebuild every image, not only those without variants',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'IMAGE_VARIANT_WORKERS', 2),
+        )
+
+    def handle(self, *args, **options):
+        jobs = []
+        for model in (ProductImage, DeliveryProof):
+            queryset = model.objects.exclude(image='')
+            if not options['all']:
+                queryset = queryset.filter(variants={})
+            jobs.extend((model, pk) for pk in queryset.values_list('pk', flat=True))
+
+        if not jobs:
+            self.stdout.write(self.style.SUCCESS('All images have variants'))
+            return
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            results = list(pool.map(lambda job: build_variants(*job), jobs))
+
+        failed = sum(1 for result in results if result is None)
+        self.stdout.write(self.style.SUCCESS(f'Built variants for {len(jobs) - failed} image(s)'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} image(s) failed, see log above'))
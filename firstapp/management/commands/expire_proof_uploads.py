@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from firstapp.uploads import expire_stale_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete delivery-proof uploads left unfinished, with their partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only list the stale uploads, do not delete them',
+        )
+
+    def handle(self, *args, **options):
+        expired = expire_stale_uploads(dry_run=options['check'])
+
+        for upload in expired:
+            self.stdout.write(
+                f'Upload {upload.id}: order {upload.order_id}, '
+                f'{upload.received_size}/{upload.total_size} bytes, last chunk {upload.updated_at:%Y-%m-%d %H:%M}'
+            )
+
+        if not expired:
+            self.stdout.write(self.style.SUCCESS('No stale uploads'))
+        elif options['check']:
+            self.stdout.write(self.style.WARNING(f'{len(expired)} stale upload(s)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Deleted {len(expired)} stale upload(s)'))
@@ -0,0 +1,65 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from firstapp.exports import DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, ExportError, parse_filters, sales_queryset
+
+
+class _TextOutput:
+    """self.stdout without the newline OutputWrapper appends to each write"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text):
+        self.stdout.write(text, ending='')
+
+    def flush(self):
+        self.stdout.flush()
+
+
+class Command(BaseCommand):
+    help = 'Export order items (with order, customer and payment columns) as CSV or Parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help='File to write; "-" for stdout')
+        parser.add_argument('--start', help='First order date (YYYY-MM-DD)')
+        parser.add_argument('--end', help='Last order date (YYYY-MM-DD)')
+        parser.add_argument('--status', help='Comma-separated order status codes, e.g. C,S,D')
+        parser.add_argument('--category', help='Category code, e.g. D')
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+            help='Rows fetched per query',
+        )
+
+    def handle(self, *args, **options):
+        writer = EXPORT_FORMATS[options['format']][0]
+        try:
+            queryset = sales_queryset(**parse_filters(
+                options['start'], options['end'], options['status'], options['category']
+            ))
+        except ExportError as e:
+            raise CommandError(str(e))
+
+        binary = options['format'] != 'csv'
+        if options['output'] == '-':
+            out = sys.stdout.buffer if binary else _TextOutput(self.stdout)
+            close = False
+        else:
+            out = open(options['output'], 'wb' if binary else 'w', newline=None if binary else '')
+            close = True
+
+        try:
+            for chunk in writer(queryset, chunk_size=options['chunk_size']):
+                out.write(chunk)
+        except ExportError as e:
+            raise CommandError(str(e))
+        finally:
+            if close:
+                out.close()
+            else:
+                out.flush()
+
+        if close:
+            self.stderr.write(self.style.SUCCESS(f"Export written to {options['output']}"))
@@ -0,0 +1,204 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from django.core.management.base import BaseCommand
+
+
+class FakeProviders:
+    """In-memory Stripe checkout sessions / payment intents and PayPal payments"""
+
+    def __init__(self, base_url, latency=0.0, error_rate=0.0):
+        self.base_url = base_url
+        self.latency = latency
+        self.error_rate = error_rate
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def save(self, obj):
+        with self.lock:
+            self.objects[obj['id']] = obj
+        return obj
+
+    def get(self, object_id):
+        with self.lock:
+            return self.objects.get(object_id)
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # load tests open many connections at once
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        pass  # a load test would drown the console
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode() if length else ''
+
+    def _api_delay(self):
+        """Simulated latency / outages; True if this call should fail"""
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        return random.random() < self.fake.error_rate
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def _route(self, method):
+        path = urlsplit(self.path).path.rstrip('/')
+        body = self._read_body()
+        parts = path.strip('/').split('/')
+
+        # Browser redirects (what the customer would do at the provider)
+        if method == 'GET' and parts[0] in ('pay', 'approve') and len(parts) == 2:
+            return self._approve(parts[0], parts[1])
+
+        if self._api_delay():
+            return self._send(503, {'error': {'message': 'Fake provider outage'}})
+
+        if path == '/v1/checkout/sessions' and method == 'POST':
+            return self._send(200, self._create_session(parse_qs(body)))
+        if path == '/v1/payment_intents' and method == 'POST':
+            return self._send(200, self._create_intent(parse_qs(body)))
+        if path == '/v1/oauth2/token' and method == 'POST':
+            return self._send(200, {'access_token': uuid.uuid4().hex, 'token_type': 'Bearer', 'expires_in': 32400})
+        if path == '/v1/payments/payment' and method == 'POST':
+            return self._send(201, self._create_paypal(json.loads(body or '{}')))
+        if len(parts) == 5 and parts[:3] == ['v1', 'payments', 'payment'] and parts[4] == 'execute':
+            return self._execute_paypal(parts[3])
+        if len(parts) == 5 and parts[:3] == ['v1', 'checkout', 'sessions'] and parts[4] == 'expire':
+            return self._expire_session(parts[3])
+
+        if method == 'GET' and len(parts) in (3, 4):
+            obj = self.fake.get(parts[-1])
+            if obj is not None:
+                return self._send(200, obj)
+        if parts[:2] == ['v1', 'payments']:
+            return self._send(404, {'name': 'INVALID_RESOURCE_ID', 'message': 'Requested resource ID was not found.'})
+        self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'No such object: {path}'}})
+
+    # ----- Stripe -----
+
+    def _create_session(self, form):
+        session_id = f'cs_test_{uuid.uuid4().hex}'
+        return self.fake.save({
+            'id': session_id,
+            'object': 'checkout.session',
+            'status': 'open',
+            'payment_status': 'unpaid',
+            'url': f'{self.fake.base_url}/pay/{session_id}',
+            'success_url': form.get('success_url', [''])[0],
+            'metadata': {
+                key[len('metadata['):-1]: values[0] for key, values in form.items() if key.startswith('metadata[')
+            },
+        })
+
+    def _expire_session(self, session_id):
+        session = self.fake.get(session_id)
+        if session is None or session['status'] != 'open':
+            return self._send(400, {'error': {'type': 'invalid_request_error', 'message': 'Session is not open'}})
+        session['status'] = 'expired'
+        self._send(200, session)
+
+    def _create_intent(self, form):
+        intent_id = f'pi_{uuid.uuid4().hex}'
+        return self.fake.save({
+            'id': intent_id,
+            'object': 'payment_intent',
+            'status': 'requires_payment_method',
+            'amount': int(form.get('amount', ['0'])[0]),
+            'currency': form.get('currency', ['myr'])[0],
+            'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:12]}',
+        })
+
+    # ----- PayPal -----
+
+    def _create_paypal(self, data):
+        payment_id = f'PAY-{uuid.uuid4().hex[:24].upper()}'
+        return self.fake.save({
+            'id': payment_id,
+            'intent': 'sale',
+            'state': 'created',
+            'transactions': data.get('transactions', []),
+            'return_url': data.get('redirect_urls', {}).get('return_url', ''),
+            'links': [
+                {'rel': 'self', 'href': f'{self.fake.base_url}/v1/payments/payment/{payment_id}', 'method': 'GET'},
+                {'rel': 'approval_url', 'href': f'{self.fake.base_url}/approve/{payment_id}', 'method': 'REDIRECT'},
+            ],
+        })
+
+    def _execute_paypal(self, payment_id):
+        payment = self.fake.get(payment_id)
+        if payment is None:
+            return self._send(404, {'name': 'INVALID_RESOURCE_ID', 'message': 'Requested resource ID was not found.'})
+        payment['state'] = 'approved'
+        self._send(200, payment)
+
+    # ----- Customer approval -----
+
+    def _approve(self, kind, object_id):
+        obj = self.fake.get(object_id)
+        if obj is None:
+            return self._send(404, {'error': 'unknown checkout'})
+        if kind == 'pay':
+            obj['payment_status'] = 'paid'
+            obj['status'] = 'complete'
+            location = obj['success_url'].replace('{CHECKOUT_SESSION_ID}', object_id)
+        else:
+            obj['payer'] = {'payment_method': 'paypal', 'payer_info': {'payer_id': 'FAKEPAYER'}}
+            query = urlencode({'paymentId': object_id, 'token': 'EC-FAKE', 'PayerID': 'FAKEPAYER'})
+            location = f"{obj['return_url']}?{query}"
+        self._send(302, headers={'Location': location})
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake Stripe/PayPal API for offline checkout load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds added to every API call')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of API calls answered with 503')
+
+    def handle(self, *args, **options):
+        base_url = f"http://{options['host']}:{options['port']}"
+        server = FakeServer((options['host'], options['port']), Handler)
+        server.fake = FakeProviders(base_url, options['latency'], options['error_rate'])
+
+        self.stdout.write(f'Fake payment provider on {base_url}')
+        self.stdout.write(f'  STRIPE_API_BASE={base_url} PAYPAL_API_BASE={base_url}')
+        self.stdout.write('  Checkout URLs it returns (/pay/..., /approve/...) redirect straight back to the shop')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
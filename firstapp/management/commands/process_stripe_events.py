@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from firstapp.webhooks import format_counts, process_batch
+
+
+class Command(BaseCommand):
+    help = 'Process stored Stripe webhook events (retries and anything the in-process pool missed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process due events and exit')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4, help='Events processed in parallel')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to sleep when nothing is due')
+
+    def handle(self, *args, **options):
+        while True:
+            counts = process_batch(options['batch_size'], options['workers'])
+            if counts:
+                self.stdout.write(format_counts(counts))
+                continue  # Keep draining while there is work
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from firstapp.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized cart item_count/subtotal counters from cart items'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report carts with wrong counters, do not fix them',
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        drifted = Cart.objects.rebuild_counters(
+            batch_size=options['batch_size'],
+            dry_run=options['check'],
+        )
+
+        for cart in drifted:
+            self.stdout.write(
+                f"Cart {cart.pk}: item_count={cart.item_count} subtotal={cart.subtotal}"
+            )
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All cart counters are consistent'))
+        elif options['check']:
+            self.stdout.write(self.style.WARNING(f'{len(drifted)} cart(s) have drifted counters'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt counters for {len(drifted)} cart(s)'))
@@ -0,0 +1,65 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand
+
+from firstapp.loyalty import DEFAULT_CHUNK_SIZE, Drift, recompute_from_history
+
+
+class Command(BaseCommand):
+    help = "Recompute members' loyalty points and total spent from order/payment history"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report members with wrong balances, do not fix them',
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Members locked and recomputed per transaction')
+        parser.add_argument('--report', help='Write every discrepancy to this CSV file')
+        parser.add_argument('--start-id', type=int,
+                            help='Only members with this id or higher (resume an interrupted run from here)')
+        parser.add_argument('--end-id', type=int, help='Only members with this id or lower')
+
+    def handle(self, *args, **options):
+        committed = []
+
+        def on_commit(last_id):
+            committed.append(last_id)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Members up to id {last_id} done')
+
+        started = time.monotonic()
+        try:
+            drifted = recompute_from_history(
+                chunk_size=options['batch_size'],
+                dry_run=options['check'],
+                start_id=options['start_id'],
+                end_id=options['end_id'],
+                on_commit=on_commit,
+            )
+        except Exception:
+            if committed:
+                self.stderr.write(f'Stopped after member {committed[-1]}, '
+                                  f'resume with --start-id {committed[-1] + 1}')
+            raise
+        elapsed = time.monotonic() - started
+
+        for drift in drifted:
+            self.stdout.write(
+                f'Member {drift.member_id}: points {drift.points} -> {drift.expected_points}, '
+                f'spent {drift.spent} -> {drift.expected_spent}'
+            )
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(Drift._fields)
+                writer.writerows(drifted)
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(f'All member balances match the order history ({elapsed:.1f}s)'))
+        elif options['check']:
+            self.stdout.write(self.style.WARNING(f'{len(drifted)} member(s) have wrong balances ({elapsed:.1f}s)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Recomputed balances for {len(drifted)} member(s) ({elapsed:.1f}s)'))
@@ -0,0 +1,57 @@
+import csv
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from firstapp.reconciliation import (
+    DEFAULT_BATCH_SIZE, DEFAULT_WORKERS, RECONCILED_METHODS, Result, reconcile,
+)
+
+
+class Command(BaseCommand):
+    help = 'Settle pending Stripe/PayPal payments from the providers and report what changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Provider lookups in flight at once')
+        parser.add_argument('--min-age', type=int, default=15,
+                            help='Minutes a payment must be pending before it is checked')
+        parser.add_argument('--stale-hours', type=int, default=24,
+                            help='Close checkouts still open after this many hours')
+        parser.add_argument('--method', choices=RECONCILED_METHODS, help='Only this payment method')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Look up and report, but change nothing here or at the providers')
+        parser.add_argument('--report', help='Write every checked payment to this CSV file')
+
+    def handle(self, *args, **options):
+        def on_batch(results, applied):
+            self.stdout.write(f'Checked {len(results)} payments, updated {len(applied)}')
+            for result in applied:
+                self.stdout.write(
+                    f'  Payment {result.payment_id} ({result.method} {result.reference}): '
+                    f'{result.outcome} [{result.provider_state}] {result.detail}'.rstrip()
+                )
+
+        counts, report = reconcile(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            min_age=timedelta(minutes=options['min_age']),
+            stale_after=timedelta(hours=options['stale_hours']),
+            methods=(options['method'],) if options['method'] else RECONCILED_METHODS,
+            dry_run=options['dry_run'],
+            on_batch=on_batch,
+        )
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(Result._fields)
+                writer.writerows(report)
+
+        updated = counts.pop('updated', 0)
+        summary = ', '.join(f'{outcome}: {count}' for outcome, count in sorted(counts.items()))
+        prefix = 'Dry run - ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}{len(report)} pending payments checked, {updated} updated' + (f' ({summary})' if summary else '')
+        ))
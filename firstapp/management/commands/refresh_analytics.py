@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from firstapp.analytics import PERIODS, refresh_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cached analytics dashboard snapshots for every period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Refresh every period once and exit')
+        parser.add_argument('--interval', type=float, default=240.0,
+                            help='Seconds between refresh rounds')
+
+    def handle(self, *args, **options):
+        while True:
+            for period in PERIODS:
+                started = time.monotonic()
+                try:
+                    refresh_snapshot(period)
+                except Exception as e:
+                    self.stderr.write(f'Period {period} failed: {e}')
+                    continue
+                self.stdout.write(f'Period {period} refreshed in {time.monotonic() - started:.2f}s')
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
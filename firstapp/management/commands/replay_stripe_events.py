@@ -0,0 +1,51 @@
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from firstapp.models import StripeEvent
+from firstapp.webhooks import format_counts, process_batch, replay
+
+
+class Command(BaseCommand):
+    help = 'Re-queue stored Stripe webhook events (by id, type, status or date) and optionally process them now'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_ids', nargs='*', help='Stripe event ids (evt_...)')
+        parser.add_argument('--status', help='Only events with this status (P, D, I, F), e.g. F for failed ones')
+        parser.add_argument('--type', help='Only events of this type, e.g. checkout.session.completed')
+        parser.add_argument('--since', help='Only events received on/after this date (YYYY-MM-DD)')
+        parser.add_argument('--process', action='store_true', help='Process the replayed events before exiting')
+        parser.add_argument('--dry-run', action='store_true', help='Only show how many events match')
+
+    def handle(self, *args, **options):
+        events = StripeEvent.objects.all()
+        if options['event_ids']:
+            events = events.filter(event_id__in=options['event_ids'])
+        if options['status']:
+            events = events.filter(status=options['status'].upper())
+        if options['type']:
+            events = events.filter(type=options['type'])
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            events = events.filter(received_at__gte=timezone.make_aware(datetime.combine(since, time.min)))
+        if not (options['event_ids'] or options['status'] or options['type'] or options['since']):
+            raise CommandError('Give event ids or at least one of --status, --type, --since')
+
+        if options['dry_run']:
+            self.stdout.write(f'{events.count()} event(s) match')
+            return
+
+        count = replay(events)
+        self.stdout.write(f'Re-queued {count} event(s)')
+
+        if options['process']:
+            while True:
+                counts = process_batch()
+                if not counts:
+                    break
+                self.stdout.write(format_counts(counts))
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from firstapp.notifications import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Drain the notification outbox (order emails) over a reused SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process due notifications and exit')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to sleep when the outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = process_batch(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'Sent {sent}, failed {failed}')
+                continue  # Keep draining while there is work
+            if options['once']:
+                break
+            time.sleep(options['interval'])
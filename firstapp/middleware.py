@@ -0,0 +1,174 @@
+"""
+Session user resolution
+
+The shop uses its own User model keyed by request.session['user_id'], not
+django.contrib.auth. Everything that needs the logged-in user goes through
+get_session_user(), which hits the DB at most once per request (and usually
+not at all: the row's fields, minus the password hash, are kept in the
+shared USERS cache). Pages that only
+display name/email/role can use get_user_snapshot(), which reads a signed
+copy of those fields from the session without any query. The snapshot is
+only refreshed at login, so it is never used for access checks: a revoked
+driver/admin role or a deleted user must take effect at once, which
+get_session_user() does (the USERS entry is dropped when a user changes).
+
+The middleware here supports both sync and async requests. Under the ASGI
+server a sync-only middleware would run the rest of the chain on Django's
+single thread-sensitive worker thread, so one async view awaiting a payment
+provider would hold up every other request of the process.
+"""
+from collections import namedtuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.core import signing
+from django.utils.functional import SimpleLazyObject
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from .caching import USERS
+from .models import User
+
+
+SNAPSHOT_SESSION_KEY = 'user_snapshot'
+SNAPSHOT_SALT = 'firstapp.user_snapshot'
+
+_UNRESOLVED = object()
+
+# What USERS keeps per user: every column but the password hash, which stays
+# deferred on session users (the password views load it when they read it)
+CACHED_USER_FIELDS = tuple(
+    field.attname for field in User._meta.concrete_fields if field.attname != 'password'
+)
+
+
+class UserSnapshot(namedtuple('UserSnapshot', ['id', 'name', 'email', 'role'])):
+    """Identity fields of the logged-in user, with the same role helpers as User"""
+    __slots__ = ()
+
+    def is_member(self):
+        return self.role == 'M'
+
+    def is_admin(self):
+        return self.role == 'A'
+
+    def is_driver(self):
+        return self.role == 'D'
+
+
+def get_session_user(request):
+    """Return the User for the session (one query per request at most), or None"""
+    user = getattr(request, '_session_user_cache', _UNRESOLVED)
+    if user is not _UNRESOLVED:
+        return user
+
+    user = None
+    user_id = request.session.get('user_id')
+    if user_id:
+        values = USERS.get(user_id)
+        if values is not None:
+            user = User.from_db(User.objects.db, CACHED_USER_FIELDS, values)
+        else:
+            user = User.objects.filter(pk=user_id).only(*CACHED_USER_FIELDS).first()
+            if user is not None:
+                USERS.set(user_id, [getattr(user, field) for field in CACHED_USER_FIELDS])
+    request._session_user_cache = user
+    return user
+
+
+def set_session_user(request, user):
+    """Log `user` into the session and refresh the cached user and snapshot"""
+    request.session['user_id'] = user.id
+    request.session['user_name'] = user.name
+    request.session['user_email'] = user.email
+    request.session['user_role'] = user.role
+    request.session[SNAPSHOT_SESSION_KEY] = signing.dumps(
+        [user.id, user.name, user.email, user.role], salt=SNAPSHOT_SALT
+    )
+    request._session_user_cache = user
+
+
+def clear_session_user(request):
+    """Forget the cached user (call after session.flush())"""
+    request._session_user_cache = None
+
+
+def get_user_snapshot(request):
+    """
+    Return a UserSnapshot for the session user without touching the DB, or None
+    For display only: it can be stale, so role checks use get_session_user().
+    """
+    user_id = request.session.get('user_id')
+    if not user_id:
+        return None
+
+    signed = request.session.get(SNAPSHOT_SESSION_KEY)
+    if signed:
+        try:
+            snapshot = UserSnapshot(*signing.loads(signed, salt=SNAPSHOT_SALT))
+            if snapshot.id == user_id:
+                return snapshot
+        except (signing.BadSignature, TypeError):
+            pass
+
+    # Sessions created before snapshots existed (or tampered ones):
+    # resolve once and store a fresh snapshot
+    user = get_session_user(request)
+    if not user:
+        return None
+    set_session_user(request, user)
+    return UserSnapshot(user.id, user.name, user.email, user.role)
+
+
+class SessionUserMiddleware:
+    """
+    Attach the session user lazily to every request:
+    - request.shop_user: the User (queried on first access only)
+    - request.user_snapshot: UserSnapshot from the session (no query, display only)
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _attach(self, request):
+        request.shop_user = SimpleLazyObject(lambda: get_session_user(request))
+        request.user_snapshot = SimpleLazyObject(lambda: get_user_snapshot(request))
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self._attach(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        self._attach(request)
+        return await self.get_response(request)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise (sync-only upstream) that passes async requests straight through"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+FULLTEXT_INDEX = 'product_search_ft'
+
+
+def create_fulltext_index(apps, schema_editor):
+    # FULLTEXT is MySQL-only; other databases use the in-memory search backend
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    schema_editor.execute(
+        f'CREATE FULLTEXT INDEX {FULLTEXT_INDEX} ON product '
+        '(name, short_description, description, ingredients)'
+    )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    schema_editor.execute(f'DROP INDEX {FULLTEXT_INDEX} ON product')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0002_alter_user_role_deliveryproof'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0 on 2026-10-18 00:30
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def backfill_cart_counters(apps, schema_editor):
+    Cart = apps.get_model('firstapp', 'Cart')
+    CartItem = apps.get_model('firstapp', 'CartItem')
+
+    totals = CartItem.objects.values('cart_id').annotate(
+        count=Sum('quantity'),
+        subtotal=Sum(F('quantity') * F('product__price')),
+    )
+    carts = []
+    for row in totals:
+        carts.append(Cart(pk=row['cart_id'], item_count=row['count'], subtotal=row['subtotal']))
+    Cart.objects.bulk_update(carts, ['item_count', 'subtotal'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0003_product_fulltext_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=10),
+        ),
+        migrations.RunPython(backfill_cart_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-18 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0005_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncryptionKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_id', models.CharField(max_length=32, unique=True)),
+                ('kms_key_id', models.CharField(max_length=255)),
+                ('wrapped_key', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Encryption Key',
+                'verbose_name_plural': 'Encryption Keys',
+                'db_table': 'encryption_key',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 02:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0006_encryption_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deliveryproof',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='productimage',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
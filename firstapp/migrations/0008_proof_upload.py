@@ -0,0 +1,34 @@
+# Generated by Django 6.0 on 2026-10-18 03:10
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0007_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProofUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('total_size', models.PositiveBigIntegerField()),
+                ('received_size', models.PositiveBigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('U', 'Uploading'), ('C', 'Complete')], default='U', max_length=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='proof_uploads', to='firstapp.user')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='proof_uploads', to='firstapp.order')),
+            ],
+            options={
+                'verbose_name': 'Proof Upload',
+                'verbose_name_plural': 'Proof Uploads',
+                'db_table': 'proof_upload',
+            },
+        ),
+    ]
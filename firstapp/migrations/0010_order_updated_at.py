@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-18 04:20
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def backfill_updated_at(apps, schema_editor):
+    Order = apps.get_model('firstapp', 'Order')
+    DeliveryProof = apps.get_model('firstapp', 'DeliveryProof')
+
+    # Existing rows got the migration time; use the best known last change instead
+    Order.objects.update(updated_at=F('created_at'))
+    Order.objects.filter(delivery_proof__isnull=False).update(
+        updated_at=Subquery(
+            DeliveryProof.objects.filter(order_id=OuterRef('pk')).values('uploaded_at')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0009_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['address', 'updated_at'], name='order_address_f022d1_idx'),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 6.0 on 2026-10-18 06:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def open_ledger(apps, schema_editor):
+    """One opening entry per member, so the ledger sums to the current balances"""
+    Member = apps.get_model('firstapp', 'Member')
+    LoyaltyTransaction = apps.get_model('firstapp', 'LoyaltyTransaction')
+    members = Member.objects.exclude(Q(loyalty_points=0) & Q(total_spent=0)).values_list(
+        'pk', 'loyalty_points', 'total_spent'
+    )
+    LoyaltyTransaction.objects.bulk_create(
+        (
+            LoyaltyTransaction(
+                member_id=pk, kind='O', points=points, amount_spent=spent,
+                note='Balance before the loyalty ledger',
+            )
+            for pk, points, spent in members.iterator(chunk_size=2000)
+        ),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firstapp', '0012_stripe_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoyaltyTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('O', 'Opening balance'), ('E', 'Earned'), ('R', 'Redeemed'), ('A', 'Adjustment')], max_length=1)),
+                ('points', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('amount_spent', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('note', models.CharField(blank=True, default='', max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='loyalty_entries', to='firstapp.member')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loyalty_entries', to='firstapp.order')),
+            ],
+            options={
+                'verbose_name': 'Loyalty Transaction',
+                'verbose_name_plural': 'Loyalty Transactions',
+                'db_table': 'loyalty_transaction',
+                'ordering': ['-created_at', '-id'],
+                'indexes': [models.Index(fields=['member', 'created_at'], name='loyalty_tra_member__46dd93_idx')],
+                'constraints': [models.UniqueConstraint(fields=('order', 'kind'), name='loyalty_transaction_order_kind')],
+            },
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,27 @@
 # UPDATED MODELS.PY - Multiple Addresses + Improvements
 
+import logging
 import os
-from django.db import models
+import uuid
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Prefetch, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from datetime import timedelta, date
 from django.conf import settings
-from decimal import Decimal
-from django.core.mail import send_mail
+from decimal import Decimal, ROUND_HALF_UP
+from django.core.mail import EmailMultiAlternatives, send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 
 
+logger = logging.getLogger(__name__)
+
+
 # -----------------------
 # User (Base User Model)
 # -----------------------
@@ -170,7 +180,12 @@ class Member(models.Model):
     UPDATED LOYALTY LOGIC:
     - Earn: RM 1 spent = 0.01 points
     - Redeem: 1 point = RM 0.5 discount
+    loyalty_points / total_spent are a cached sum of the member's
+    LoyaltyTransaction rows: they only move together with a new ledger
+    entry (_apply_loyalty) or when rebuilt from it (firstapp.loyalty).
     """
+    BALANCE_FIELDS = ('loyalty_points', 'total_spent')
+
     user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='member_profile')
     loyalty_points = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     total_spent = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
@@ -184,31 +199,67 @@ class Member(models.Model):
     def __str__(self):
         return f"{self.user.name} - Points: {self.loyalty_points}"
     
-    def add_loyalty_points(self, amount_spent):
+    def save(self, *args, **kwargs):
+        # Never write back balances read earlier: another request may have
+        # moved them since (they change through _apply_loyalty only)
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.BALANCE_FIELDS
+            ]
+        super().save(*args, **kwargs)
+    
+    def _apply_loyalty(self, kind, points, amount_spent=Decimal('0'), order=None, note=''):
+        """
+        Append a ledger entry and move the cached balances by the same
+        amounts, holding the member's row lock. An order gets at most one
+        entry per kind: a repeated call returns the existing entry unchanged.
+        Returns (entry, created).
+        """
+        with transaction.atomic():
+            locked = Member.objects.select_for_update().only('loyalty_points').get(pk=self.pk)
+            entry = None
+            if order is not None:
+                entry = LoyaltyTransaction.objects.filter(order=order, kind=kind).first()
+            if entry is None:
+                if points < 0 and locked.loyalty_points + points < 0:
+                    raise ValidationError("Insufficient loyalty points")
+                entry = LoyaltyTransaction.objects.create(
+                    member_id=self.pk, kind=kind, points=points,
+                    amount_spent=amount_spent, order=order, note=note,
+                )
+                Member.objects.filter(pk=self.pk).update(
+                    loyalty_points=F('loyalty_points') + points,
+                    total_spent=F('total_spent') + amount_spent,
+                )
+                created = True
+            else:
+                created = False
+            self.refresh_from_db(fields=list(self.BALANCE_FIELDS))
+        return entry, created
+    
+    def add_loyalty_points(self, amount_spent, order=None):
         """
         Add loyalty points based on spending
         UPDATED RULE: Spend RM 1 = 0.01 points
+        Once per order: returns the points earned by that order either way.
         """
-        points_earned = Decimal(str(amount_spent)) / Decimal('100')
-        self.loyalty_points += points_earned
-        self.total_spent += Decimal(str(amount_spent))
-        self.save()
-        return points_earned
+        amount_spent = Decimal(str(amount_spent))
+        # Rounded here, as the recompute from order history rounds each payment (firstapp.loyalty)
+        points = self.calculate_points_from_spending(amount_spent).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        entry, _ = self._apply_loyalty('E', points, amount_spent, order=order)
+        return entry.points
 
-    def redeem_points(self, points_to_redeem):
+    def redeem_points(self, points_to_redeem, order=None):
         """
         Redeem loyalty points
         UPDATED RULE: 1 point = RM 0.5 discount
         """
         points_to_redeem = Decimal(str(points_to_redeem))
-        if points_to_redeem > self.loyalty_points:
-            raise ValidationError("Insufficient loyalty points")
-        
-        self.loyalty_points -= points_to_redeem
-        self.save()
+        entry, _ = self._apply_loyalty('R', -points_to_redeem, order=order)
         
         # Return discount amount: 1 point = RM 0.5
-        discount_amount = points_to_redeem * Decimal('0.5')
+        discount_amount = self.calculate_discount_from_points(-entry.points)
         return discount_amount
     
     def get_points_value(self):
@@ -224,6 +275,46 @@ class Member(models.Model):
         return Decimal(str(points)) * Decimal('0.5')
 
 
+# -----------------------
+# Loyalty Ledger
+# -----------------------
+class LoyaltyTransaction(models.Model):
+    """
+    Append-only record of every change to a member's points / spending
+    Member.loyalty_points and total_spent equal the sums of these rows.
+    """
+    kind_choices = [
+        ('O', 'Opening balance'),
+        ('E', 'Earned'),
+        ('R', 'Redeemed'),
+        ('A', 'Adjustment'),
+    ]
+
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='loyalty_entries')
+    kind = models.CharField(max_length=1, choices=kind_choices)
+    points = models.DecimalField(max_digits=10, decimal_places=2)  # negative when redeemed
+    amount_spent = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    order = models.ForeignKey('Order', on_delete=models.SET_NULL, null=True, blank=True, related_name='loyalty_entries')
+    note = models.CharField(max_length=200, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'loyalty_transaction'
+        verbose_name = 'Loyalty Transaction'
+        verbose_name_plural = 'Loyalty Transactions'
+        ordering = ['-created_at', '-id']
+        constraints = [
+            # One earn / one redemption per order (NULL orders don't collide)
+            models.UniqueConstraint(fields=['order', 'kind'], name='loyalty_transaction_order_kind'),
+        ]
+        indexes = [
+            models.Index(fields=['member', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.points} pts for member {self.member_id}"
+
+
 # -----------------------
 # Product Category
 # -----------------------
@@ -260,6 +351,37 @@ class ProductCategory(models.Model):
 # -----------------------
 # Product
 # -----------------------
+def product_images_prefetch(lookup='images'):
+    """
+    Prefetch for Product.images ordered primary-first, so get_primary_image()
+    and get_all_images() read it instead of querying per product.
+    `lookup` may go through relations, e.g. 'product__images' on CartItem.
+    """
+    return Prefetch(lookup, queryset=ProductImage.objects.order_by('-is_primary', 'order'))
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_images(self):
+        """Load every product's images (primary first) in one extra query"""
+        return self.prefetch_related(product_images_prefetch())
+
+
+class ProductManager(models.Manager.from_queryset(ProductQuerySet)):
+    def decrement_stock(self, product_id, quantity):
+        """
+        Take `quantity` units in one conditional UPDATE
+        (stock = stock - qty WHERE stock >= qty), so concurrent checkouts can
+        never oversell. Marks the product Out of Stock when it hits zero.
+        Returns True if the stock was taken.
+        """
+        updated = self.filter(pk=product_id, stock__gte=quantity).update(
+            # Listed before stock: MySQL evaluates SET left to right
+            status=Case(When(stock=quantity, then=Value(2)), default=F('status')),
+            stock=F('stock') - quantity,
+        )
+        return updated == 1
+
+
 class Product(models.Model):
     """
     Chocolate products available for purchase
@@ -280,6 +402,8 @@ class Product(models.Model):
     status = models.IntegerField(choices=status_choices, default=1)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ProductManager()
+
     class Meta:
         db_table = 'product'
         verbose_name = 'Product'
@@ -292,6 +416,21 @@ class Product(models.Model):
     def __str__(self):
         return f"{self.name} (RM {self.price})"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_price = instance.__dict__.get('price')
+        return instance
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Cart subtotals are denormalized; re-price carts holding this product
+        loaded_price = getattr(self, '_loaded_price', None)
+        if loaded_price is not None and loaded_price != self.price:
+            cart_ids = CartItem.objects.filter(product_id=self.pk).values_list('cart_id', flat=True)
+            Cart.objects.rebuild_counters(cart_ids=list(cart_ids))
+        self._loaded_price = self.price
+    
     def is_available(self):
         """Check if product is available for purchase"""
         return self.status == 1 and self.stock > 0
@@ -302,11 +441,8 @@ class Product(models.Model):
     
     def reduce_stock(self, quantity):
         """Reduce stock and update status if needed"""
-        if self.stock >= quantity:
-            self.stock -= quantity
-            if self.stock == 0:
-                self.status = 2  # Out of Stock
-            self.save()
+        if Product.objects.decrement_stock(self.pk, quantity):
+            self.refresh_from_db(fields=['stock', 'status'])
             return True
         return False
     
@@ -317,8 +453,17 @@ class Product(models.Model):
             self.status = 1  # Active
         self.save()
     
+    def _prefetched_images(self):
+        """Images from product_images_prefetch() (primary first), or None if not prefetched"""
+        if 'images' in getattr(self, '_prefetched_objects_cache', {}):
+            return list(self.images.all())
+        return None
+
     def get_primary_image(self):
         """Get the primary product image"""
+        prefetched = self._prefetched_images()
+        if prefetched is not None:
+            return prefetched[0] if prefetched else None
         images = self.images.filter(is_primary=True).first()
         if not images:
             images = self.images.first()
@@ -326,17 +471,59 @@ class Product(models.Model):
     
     def get_all_images(self):
         """Get all product images"""
+        prefetched = self._prefetched_images()
+        if prefetched is not None:
+            return prefetched
         return self.images.all().order_by('-is_primary', 'order')
 
 
+# -----------------------
+# Responsive image variants
+# -----------------------
+class ResponsiveImageMixin:
+    """
+    Resized WebP/JPEG variants of `image`, built off the request path by
+    firstapp.images. `variants` is {'hash': <content hash>, 'widths': {name: px}}
+    and stays empty until the worker has written the files; until then the
+    helpers fall back to the original upload.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_image_name = instance.image.name if 'image' in field_names else None
+        return instance
+
+    def image_changed(self):
+        return self.image.name != getattr(self, '_loaded_image_name', None)
+
+    def get_variant_url(self, variant='detail', fmt='jpeg'):
+        from .images import variant_url
+        if self.variants.get('widths', {}).get(variant):
+            return variant_url(self.variants['hash'], variant, fmt)
+        return self.image.url
+
+    def get_thumbnail_url(self):
+        return self.get_variant_url('thumb')
+
+    def get_detail_url(self):
+        return self.get_variant_url('detail')
+
+    def get_srcset(self, fmt='webp'):
+        """srcset string over every variant ('' while variants are pending)"""
+        from .images import build_srcset
+        return build_srcset(self.variants, fmt)
+
+
 # -----------------------
 # Product Image
 # -----------------------
-class ProductImage(models.Model):
+class ProductImage(ResponsiveImageMixin, models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='products/')
     is_primary = models.BooleanField(default=False)
     order = models.IntegerField(default=0)
+    variants = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -370,13 +557,101 @@ class ProductImage(models.Model):
 # -----------------------
 # Cart
 # -----------------------
+CART_COUNTERS_CACHE_KEY = 'cart:{}:counters'
+CART_COUNTERS_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class CartManager(models.Manager):
+    def with_items(self):
+        """Carts with items, their products (and categories) and product images in 2 extra queries"""
+        return self.prefetch_related(Prefetch(
+            'items',
+            queryset=CartItem.objects.select_related('product__category').prefetch_related(
+                product_images_prefetch('product__images')
+            )
+        ))
+
+    def get_counters(self, cart_id):
+        """
+        Get (item_count, subtotal) for a cart without scanning its items
+        Served from the cache; falls back to one primary-key lookup.
+        """
+        key = CART_COUNTERS_CACHE_KEY.format(cart_id)
+        counters = cache.get(key)
+        if counters is None:
+            counters = self.filter(pk=cart_id).values_list('item_count', 'subtotal').first()
+            if counters is None:
+                return 0, Decimal('0.00')
+            cache.set(key, counters, CART_COUNTERS_CACHE_TIMEOUT)
+        return counters
+
+    def apply_delta(self, cart_id, quantity_delta, amount_delta):
+        """
+        Atomically shift a cart's counters (call inside the CartItem
+        transaction) and mirror the new values into the cache on commit.
+        Returns the new (item_count, subtotal).
+        """
+        self.filter(pk=cart_id).update(
+            item_count=F('item_count') + quantity_delta,
+            subtotal=F('subtotal') + amount_delta,
+        )
+        counters = self.filter(pk=cart_id).values_list('item_count', 'subtotal').get()
+        self._cache_on_commit(cart_id, counters)
+        return counters
+
+    def _cache_on_commit(self, cart_id, counters):
+        key = CART_COUNTERS_CACHE_KEY.format(cart_id)
+        transaction.on_commit(lambda: cache.set(key, counters, CART_COUNTERS_CACHE_TIMEOUT))
+
+    def rebuild_counters(self, cart_ids=None, batch_size=500, dry_run=False):
+        """
+        Recompute item_count/subtotal from cart items with one grouped query
+        Returns the carts whose stored counters were wrong (fixed unless dry_run).
+        """
+        items = CartItem.objects.all()
+        carts = self.all()
+        if cart_ids is not None:
+            items = items.filter(cart_id__in=cart_ids)
+            carts = carts.filter(pk__in=cart_ids)
+
+        totals = {
+            row['cart_id']: (row['count'], row['subtotal'])
+            for row in items.values('cart_id').annotate(
+                count=Sum('quantity'),
+                subtotal=Sum(F('quantity') * F('product__price')),
+            )
+        }
+
+        drifted = []
+        for cart in carts.only('id', 'item_count', 'subtotal').iterator(chunk_size=batch_size):
+            count, subtotal = totals.get(cart.pk, (0, Decimal('0.00')))
+            if cart.item_count != count or cart.subtotal != subtotal:
+                cart.item_count = count
+                cart.subtotal = subtotal
+                drifted.append(cart)
+
+        if dry_run:
+            return drifted
+
+        with transaction.atomic():
+            self.bulk_update(drifted, ['item_count', 'subtotal'], batch_size=batch_size)
+        cache.delete_many([CART_COUNTERS_CACHE_KEY.format(cart.pk) for cart in drifted])
+        return drifted
+
+
 class Cart(models.Model):
     """
     Shopping cart for users
+    item_count/subtotal are denormalized counters maintained by CartItem
+    save/delete, Cart.clear and product deletes (see CartManager.rebuild_counters)
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='cart')
+    item_count = models.IntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CartManager()
+
     class Meta:
         db_table = 'cart'
         verbose_name = 'Shopping Cart'
@@ -387,11 +662,11 @@ class Cart(models.Model):
     
     def get_total_items(self):
         """Get total number of items in cart"""
-        return sum(item.quantity for item in self.items.all())
+        return self.item_count
     
     def get_subtotal(self):
         """Get cart subtotal"""
-        return sum(item.get_total_price() for item in self.items.all())
+        return self.subtotal
     
     def get_total(self):
         """Get cart total (same as subtotal, discount handled at checkout)"""
@@ -399,7 +674,14 @@ class Cart(models.Model):
     
     def clear(self):
         """Remove all items from cart"""
-        self.items.all().delete()
+        with transaction.atomic():
+            # Hold the cart row so a concurrent add either finishes first (and is cleared)
+            # or shifts the counters after the reset (and is counted)
+            list(Cart.objects.select_for_update().filter(pk=self.pk).values_list('pk'))
+            self.items.all().delete()
+            Cart.objects.filter(pk=self.pk).update(item_count=0, subtotal=0)
+            self.item_count, self.subtotal = 0, Decimal('0.00')
+            Cart.objects._cache_on_commit(self.pk, (0, self.subtotal))
     
     def is_empty(self):
         """Check if cart is empty"""
@@ -427,6 +709,43 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.quantity}x {self.product.name}"
     
+    def _locked_quantity(self):
+        """
+        The stored quantity, read under the row lock (0 if not stored yet)
+        The delta has to come from here, not from when this instance was
+        loaded: two requests changing the same line would both apply it.
+        """
+        if self._state.adding or self.pk is None:
+            return 0
+        stored = CartItem.objects.select_for_update().filter(pk=self.pk).values_list('quantity', flat=True)
+        return stored.first() or 0
+    
+    def save(self, *args, **kwargs):
+        """Save and shift the cart counters in the same transaction"""
+        with transaction.atomic():
+            stored = self._locked_quantity()
+            super().save(*args, **kwargs)
+            delta = self.quantity - stored
+            if delta:
+                self._shift_cart_counters(delta)
+    
+    def delete(self, *args, **kwargs):
+        """Delete and remove this line from the cart counters"""
+        with transaction.atomic():
+            stored = self._locked_quantity()
+            result = super().delete(*args, **kwargs)
+            if stored:
+                self._shift_cart_counters(-stored)
+            return result
+    
+    def _shift_cart_counters(self, quantity_delta):
+        counters = Cart.objects.apply_delta(
+            self.cart_id, quantity_delta, quantity_delta * self.product.price
+        )
+        # Keep an already-loaded cart instance in step with the DB
+        if CartItem.cart.is_cached(self):
+            self.cart.item_count, self.cart.subtotal = counters
+    
     def get_unit_price(self):
         """Get unit price"""
         return self.product.price
@@ -444,9 +763,40 @@ class CartItem(models.Model):
             raise ValidationError(f"Only {self.product.stock} items available in stock")
 
 
+@receiver(pre_delete, sender=Product)
+def _remove_deleted_product_from_carts(sender, instance, **kwargs):
+    """Deleting a product cascades to its cart lines without CartItem.delete; uncount them here"""
+    lines = CartItem.objects.select_for_update().filter(product_id=instance.pk).values_list('cart_id', 'quantity')
+    for cart_id, quantity in lines:
+        Cart.objects.apply_delta(cart_id, -quantity, -quantity * instance.price)
+
+
 # -----------------------
 # Order
 # -----------------------
+class OrderQuerySet(models.QuerySet):
+    def for_history(self, user):
+        """The user's orders shown in their history (cancelled ones hidden)"""
+        return self.filter(address__user=user).exclude(status='X')
+
+    def with_summary(self):
+        """
+        Annotate total_items and payment_total (latest payment) as correlated
+        subqueries, so a page of orders is one query with no GROUP BY
+        """
+        items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        latest_payment = Payment.objects.filter(order=OuterRef('pk')).order_by('-created_at', '-id')
+        return self.annotate(
+            total_items=Coalesce(
+                Subquery(items.annotate(total=Sum('quantity')).values('total')), Value(0)
+            ),
+            payment_total=Subquery(
+                latest_payment.values('total_amount')[:1],
+                output_field=models.DecimalField(max_digits=10, decimal_places=2),
+            ),
+        )
+
+
 class Order(models.Model):
     """
     Customer orders
@@ -466,6 +816,10 @@ class Order(models.Model):
     loyalty_points_earned = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     loyalty_points_used = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Bumped by save() and when the delivery proof changes (delta feed in firstapp.tracking)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = OrderQuerySet.as_manager()
 
     class Meta:
         db_table = 'order'
@@ -475,11 +829,21 @@ class Order(models.Model):
         indexes = [
             models.Index(fields=['order_number']),
             models.Index(fields=['address', 'status']),
+            models.Index(fields=['address', 'updated_at']),
+            # Driver feed: status filter + newest first
+            models.Index(fields=['status', 'created_at']),
         ]
 
     def __str__(self):
         return f"Order {self.order_number} - {self.address.user.name}"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Previous status, for the analytics rollups (firstapp.rollups)
+        instance._loaded_status = instance.status if 'status' in field_names else None
+        return instance
+    
     def generate_order_number(self):
         """Generate unique order number"""
         from datetime import datetime
@@ -491,27 +855,18 @@ class Order(models.Model):
     def save(self, *args, **kwargs):
         if not self.order_number:
             self.order_number = self.generate_order_number()
-        
-        # If this is a new order with loyalty points used, deduct them
-        if not self.pk and hasattr(self, '_loyalty_points_to_use') and self._loyalty_points_to_use > 0:
-            if self.address.user.is_member():
-                try:
-                    member = self.address.user.member_profile
-                    discount_amount = member.redeem_points(self._loyalty_points_to_use)
-                    self.loyalty_points_used = self._loyalty_points_to_use
-                    # discount_amount will be used in payment
-                except Exception as e:
-                    # Handle error - maybe set points_used to 0
-                    self.loyalty_points_used = 0
-                    print(f"Error redeeming points: {e}")
+        # Points are redeemed by checkout.place_order (one ledger entry per order)
         super().save(*args, **kwargs)
     
     def get_total_items(self):
         """Get total number of items in order"""
+        # Annotated by Order.objects.with_summary()
+        if hasattr(self, 'total_items'):
+            return self.total_items
         return sum(item.quantity for item in self.items.all())
     
-    def send_confirmation_email(self):
-        """Send order confirmation email"""
+    def build_confirmation_email(self):
+        """Build (but don't send) the order confirmation email"""
         payment = self.payments.first()
         subject = f'Order Confirmation #{self.order_number} - WinnieCho'
         html_message = render_to_string('emails/order_confirmation.html', {
@@ -520,8 +875,18 @@ class Order(models.Model):
             'items': self.items.all()
         })
         plain_message = strip_tags(html_message)
-        send_mail(subject, plain_message, settings.DEFAULT_FROM_EMAIL, 
-                 [self.address.user.email], html_message=html_message)
+        message = EmailMultiAlternatives(subject, plain_message, settings.DEFAULT_FROM_EMAIL,
+                                         [self.address.user.email])
+        message.attach_alternative(html_message, 'text/html')
+        return message
+    
+    def send_confirmation_email(self):
+        """Send order confirmation email"""
+        self.build_confirmation_email().send()
+    
+    def queue_confirmation_email(self):
+        """Queue the confirmation email in the notification outbox"""
+        NotificationOutbox.enqueue(self, 'order_confirmation')
 
 
 # -----------------------
@@ -557,7 +922,7 @@ class OrderItem(models.Model):
 # -----------------------
 # Delivery Proof
 # -----------------------
-class DeliveryProof(models.Model):
+class DeliveryProof(ResponsiveImageMixin, models.Model):
     """Delivery proof image uploaded by driver"""
     order = models.OneToOneField(
         Order, 
@@ -573,6 +938,7 @@ class DeliveryProof(models.Model):
         limit_choices_to={'role': 'D'}
     )
     image = models.ImageField(upload_to='delivery_proofs/')
+    variants = models.JSONField(default=dict, blank=True, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     notes = models.TextField(blank=True, default='')
 
@@ -586,6 +952,42 @@ class DeliveryProof(models.Model):
         return f"Proof for Order #{self.order.order_number}"
 
 
+# -----------------------
+# Proof Upload (resumable, chunked)
+# -----------------------
+class ProofUpload(models.Model):
+    """
+    In-progress chunked delivery-proof upload (see firstapp.uploads)
+    Chunks are appended to a partial file in media storage; received_size
+    is the resume offset for the client.
+    """
+    status_choices = [
+        ('U', 'Uploading'),
+        ('C', 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='proof_uploads')
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='proof_uploads')
+    filename = models.CharField(max_length=255)
+    total_size = models.PositiveBigIntegerField()
+    received_size = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=1, choices=status_choices, default='U')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'proof_upload'
+        verbose_name = 'Proof Upload'
+        verbose_name_plural = 'Proof Uploads'
+
+    def __str__(self):
+        return f"Upload {self.id} for Order #{self.order.order_number}"
+
+    def is_complete(self):
+        return self.status == 'C'
+
+
 # -----------------------
 # Payment
 # -----------------------
@@ -624,35 +1026,230 @@ class Payment(models.Model):
     def __str__(self):
         return f"Payment for Order {self.order.order_number} - RM{self.total_amount}"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Previous status, for the analytics rollups (firstapp.rollups)
+        instance._loaded_status = instance.status if 'status' in field_names else None
+        return instance
+    
     def mark_as_paid(self):
-        """Mark payment as successful"""
-        self.status = 'S'
-        self.save()
+        """
+        Mark payment as successful
+        Status, points and the confirmation email commit together (the loyalty
+        recompute reads both): if the loyalty update fails, nothing is saved
+        and the error reaches the caller, whose retry is safe (points are
+        earned once per order).
+        """
+        with transaction.atomic():
+            self.status = 'S'
+            self.save()
         
-        if self.order.address.user.is_member():
-            try:
+            if self.order.address.user.is_member():
                 member = self.order.address.user.member_profile
                 
-                # 1. Deduct points that were used (if any)
-                if self.order.loyalty_points_used > 0:
-                    # Points should already be deducted when order was created,
-                    current_points = member.loyalty_points
-                    # Points are deducted in the Order.save() method above
-                
-                # 2. Add points earned from this purchase (after discount)
-                # Earn points based on actual amount paid (total_amount)
-                points_earned = member.add_loyalty_points(self.total_amount)
+                # Points used were already redeemed at checkout (checkout.place_order).
+                # Earn points based on actual amount paid (total_amount), once per order
+                points_earned = member.add_loyalty_points(self.total_amount, order=self.order)
                 self.order.loyalty_points_earned = points_earned
                 self.order.save()
-                
-                print(f"✅ Member loyalty updated: Used {self.order.loyalty_points_used} points, Earned {points_earned} points")
-                print(f"✅ Current points: {current_points}")
-                
-            except Exception as e:
-                print(f"Error updating loyalty: {e}")
+                logger.info(
+                    "Order %s paid: used %s points, earned %s, balance %s",
+                    self.order.order_number, self.order.loyalty_points_used, points_earned, member.loyalty_points,
+                )
+
+                # Queue confirmation email (sent by the notification worker)
+                self.order.queue_confirmation_email()
+
+
+# -----------------------
+# Notification Outbox
+# -----------------------
+class NotificationOutbox(models.Model):
+    """
+    Transactional outbox for order notifications
+    Rows are written alongside the order change and delivered later by
+    `manage.py send_notifications`, so requests never wait on SMTP.
+    """
+    event_choices = [
+        ('admin_new_order', 'Admin: New Order'),
+        ('order_confirmation', 'Customer: Order Confirmation'),
+        ('order_status', 'Customer: Status Update'),
+    ]
+
+    status_choices = [
+        ('P', 'Pending'),
+        ('S', 'Sent'),
+        ('F', 'Failed'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='notifications')
+    event = models.CharField(max_length=30, choices=event_choices)
+    dedupe_key = models.CharField(max_length=100, unique=True)
+    payload = models.JSONField(blank=True, default=dict)
+    status = models.CharField(max_length=1, choices=status_choices, default='P')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'notification_outbox'
+        verbose_name = 'Notification'
+        verbose_name_plural = 'Notification Outbox'
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_event_display()} for Order #{self.order.order_number}"
+
+    @classmethod
+    def enqueue(cls, order, event, dedupe_suffix='', **payload):
+        """
+        Queue a notification once per (order, event[, suffix])
+        Re-queuing the same event is a no-op, so retried requests don't double-send.
+        """
+        dedupe_key = f"{event}:{order.pk}"
+        if dedupe_suffix:
+            dedupe_key = f"{dedupe_key}:{dedupe_suffix}"
+        notification, _ = cls.objects.get_or_create(
+            dedupe_key=dedupe_key,
+            defaults={'order': order, 'event': event, 'payload': payload}
+        )
+        return notification
+
+
+# -----------------------
+# Stripe Webhook Events (inbox, processed by firstapp.webhooks)
+# -----------------------
+class StripeEvent(models.Model):
+    """
+    Raw Stripe webhook event, stored before any processing
+    event_id is unique, so Stripe's retries of an event are dropped at insert.
+    """
+    status_choices = [
+        ('P', 'Pending'),
+        ('D', 'Processed'),
+        ('I', 'Ignored'),
+        ('F', 'Failed'),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=1, choices=status_choices, default='P')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'stripe_event'
+        verbose_name = 'Stripe Event'
+        verbose_name_plural = 'Stripe Events'
+        ordering = ['received_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id})"
+
+
+# -----------------------
+# Encryption Key (envelope encryption)
+# -----------------------
+class EncryptionKey(models.Model):
+    """
+    KMS-wrapped data keys used by firstapp.encryption
+    Ciphertexts only carry the key_id; the plaintext key never touches the DB.
+    """
+    key_id = models.CharField(max_length=32, unique=True)
+    kms_key_id = models.CharField(max_length=255)
+    wrapped_key = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'encryption_key'
+        verbose_name = 'Encryption Key'
+        verbose_name_plural = 'Encryption Keys'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Data key {self.key_id}"
+
 
-            # Send confirmation email
-            self.order.send_confirmation_email()
+# -----------------------
+# Analytics Rollups (maintained by firstapp.rollups)
+# -----------------------
+class DailySales(models.Model):
+    """Per-day totals: successful payments, placed orders, new customers"""
+    date = models.DateField(unique=True)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    paid_orders = models.IntegerField(default=0)
+    orders_placed = models.IntegerField(default=0)  # orders not cancelled/hidden
+    new_customers = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'daily_sales'
+        verbose_name = 'Daily Sales'
+        verbose_name_plural = 'Daily Sales'
+        ordering = ['date']
+
+    def __str__(self):
+        return f"Sales {self.date}: RM{self.revenue}"
+
+
+class DailyOrderStatus(models.Model):
+    """Orders created on `date`, counted by their current status"""
+    date = models.DateField()
+    status = models.CharField(max_length=1, choices=Order.status_choices)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'daily_order_status'
+        unique_together = [['date', 'status']]
+
+    def __str__(self):
+        return f"{self.date} {self.get_status_display()}: {self.count}"
+
+
+class DailyProductSales(models.Model):
+    """Units and revenue per product for confirmed/shipped/delivered orders created on `date`"""
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    category = models.ForeignKey(ProductCategory, on_delete=models.CASCADE, related_name='daily_sales')
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        db_table = 'daily_product_sales'
+        unique_together = [['date', 'product']]
+        indexes = [
+            models.Index(fields=['date', 'category']),
+        ]
+
+    def __str__(self):
+        return f"{self.date} product {self.product_id}: {self.quantity}"
+
+
+class DailyCustomerSales(models.Model):
+    """Successful payments per customer per day"""
+    date = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_sales')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payments = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'daily_customer_sales'
+        unique_together = [['date', 'user']]
+
+    def __str__(self):
+        return f"{self.date} customer {self.user_id}: RM{self.revenue}"
 
 
 # -----------------------
@@ -0,0 +1,268 @@
+"""
+Order notifications
+
+Views only queue rows in NotificationOutbox (see queue_* helpers); the
+`send_notifications` management command drains the outbox in batches over
+one reused SMTP connection, retrying failures with exponential backoff.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .aws_clients import get_sns_client
+from .models import NotificationOutbox, Order
+
+
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 30
+CLAIM_SECONDS = 300  # how long a worker owns a claimed batch
+
+
+# =====================
+# QUEUEING (called from views/models)
+# =====================
+
+def queue_admin_notification(order):
+    """Queue the new-order email/SMS to the admin"""
+    return NotificationOutbox.enqueue(order, 'admin_new_order')
+
+
+def queue_order_status_email(order, old_status):
+    """
+    Queue the status-change email (once per transition)
+    Keys carry a per-order transition number, so P -> C -> P -> C sends three
+    emails, while re-queuing the transition just queued is a no-op.
+    """
+    transition = f'{old_status}>{order.status}'
+    queued = order.notifications.filter(event='order_status')
+    previous = queued.order_by('-pk').first()
+    if previous is not None and previous.dedupe_key.endswith(f':{transition}'):
+        return previous
+    return NotificationOutbox.enqueue(
+        order, 'order_status', dedupe_suffix=f'{queued.count() + 1}:{transition}', old_status=old_status
+    )
+
+
+# =====================
+# MESSAGE BUILDERS
+# =====================
+
+def build_admin_notification(order):
+    """Email to admin when order placed"""
+    subject = f'🛒 New Order - #{order.order_number}'
+    payment = order.payments.first()
+
+    message = f"""
+═══════════════════════════════════════
+NEW ORDER RECEIVED
+═══════════════════════════════════════
+
+Order Number: {order.order_number}
+Order Date: {order.created_at.strftime('%Y-%m-%d %H:%M:%S')}
+
+CUSTOMER INFORMATION:
+• Name: {order.address.user.name}
+• Email: {order.address.user.email}
+• Phone: {order.address.user.phone}
+
+ORDER DETAILS:
+• Items: {order.get_total_items()} item(s)
+• Subtotal: RM {order.subtotal}
+• Discount: RM {payment.discount_amount if payment else 0}
+• Total: RM {payment.total_amount if payment else order.subtotal}
+• Payment: {payment.get_method_display() if payment else 'N/A'}
+
+DELIVERY ADDRESS:
+{order.address.label}
+{order.address.address}
+{order.address.city}, {order.address.state} {order.address.postal_code}
+{order.address.country}
+
+ITEMS ORDERED:
+"""
+
+    for item in order.items.all():
+        message += f"\n  • {item.quantity}x {item.product_name} - RM {item.subtotal}"
+
+    message += f"""
+
+═══════════════════════════════════════
+View in admin panel to process order.
+
+WinnieChO Admin System
+═══════════════════════════════════════
+"""
+
+    return EmailMessage(subject, message, settings.EMAIL_HOST_USER, [settings.ADMIN_EMAIL])
+
+
+def build_order_status_email(order, old_status):
+    """Email to customer when order status changes"""
+    subject = f'Order Status Update - #{order.order_number}'
+
+    status_messages = {
+        'P': 'Your order is pending confirmation.',
+        'C': 'Your order has been confirmed and is being prepared!',
+        'S': 'Your order has been shipped and is on the way!',
+        'D': 'Your order has been delivered. Enjoy your chocolates!',
+        'X': 'Your order has been cancelled.'
+    }
+
+    message = f"""
+Hi {order.address.user.name},
+
+Your order #{order.order_number} status has been updated.
+
+Previous Status: {old_status}
+New Status: {order.get_status_display()}
+
+{status_messages.get(order.status, '')}
+
+Order Details:
+Total: RM {order.subtotal}
+Items: {order.get_total_items()}
+
+Delivery Address:
+{order.address.get_full_address()}
+
+Thank you for shopping with WinnieCho!
+
+Best regards,
+WinnieChO Team
+"""
+
+    return EmailMessage(subject, message, settings.EMAIL_HOST_USER, [order.address.user.email])
+
+
+def build_message(notification):
+    """EmailMessage for an outbox row"""
+    order = notification.order
+    if notification.event == 'admin_new_order':
+        return build_admin_notification(order)
+    if notification.event == 'order_confirmation':
+        return order.build_confirmation_email()
+    if notification.event == 'order_status':
+        return build_order_status_email(order, notification.payload.get('old_status'))
+    raise ValueError(f"Unknown notification event: {notification.event}")
+
+
+def send_admin_sms(order):
+    """Optional SNS SMS to admin for new orders (best effort)"""
+    if not getattr(settings, 'USE_SNS_NOTIFICATIONS', False):
+        return
+    try:
+        payment = order.payments.first()
+        sns = get_sns_client()
+        sms_message = f"WinnieChO: New order #{order.order_number} from {order.address.user.name}. Total: RM {payment.total_amount if payment else order.subtotal}"
+        sns.publish(
+            TopicArn=settings.AWS_SNS_TOPIC_ARN,
+            Subject=f'🛒 New Order - #{order.order_number}',
+            Message=sms_message
+        )
+        print(f"✅ Admin SMS sent for order {order.order_number}")
+    except Exception as e:
+        print(f"⚠️  SNS failed: {str(e)}")
+
+
+# =====================
+# WORKER
+# =====================
+
+def claim_batch(batch_size):
+    """
+    Lock due pending rows (skipping rows other workers hold) and lease them
+    for CLAIM_SECONDS so a crashed worker's batch is retried later.
+    """
+    now = timezone.now()
+    lease = now + timedelta(seconds=CLAIM_SECONDS)
+    with transaction.atomic():
+        batch = list(
+            NotificationOutbox.objects.select_for_update(skip_locked=True).filter(
+                status='P', next_attempt_at__lte=now
+            ).order_by('next_attempt_at')[:batch_size]
+        )
+        NotificationOutbox.objects.filter(pk__in=[n.pk for n in batch]).update(next_attempt_at=lease)
+    for notification in batch:
+        notification.next_attempt_at = lease
+    return batch
+
+
+def renew_lease(notification):
+    """
+    Extend our claim on a row before sending it
+    The lease expiry doubles as the claim token: if it changed, the lease ran
+    out mid-batch and another worker re-claimed the row, so we must not send.
+    """
+    lease = timezone.now() + timedelta(seconds=CLAIM_SECONDS)
+    renewed = NotificationOutbox.objects.filter(
+        pk=notification.pk, status='P', next_attempt_at=notification.next_attempt_at
+    ).update(next_attempt_at=lease)
+    if renewed:
+        notification.next_attempt_at = lease
+    return bool(renewed)
+
+
+def _mark_failed(notification, error):
+    notification.attempts += 1
+    notification.last_error = str(error)[:2000]
+    if notification.attempts >= MAX_ATTEMPTS:
+        notification.status = 'F'
+    else:
+        delay = RETRY_BASE_SECONDS * (2 ** (notification.attempts - 1))
+        notification.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    notification.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+
+
+def process_batch(batch_size=50):
+    """Send one batch of due notifications; returns (sent, failed)"""
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0, 0
+
+    # One query for all orders (plus their customer/address) in the batch
+    orders = Order.objects.select_related('address__user').in_bulk(
+        [notification.order_id for notification in batch]
+    )
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for notification in batch:
+            _mark_failed(notification, e)
+        return 0, len(batch)
+
+    sent = failed = 0
+    try:
+        for notification in batch:
+            if not renew_lease(notification):
+                continue  # Another worker owns it now
+            notification.order = orders[notification.order_id]
+            try:
+                connection.send_messages([build_message(notification)])
+            except Exception as e:
+                failed += 1
+                _mark_failed(notification, e)
+                # Drop a possibly broken SMTP session before the next message
+                connection.close()
+                try:
+                    connection.open()
+                except Exception:
+                    pass  # send_messages() reconnects on its own
+                continue
+
+            notification.status = 'S'
+            notification.attempts += 1
+            notification.sent_at = timezone.now()
+            notification.save(update_fields=['status', 'attempts', 'sent_at'])
+            sent += 1
+
+            if notification.event == 'admin_new_order':
+                send_admin_sms(notification.order)
+    finally:
+        connection.close()
+
+    return sent, failed
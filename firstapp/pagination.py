@@ -0,0 +1,108 @@
+"""
+Keyset (cursor) pagination for JSON APIs
+
+Instead of OFFSET/LIMIT (which scans every skipped row) each page starts
+right after the last row of the previous page, using the sort columns of
+that row as an opaque cursor. The last ordering field must be unique
+(normally 'id' / '-id') so ties are broken deterministically.
+"""
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor we did not issue"""
+
+
+def _json_default(value):
+    # Keep full precision: DjangoJSONEncoder truncates microseconds,
+    # which would make created_at cursors skip or repeat rows
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Cannot encode {type(value).__name__} in cursor")
+
+
+def encode_cursor(values):
+    """Encode a list of sort values into a URL-safe cursor string"""
+    raw = json.dumps(values, default=_json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor string back into its list of sort values"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, TypeError):
+        raise InvalidCursor("Malformed cursor")
+    if not isinstance(values, list):
+        raise InvalidCursor("Malformed cursor")
+    return values
+
+
+def get_page_size(request, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Read ?limit= from the request, clamped to [1, maximum]"""
+    try:
+        limit = int(request.GET.get('limit', default))
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def _keyset_filter(ordering, values):
+    """
+    Build the "row comes after cursor" condition for a multi-column ordering:
+    (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+    """
+    condition = Q()
+    equal_so_far = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= equal_so_far & Q(**{f'{name}__{lookup}': value})
+        equal_so_far &= Q(**{name: value})
+    return condition
+
+
+def keyset_paginate(queryset, ordering, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return (rows, next_cursor) for one page of `queryset`.
+
+    `ordering` is a list of model attribute names (optionally prefixed with
+    '-') whose last entry is unique. Runs a single query for the page
+    (plus whatever prefetches are attached to the queryset); no COUNT.
+    """
+    queryset = queryset.order_by(*ordering)
+
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(ordering):
+            raise InvalidCursor("Cursor does not match ordering")
+        try:
+            queryset = queryset.filter(_keyset_filter(ordering, values))
+        except (ValidationError, ValueError, TypeError):
+            # Cursors aren't signed: a value of the wrong type for its column
+            # (e.g. "abc" for a price) is a tampered cursor, not a server error
+            raise InvalidCursor("Cursor values do not match ordering")
+
+    # Fetch one extra row to know whether another page exists
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([
+            getattr(last, field.lstrip('-')) for field in ordering
+        ])
+    return rows, next_cursor
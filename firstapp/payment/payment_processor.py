@@ -1,19 +1,99 @@
-from .stripe_payment import create_payment_intent, create_checkout_session
-from .paypal import create_payment as create_paypal_payment, execute_payment
+"""
+Single entry point for the payment providers
+
+Views talk to Stripe and PayPal only through PaymentProcessor. Every call
+has a sync and an `_async` variant; the async ones let ASGI views await the
+provider round trip instead of holding a worker thread for it. Pooling,
+timeouts and circuit breakers live in the provider modules (see
+transport.py).
+"""
+from . import paypal, stripe_payment
+
+
+def _stripe_line_items(amount, order_number):
+    return [{
+        'price_data': {
+            'currency': 'myr',
+            'product_data': {
+                'name': f'Order #{order_number} - WinnieCho',
+                'description': 'Chocolate Shop Purchase',
+            },
+            'unit_amount': int(amount * 100),  # cents
+        },
+        'quantity': 1,
+    }]
+
+
+def _paypal_request_id(local_payment_id, operation):
+    return paypal.request_id(local_payment_id, operation) if local_payment_id else None
+
 
 class PaymentProcessor:
     """Unified payment processor for all payment methods"""
-    
+
+    # ----- Stripe -----
+
     @staticmethod
     def process_stripe_payment(amount, metadata=None):
         """Process Stripe payment"""
-        return create_payment_intent(amount, metadata=metadata)
-    
+        return stripe_payment.create_payment_intent(amount, metadata=metadata)
+
+    @staticmethod
+    def create_stripe_checkout(amount, order_number, success_url, cancel_url, metadata=None, customer_email=None):
+        """Stripe Checkout Session for one order; returns the stripe Session"""
+        return stripe_payment.open_checkout_session(
+            _stripe_line_items(amount, order_number), success_url, cancel_url, metadata, customer_email
+        )
+
+    @staticmethod
+    async def create_stripe_checkout_async(amount, order_number, success_url, cancel_url, metadata=None, customer_email=None):
+        return await stripe_payment.open_checkout_session_async(
+            _stripe_line_items(amount, order_number), success_url, cancel_url, metadata, customer_email
+        )
+
+    @staticmethod
+    def get_stripe_checkout(session_id):
+        return stripe_payment.retrieve_checkout_session(session_id)
+
     @staticmethod
-    def process_paypal_payment(amount, return_url, cancel_url):
-        """Process PayPal payment"""
-        return create_paypal_payment(amount, return_url, cancel_url)
-    
+    async def get_stripe_checkout_async(session_id):
+        return await stripe_payment.retrieve_checkout_session_async(session_id)
+
+    @staticmethod
+    def expire_stripe_checkout(session_id):
+        return stripe_payment.expire_checkout_session(session_id)
+
+    # ----- PayPal -----
+
+    @staticmethod
+    def process_paypal_payment(amount, return_url, cancel_url, description="Chocolate Order", invoice_number=None,
+                               local_payment_id=None):
+        """Process PayPal payment (local_payment_id makes a repeated create idempotent)"""
+        return paypal.create_payment(amount, return_url, cancel_url, description, invoice_number,
+                                     _paypal_request_id(local_payment_id, 'create'))
+
+    @staticmethod
+    async def process_paypal_payment_async(amount, return_url, cancel_url, description="Chocolate Order",
+                                           invoice_number=None, local_payment_id=None):
+        return await paypal.create_payment_async(amount, return_url, cancel_url, description, invoice_number,
+                                                 _paypal_request_id(local_payment_id, 'create'))
+
+    @staticmethod
+    def complete_paypal_payment(payment_id, payer_id, local_payment_id=None):
+        """Complete PayPal payment after approval (local_payment_id makes a repeated execute idempotent)"""
+        return paypal.execute_payment(payment_id, payer_id, _paypal_request_id(local_payment_id, 'execute'))
+
+    @staticmethod
+    async def complete_paypal_payment_async(payment_id, payer_id, local_payment_id=None):
+        return await paypal.execute_payment_async(payment_id, payer_id, _paypal_request_id(local_payment_id, 'execute'))
+
+    @staticmethod
+    def get_paypal_payment(payment_id):
+        """PayPal payment resource, or None if it doesn't exist"""
+        return paypal.find_payment(payment_id)
+
+    # ----- Cash on Delivery -----
+
     @staticmethod
     def process_cod_payment(order_id):
         """Process Cash on Delivery"""
@@ -23,8 +103,3 @@ class PaymentProcessor:
             'order_id': order_id,
             'message': 'Order placed. Pay on delivery.'
         }
-    
-    @staticmethod
-    def complete_paypal_payment(payment_id, payer_id):
-        """Complete PayPal payment after approval"""
-        return execute_payment(payment_id, payer_id)
\ No newline at end of file
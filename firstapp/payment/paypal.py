@@ -1,16 +1,188 @@
-import paypalrestsdk
+"""
+PayPal client (REST v1 payments, the API paypalrestsdk wrapped)
+
+paypalrestsdk opens a new connection for every call, has no timeouts and is
+configured globally at import, so the few endpoints the shop needs are
+called directly instead:
+- sync: a keep-alive requests session per thread
+- async: a pooled httpx client per event loop
+- explicit (connect, read) timeouts, the PAYPAL circuit breaker, and the
+  OAuth token cached until shortly before it expires
+- POSTs carry a PayPal-Request-Id derived from the local Payment
+  (request_id()), so PayPal answers a repeated create / execute of the same
+  payment with the first result instead of doing it twice
+
+PAYPAL_API_BASE overrides the sandbox/live host (PAYPAL_MODE), e.g. to use
+`manage.py fake_payment_provider`.
+"""
+import threading
+import time
+from urllib.parse import quote
+
+import requests
 from django.conf import settings
 
-# Configure PayPal SDK
-paypalrestsdk.configure({
-    "mode": settings.PAYPAL_MODE,  # sandbox or live
-    "client_id": settings.PAYPAL_CLIENT_ID,
-    "client_secret": settings.PAYPAL_SECRET
-})
+from .transport import CircuitBreaker, LoopLocal, PaymentError, PaymentUnavailable, get_timeout
 
-def create_payment(amount, return_url, cancel_url, description="Chocolate Order"):
-    """Create PayPal payment"""
-    payment = paypalrestsdk.Payment({
+
+API_BASES = {
+    'sandbox': 'https://api.sandbox.paypal.com',
+    'live': 'https://api.paypal.com',
+}
+TOKEN_MARGIN = 60  # renew the OAuth token this many seconds before it expires
+
+BREAKER = CircuitBreaker('PayPal')
+
+
+def api_base():
+    return getattr(settings, 'PAYPAL_API_BASE', '') or API_BASES.get(settings.PAYPAL_MODE, API_BASES['sandbox'])
+
+
+# =====================
+# HTTP
+# =====================
+
+_sessions = threading.local()
+
+
+def _session():
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    return session
+
+
+def _build_async_client():
+    import httpx
+    connect, read = get_timeout()
+    return httpx.AsyncClient(timeout=httpx.Timeout(read, connect=connect))
+
+
+_async_clients = LoopLocal(_build_async_client, close=lambda client: client.aclose())
+
+_token = {'value': None, 'expires_at': 0}
+_token_lock = threading.Lock()
+
+
+def _cached_token():
+    with _token_lock:
+        if _token['value'] and time.monotonic() < _token['expires_at']:
+            return _token['value']
+    return None
+
+
+def _store_token(data):
+    with _token_lock:
+        _token['value'] = data['access_token']
+        _token['expires_at'] = time.monotonic() + int(data.get('expires_in', 0)) - TOKEN_MARGIN
+        return _token['value']
+
+
+def _forget_token():
+    with _token_lock:
+        _token['value'] = None
+
+
+def _check(status_code, body):
+    """Raise PaymentUnavailable for 5xx / 429; returns True for 2xx"""
+    if status_code >= 500 or status_code == 429:
+        raise PaymentUnavailable(f"PayPal answered {status_code}")
+    return status_code < 400
+
+
+def _json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+def _token_request():
+    return {
+        'url': f'{api_base()}/v1/oauth2/token',
+        'auth': (settings.PAYPAL_CLIENT_ID or '', settings.PAYPAL_CLIENT_SECRET or ''),
+        'data': {'grant_type': 'client_credentials'},
+        'headers': {'Accept': 'application/json'},
+    }
+
+
+def request_id(payment_pk, operation):
+    """PayPal-Request-Id for one operation ('create', 'execute') on a local Payment"""
+    return f'payment-{payment_pk}-{operation}'
+
+
+def _headers(token, request_id=None):
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+    }
+    if request_id:
+        headers['PayPal-Request-Id'] = request_id
+    return headers
+
+
+def _request(method, path, body=None, request_id=None):
+    """(ok, json body) for one API call; refreshes the token once on 401"""
+    session = _session()
+    for attempt in range(2):
+        try:
+            token = _cached_token()
+            if token is None:
+                response = session.post(timeout=get_timeout(), **_token_request())
+                data = _json(response)
+                if not _check(response.status_code, data):
+                    raise PaymentError(f"PayPal authentication failed: {data.get('error_description', response.status_code)}")
+                token = _store_token(data)
+            response = session.request(
+                method, api_base() + path, json=body, headers=_headers(token, request_id), timeout=get_timeout()
+            )
+        except requests.RequestException as e:
+            raise PaymentUnavailable(f"PayPal: {e}")
+        if response.status_code == 401 and attempt == 0:
+            _forget_token()
+            continue
+        data = _json(response)
+        return _check(response.status_code, data), data
+
+
+async def _request_async(method, path, body=None, request_id=None):
+    import httpx
+    client = _async_clients.get()
+    for attempt in range(2):
+        try:
+            token = _cached_token()
+            if token is None:
+                response = await client.post(**_token_request())
+                data = _json(response)
+                if not _check(response.status_code, data):
+                    raise PaymentError(f"PayPal authentication failed: {data.get('error_description', response.status_code)}")
+                token = _store_token(data)
+            response = await client.request(method, api_base() + path, json=body, headers=_headers(token, request_id))
+        except httpx.HTTPError as e:
+            raise PaymentUnavailable(f"PayPal: {e}")
+        if response.status_code == 401 and attempt == 0:
+            _forget_token()
+            continue
+        data = _json(response)
+        return _check(response.status_code, data), data
+
+
+# =====================
+# PAYMENTS
+# =====================
+
+def _payment_body(amount, return_url, cancel_url, description, invoice_number=None):
+    transaction = {
+        "amount": {
+            "total": f"{amount:.2f}",
+            "currency": "MYR"
+        },
+        "description": description
+    }
+    if invoice_number:
+        transaction["invoice_number"] = invoice_number
+    return {
         "intent": "sale",
         "payer": {
             "payment_method": "paypal"
@@ -19,57 +191,89 @@ def create_payment(amount, return_url, cancel_url, description="Chocolate Order"
             "return_url": return_url,
             "cancel_url": cancel_url
         },
-        "transactions": [{
-            "amount": {
-                "total": str(amount),
-                "currency": "MYR"
-            },
-            "description": description
-        }]
-    })
-
-    if payment.create():
+        "transactions": [transaction]
+    }
+
+
+def _created(ok, data):
+    if ok:
         # Get approval URL
-        for link in payment.links:
-            if link.rel == "approval_url":
+        for link in data.get('links', []):
+            if link.get('rel') == "approval_url":
                 return {
                     'success': True,
-                    'payment_id': payment.id,
-                    'approval_url': link.href
+                    'payment_id': data['id'],
+                    'approval_url': link['href']
                 }
-    else:
-        return {
-            'success': False,
-            'error': payment.error
-        }
+    return {
+        'success': False,
+        'error': data if not ok else 'No approval URL returned'
+    }
 
-def execute_payment(payment_id, payer_id):
-    """Execute approved PayPal payment"""
-    payment = paypalrestsdk.Payment.find(payment_id)
-    
-    if payment.execute({"payer_id": payer_id}):
+
+def _executed(ok, data):
+    if ok:
         return {
             'success': True,
-            'payment_id': payment.id,
-            'state': payment.state,
-            'transactions': payment.transactions
-        }
-    else:
-        return {
-            'success': False,
-            'error': payment.error
+            'payment_id': data.get('id'),
+            'state': data.get('state'),
+            'transactions': data.get('transactions', [])
         }
+    return {
+        'success': False,
+        'error': data
+    }
+
+
+def create_payment(amount, return_url, cancel_url, description="Chocolate Order", invoice_number=None,
+                   request_id=None):
+    """Create PayPal payment"""
+    body = _payment_body(float(amount), return_url, cancel_url, description, invoice_number)
+    return _created(*BREAKER.call(_request, 'POST', '/v1/payments/payment', body, request_id))
+
+
+async def create_payment_async(amount, return_url, cancel_url, description="Chocolate Order", invoice_number=None,
+                               request_id=None):
+    body = _payment_body(float(amount), return_url, cancel_url, description, invoice_number)
+    return _created(*await BREAKER.call_async(_request_async, 'POST', '/v1/payments/payment', body, request_id))
+
+
+def execute_payment(payment_id, payer_id, request_id=None):
+    """Execute approved PayPal payment"""
+    path = f"/v1/payments/payment/{quote(payment_id, safe='')}/execute"
+    return _executed(*BREAKER.call(_request, 'POST', path, {"payer_id": payer_id}, request_id))
+
+
+async def execute_payment_async(payment_id, payer_id, request_id=None):
+    path = f"/v1/payments/payment/{quote(payment_id, safe='')}/execute"
+    return _executed(*await BREAKER.call_async(_request_async, 'POST', path, {"payer_id": payer_id}, request_id))
+
+
+def find_payment(payment_id):
+    """The payment resource, or None if PayPal doesn't know it"""
+    ok, data = BREAKER.call(_request, 'GET', f"/v1/payments/payment/{quote(payment_id, safe='')}")
+    if ok:
+        return data
+    if data.get('name') == 'INVALID_RESOURCE_ID':
+        return None
+    raise PaymentError(f"PayPal: {data.get('message') or data}")
+
 
 def get_payment_details(payment_id):
     """Get payment details"""
     try:
-        payment = paypalrestsdk.Payment.find(payment_id)
+        payment = find_payment(payment_id)
+    except PaymentError as e:
         return {
-            'success': True,
-            'payment': payment
+            'success': False,
+            'error': str(e)
         }
-    except Exception as e:
+    if payment is None:
         return {
             'success': False,
-            'error': str(e)
-        }
\ No newline at end of file
+            'error': 'Payment not found'
+        }
+    return {
+        'success': True,
+        'payment': payment
+    }
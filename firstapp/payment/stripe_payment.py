@@ -1,7 +1,154 @@
+"""
+Stripe client
+
+Calls go through a StripeClient built on first use (not at import) with
+explicit timeouts: the sync one keeps a keep-alive requests session per
+thread, the async one a pooled httpx client per event loop. Both share the
+STRIPE breaker. STRIPE_API_BASE points them elsewhere, e.g. at
+`manage.py fake_payment_provider`.
+
+Outages surface as PaymentUnavailable; Stripe's own errors (declines,
+invalid requests) are raised unchanged.
+"""
+import threading
+
 import stripe
 from django.conf import settings
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from .transport import CircuitBreaker, LoopLocal, PaymentUnavailable, get_timeout
+
+
+NETWORK_RETRIES = 1  # Stripe adds idempotency keys, so retried POSTs are safe
+
+BREAKER = CircuitBreaker('Stripe')
+
+
+def _client_options():
+    options = {
+        'api_key': settings.STRIPE_SECRET_KEY,
+        'max_network_retries': NETWORK_RETRIES,
+    }
+    api_base = getattr(settings, 'STRIPE_API_BASE', '')
+    if api_base:
+        options['base_addresses'] = {'api': api_base}
+    return options
+
+
+def _build_async_http_client():
+    import httpx
+    connect, read = get_timeout()
+    return stripe.HTTPXClient(timeout=httpx.Timeout(read, connect=connect))
+
+
+def _build_async_client():
+    return stripe.StripeClient(http_client=_async_http_clients.get(), **_client_options())
+
+
+_client = None
+_client_lock = threading.Lock()
+# The HTTPXClient holds the connections (closed with its loop); the StripeClient only wraps it
+_async_http_clients = LoopLocal(_build_async_http_client, close=lambda http_client: http_client.close_async())
+_async_clients = LoopLocal(_build_async_client)
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = stripe.StripeClient(
+                    http_client=stripe.RequestsClient(timeout=get_timeout()),
+                    **_client_options()
+                )
+    return _client
+
+
+def _unavailable(error):
+    """PaymentUnavailable for errors that say Stripe is down, else None"""
+    if isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError)) or (error.http_status or 0) >= 500:
+        return PaymentUnavailable(f"Stripe: {error.user_message or error}")
+    return None
+
+
+def _call(fn, *args, **kwargs):
+    def run():
+        try:
+            return fn(*args, **kwargs)
+        except stripe.StripeError as e:
+            raise (_unavailable(e) or e)
+    return BREAKER.call(run)
+
+
+async def _call_async(fn, *args, **kwargs):
+    async def run():
+        try:
+            return await fn(*args, **kwargs)
+        except stripe.StripeError as e:
+            raise (_unavailable(e) or e)
+    return await BREAKER.call_async(run)
+
+
+# =====================
+# CHECKOUT SESSIONS
+# =====================
+
+def _checkout_params(line_items, success_url, cancel_url, metadata=None, customer_email=None):
+    params = {
+        'payment_method_types': ['card'],
+        'line_items': line_items,
+        'mode': 'payment',
+        'success_url': success_url,
+        'cancel_url': cancel_url,
+        'metadata': metadata or {},
+    }
+    if customer_email:
+        params['customer_email'] = customer_email
+    return params
+
+
+def open_checkout_session(line_items, success_url, cancel_url, metadata=None, customer_email=None):
+    """Create a Checkout Session; returns the stripe Session"""
+    params = _checkout_params(line_items, success_url, cancel_url, metadata, customer_email)
+    return _call(get_client().v1.checkout.sessions.create, params)
+
+
+async def open_checkout_session_async(line_items, success_url, cancel_url, metadata=None, customer_email=None):
+    params = _checkout_params(line_items, success_url, cancel_url, metadata, customer_email)
+    return await _call_async(_async_clients.get().v1.checkout.sessions.create_async, params)
+
+
+def retrieve_checkout_session(session_id):
+    return _call(get_client().v1.checkout.sessions.retrieve, session_id)
+
+
+async def retrieve_checkout_session_async(session_id):
+    return await _call_async(_async_clients.get().v1.checkout.sessions.retrieve_async, session_id)
+
+
+def expire_checkout_session(session_id):
+    """Expire an open Checkout Session so it can no longer be paid"""
+    return _call(get_client().v1.checkout.sessions.expire, session_id)
+
+
+def create_checkout_session(line_items, success_url, cancel_url, metadata=None):
+    """Create a Stripe Checkout Session"""
+    try:
+        session = open_checkout_session(line_items, success_url, cancel_url, metadata)
+        return {
+            'success': True,
+            'session_id': session.id,
+            'url': session.url
+        }
+    except (stripe.StripeError, PaymentUnavailable) as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+# =====================
+# PAYMENT INTENTS
+# =====================
 
 def create_payment_intent(amount, currency='myr', metadata=None):
     """
@@ -9,56 +156,35 @@ def create_payment_intent(amount, currency='myr', metadata=None):
     amount: in cents (e.g., 5000 for RM 50.00)
     """
     try:
-        intent = stripe.PaymentIntent.create(
-            amount=int(amount * 100),  # Convert to cents
-            currency=currency,
-            metadata=metadata or {},
-            automatic_payment_methods={'enabled': True},
-        )
+        intent = _call(get_client().v1.payment_intents.create, {
+            'amount': int(amount * 100),  # Convert to cents
+            'currency': currency,
+            'metadata': metadata or {},
+            'automatic_payment_methods': {'enabled': True},
+        })
         return {
             'success': True,
             'client_secret': intent.client_secret,
             'payment_intent_id': intent.id
         }
-    except stripe.error.StripeError as e:
+    except (stripe.StripeError, PaymentUnavailable) as e:
         return {
             'success': False,
             'error': str(e)
         }
 
+
 def confirm_payment(payment_intent_id):
     """Confirm a payment intent"""
     try:
-        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        intent = _call(get_client().v1.payment_intents.retrieve, payment_intent_id)
         return {
             'success': True,
             'status': intent.status,
             'amount': intent.amount / 100
         }
-    except stripe.error.StripeError as e:
+    except (stripe.StripeError, PaymentUnavailable) as e:
         return {
             'success': False,
             'error': str(e)
         }
-
-def create_checkout_session(line_items, success_url, cancel_url, metadata=None):
-    """Create a Stripe Checkout Session"""
-    try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=line_items,
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata=metadata or {},
-        )
-        return {
-            'success': True,
-            'session_id': session.id,
-            'url': session.url
-        }
-    except stripe.error.StripeError as e:
-        return {
-            'success': False,
-            'error': str(e)
-        }
\ No newline at end of file
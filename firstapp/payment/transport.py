@@ -0,0 +1,162 @@
+"""
+Shared plumbing for the payment provider clients
+
+- explicit (connect, read) timeouts: PAYMENT_CONNECT_TIMEOUT / PAYMENT_READ_TIMEOUT
+- one circuit breaker per provider: after PAYMENT_BREAKER_THRESHOLD failures
+  in a row (timeouts, connection errors, 5xx) calls fail fast with
+  PaymentUnavailable for PAYMENT_BREAKER_COOLDOWN seconds, then a single
+  trial call decides whether the circuit closes again
+- per-event-loop caching for the async HTTP clients (an httpx.AsyncClient
+  cannot be shared between loops), closed when their loop shuts down
+
+Breakers are per process; every worker learns about an outage on its own.
+"""
+import asyncio
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+
+class PaymentError(Exception):
+    """The provider refused or failed the request; message is safe to log"""
+
+
+class PaymentUnavailable(PaymentError):
+    """Provider unreachable, timing out, failing (5xx) or circuit open"""
+
+
+def get_timeout():
+    """(connect, read) seconds for provider calls"""
+    return (
+        getattr(settings, 'PAYMENT_CONNECT_TIMEOUT', 3),
+        getattr(settings, 'PAYMENT_READ_TIMEOUT', 15),
+    )
+
+
+# =====================
+# CIRCUIT BREAKER
+# =====================
+
+class CircuitBreaker:
+    """Closed -> open after `threshold` consecutive failures -> half-open after `cooldown`"""
+
+    def __init__(self, name, threshold=None, cooldown=None):
+        self.name = name
+        self.threshold = threshold or getattr(settings, 'PAYMENT_BREAKER_THRESHOLD', 5)
+        self.cooldown = cooldown or getattr(settings, 'PAYMENT_BREAKER_COOLDOWN', 30)
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False  # a half-open trial call is in flight
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.cooldown and not self._trial:
+                self._trial = True
+                return
+        raise PaymentUnavailable(f"{self.name} is unavailable (circuit open)")
+
+    def _record(self, failed):
+        with self._lock:
+            if not failed:
+                self._failures = 0
+                self._opened_at = None
+                self._trial = False
+                return
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                if self._opened_at is None or self._trial:
+                    print(f"⚠️  {self.name} circuit opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn; PaymentUnavailable counts as a failure, anything else as a success"""
+        self._before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except PaymentUnavailable:
+            self._record(failed=True)
+            raise
+        except BaseException:
+            self._record(failed=False)  # the provider answered (e.g. 4xx)
+            raise
+        self._record(failed=False)
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Async version of call() for coroutine functions"""
+        self._before_call()
+        try:
+            result = await fn(*args, **kwargs)
+        except PaymentUnavailable:
+            self._record(failed=True)
+            raise
+        except asyncio.CancelledError:
+            # Client went away; says nothing about the provider
+            with self._lock:
+                self._trial = False
+            raise
+        except BaseException:
+            self._record(failed=False)
+            raise
+        self._record(failed=False)
+        return result
+
+    def reset(self):
+        self._record(failed=False)
+
+
+# =====================
+# ASYNC CLIENTS
+# =====================
+
+class LoopLocal:
+    """
+    One object per running event loop, built by `factory` on first use.
+    Under the ASGI server there's a single loop per process, so this is one
+    pooled client. Async views run under WSGI get a new loop per request
+    (asgiref runs them with asyncio.run), so the object is dropped when its
+    loop shuts down, after awaiting `close(obj)` (e.g. AsyncClient.aclose).
+    """
+
+    def __init__(self, factory, close=None):
+        self.factory = factory
+        self.close = close
+        self._objects = weakref.WeakKeyDictionary()
+        self._watchers = set()
+        self._lock = threading.Lock()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            obj = self._objects.get(loop)
+            if obj is None:
+                obj = self._objects[loop] = self.factory()
+                watcher = loop.create_task(self._release_at_shutdown(loop, obj))
+                self._watchers.add(watcher)
+                watcher.add_done_callback(self._watchers.discard)
+            return obj
+
+    async def _release_at_shutdown(self, loop, obj):
+        # asyncio.run cancels the tasks still pending when its main coroutine returns
+        try:
+            await loop.create_future()
+        finally:
+            with self._lock:
+                self._objects.pop(loop, None)
+            if self.close is not None:
+                await self.close(obj)
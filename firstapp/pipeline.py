@@ -3,6 +3,7 @@
 
 from django.contrib.auth.models import User as AuthUser
 from .models import User, Member, Cart
+from .middleware import set_session_user
 from django.contrib import messages
 
 def create_user_profile(backend, user, response, *args, **kwargs):
@@ -25,10 +26,7 @@ def create_user_profile(backend, user, response, *args, **kwargs):
             Cart.objects.create(user=custom_user)
         
         if request:
-            request.session['user_id'] = custom_user.id
-            request.session['user_name'] = custom_user.name
-            request.session['user_email'] = custom_user.email
-            request.session['user_role'] = custom_user.role
+            set_session_user(request, custom_user)
             
             # ✅ ADD THIS: Django success message
             messages.success(request, f'Welcome back, {custom_user.name}!')
@@ -0,0 +1,193 @@
+"""
+Reconciliation of pending Stripe / PayPal payments
+
+A payment only leaves 'P' when the customer's browser comes back to
+paypal_success / stripe_success or, for Stripe, when the webhook arrives.
+Customers who close the tab leave pending rows behind. `manage.py
+reconcile_payments` settles them from the provider's side:
+- pending rows older than a few minutes are read in keyset batches
+- each batch is looked up at the providers on a bounded thread pool (the
+  lookups only do HTTP, using the pooled clients in firstapp.payment)
+- failed / cancelled results are written with one UPDATE per status;
+  paid ones go through webhooks.confirm_payment, one locked transaction
+  each, since they award loyalty points and queue the confirmation email
+
+The provider reference is Payment.transaction_id, stored when the checkout
+is created. PayPal payments the customer approved but never returned from
+are executed here, as paypal_success would have done. Checkouts still open
+after `stale_after` (a day) are closed; Stripe sessions are expired first so
+they can no longer be paid.
+"""
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import stripe
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Payment
+from .payment.payment_processor import PaymentProcessor
+from .payment.transport import PaymentError
+from .webhooks import CONFIRMED, confirm_payment
+
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_WORKERS = 8
+DEFAULT_MIN_AGE = timedelta(minutes=15)  # leave checkouts in progress alone
+DEFAULT_STALE_AFTER = timedelta(hours=24)
+
+RECONCILED_METHODS = ('ST', 'PP')
+
+# Outcomes (and the Payment status they lead to)
+PAID = 'paid'                  # -> S
+FAILED = 'failed'              # -> F
+CANCELLED = 'cancelled'        # -> C
+PENDING = 'pending'            # still open at the provider
+MISSING = 'missing'            # provider doesn't know the reference
+UNVERIFIABLE = 'unverifiable'  # no reference stored (created before references were kept)
+ERROR = 'error'                # provider unavailable / unexpected answer; retried next run
+
+OUTCOME_STATUS = {PAID: 'S', FAILED: 'F', CANCELLED: 'C'}
+
+Result = namedtuple('Result', ['payment_id', 'order_id', 'method', 'reference', 'provider_state', 'outcome', 'detail'])
+
+
+# =====================
+# PROVIDER LOOKUPS (no DB access; run on the pool)
+# =====================
+
+def _check_stripe(payment, stale, apply):
+    try:
+        session = PaymentProcessor.get_stripe_checkout(payment.transaction_id)
+    except stripe.InvalidRequestError:
+        return MISSING, '', ''
+    state = f'{session.status}/{session.payment_status}'
+    if session.payment_status in ('paid', 'no_payment_required'):
+        return PAID, state, ''
+    if session.status == 'expired':
+        return CANCELLED, state, ''
+    if session.status == 'open' and stale:
+        if not apply:
+            return CANCELLED, state, 'would expire stale checkout'
+        PaymentProcessor.expire_stripe_checkout(session.id)
+        return CANCELLED, state, 'expired stale checkout'
+    return PENDING, state, ''
+
+
+def _check_paypal(payment, stale, apply):
+    resource = PaymentProcessor.get_paypal_payment(payment.transaction_id)
+    if resource is None:
+        return MISSING, '', ''
+    state = resource.get('state', '')
+    if state == 'approved':
+        return PAID, state, ''
+    if state == 'failed':
+        return FAILED, state, ''
+    if state in ('canceled', 'expired'):
+        return CANCELLED, state, ''
+
+    payer_id = ((resource.get('payer') or {}).get('payer_info') or {}).get('payer_id')
+    if state == 'created' and payer_id:
+        # Approved by the customer, who never came back to paypal_success
+        if not apply:
+            return PAID, state, 'would execute'
+        result = PaymentProcessor.complete_paypal_payment(resource['id'], payer_id, local_payment_id=payment.pk)
+        if result['success']:
+            return PAID, result['state'], 'executed'
+        return FAILED, state, f"execute failed: {result['error']}"[:200]
+    if stale:
+        return CANCELLED, state, 'stale checkout'
+    return PENDING, state, ''
+
+
+CHECKS = {
+    'ST': _check_stripe,
+    'PP': _check_paypal,
+}
+
+
+def check_payment(payment, stale_before, apply=True):
+    """Result for one pending payment; `apply` allows provider side effects (execute / expire)"""
+    def result(outcome, state='', detail=''):
+        return Result(payment.pk, payment.order_id, payment.method, payment.transaction_id or '', state, outcome, detail)
+
+    if not payment.transaction_id:
+        return result(UNVERIFIABLE)
+    stale = payment.created_at < stale_before
+    try:
+        outcome, state, detail = CHECKS[payment.method](payment, stale, apply)
+    except (PaymentError, stripe.StripeError) as e:
+        return result(ERROR, detail=str(e)[:200])
+    return result(outcome, state, detail)
+
+
+# =====================
+# BATCHES
+# =====================
+
+def pending_payments(min_age=DEFAULT_MIN_AGE, methods=RECONCILED_METHODS, now=None):
+    now = now or timezone.now()
+    return Payment.objects.filter(status='P', method__in=methods, created_at__lt=now - min_age)
+
+
+def iter_batches(queryset, batch_size=DEFAULT_BATCH_SIZE):
+    """Keyset pages by id; settled rows drop out of the filter as we go"""
+    last_id = 0
+    while True:
+        batch = list(
+            queryset.filter(pk__gt=last_id).order_by('pk')
+            .only('id', 'order_id', 'method', 'transaction_id', 'created_at', 'status')[:batch_size]
+        )
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].pk
+
+
+def apply_results(results):
+    """Write a batch of results; returns the Results that changed a payment"""
+    applied = []
+    by_status = {}
+    for result in results:
+        if result.outcome == PAID:
+            with transaction.atomic():
+                # Not counted if a redirect or the webhook confirmed it first
+                if confirm_payment(result.payment_id, result.reference) == CONFIRMED:
+                    applied.append(result)
+        elif result.outcome in OUTCOME_STATUS:
+            by_status.setdefault(OUTCOME_STATUS[result.outcome], []).append(result)
+
+    for status, group in by_status.items():
+        ids = [result.payment_id for result in group]
+        # Only rows still pending (a redirect may have won the race). Bulk
+        # UPDATE skips signals, which is fine: the rollups only track Success.
+        still_pending = set(
+            Payment.objects.filter(pk__in=ids, status='P').values_list('pk', flat=True)
+        )
+        Payment.objects.filter(pk__in=still_pending, status='P').update(status=status)
+        applied.extend(result for result in group if result.payment_id in still_pending)
+    return applied
+
+
+def reconcile(batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, min_age=DEFAULT_MIN_AGE,
+              stale_after=DEFAULT_STALE_AFTER, methods=RECONCILED_METHODS, dry_run=False, on_batch=None):
+    """
+    Reconcile every pending payment; returns (Counter of outcomes, list of Results).
+    `on_batch(results, applied)` is called after each batch.
+    """
+    now = timezone.now()
+    stale_before = now - stale_after
+    counts = Counter()
+    report = []
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile') as pool:
+        for batch in iter_batches(pending_payments(min_age, methods, now), batch_size):
+            results = list(pool.map(lambda payment: check_payment(payment, stale_before, not dry_run), batch))
+            applied = [] if dry_run else apply_results(results)
+            counts.update(result.outcome for result in results)
+            counts['updated'] += len(applied)
+            report.extend(results)
+            if on_batch:
+                on_batch(results, applied)
+    return counts, report
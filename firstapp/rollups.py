@@ -0,0 +1,292 @@
+"""
+Daily sales rollups for the analytics dashboard
+
+The dashboard used to aggregate the whole payment/order/order_item history
+of the selected period on every load. Instead, per-day totals are kept in
+DailySales, DailyOrderStatus, DailyProductSales and DailyCustomerSales:
+- incrementally, by the post_save/post_delete receivers below, whenever a
+  payment enters or leaves Success, an order changes status, or a customer
+  registers (each change is a handful of F() UPDATEs in the same transaction).
+  A status change is claimed first with a compare-and-set UPDATE, so two
+  requests saving the same change concurrently count it once
+- in bulk, by rebuild_rollups() / the `backfill_sales_rollups` command,
+  which recomputes a date range from the source tables
+
+Days are local dates (TIME_ZONE), like TruncDate in the original queries.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    DailyCustomerSales, DailyOrderStatus, DailyProductSales, DailySales,
+    Order, OrderItem, Payment, User,
+)
+
+
+# Orders whose items count as sold (same as the original category/top product queries)
+SOLD_STATUSES = ('C', 'S', 'D')
+
+
+def _bump(model, keys, defaults=None, **deltas):
+    """
+    Add `deltas` to the rollup row identified by `keys`, creating it
+    (with `defaults` for the other columns) if needed
+    """
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    increments = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**keys).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **(defaults or {}), **deltas)
+    except IntegrityError:
+        # Created concurrently by another transaction
+        model.objects.filter(**keys).update(**increments)
+
+
+def _claim_status(model, instance):
+    """
+    Move the stored status to instance.status with a compare-and-set UPDATE
+    (status = new WHERE status = old), retried from the stored value when
+    another save got there first. Returns the status this save replaced.
+    Of several concurrent saves making the same change only one replaces
+    the old status, so only that one counts the transition.
+    """
+    old_status = getattr(instance, '_loaded_status', None)
+    while old_status != instance.status:
+        if old_status is not None and model.objects.filter(
+            pk=instance.pk, status=old_status
+        ).update(status=instance.status):
+            break
+        old_status = model.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+        if old_status is None:
+            break  # Not stored (any more): the save inserts it
+    return old_status
+
+
+def _status_changed(instance, created, update_fields):
+    if update_fields is not None and 'status' not in update_fields:
+        return None, False
+    old_status = None if created else getattr(instance, '_replaced_status', instance.status)
+    return old_status, old_status != instance.status
+
+
+# =====================
+# INCREMENTAL UPDATES
+# =====================
+
+def apply_payment(payment, sign):
+    """Add (sign=1) or remove (sign=-1) one successful payment"""
+    day = timezone.localdate(payment.created_at)
+    amount = payment.total_amount * sign
+    _bump(DailySales, {'date': day}, revenue=amount, paid_orders=sign)
+
+    user_id = Order.objects.filter(pk=payment.order_id).values_list('address__user_id', flat=True).first()
+    if user_id:
+        _bump(DailyCustomerSales, {'date': day, 'user_id': user_id}, revenue=amount, payments=sign)
+
+
+def apply_order_items(order, sign):
+    """Add or remove an order's items from the per-product rollup"""
+    day = timezone.localdate(order.created_at)
+    items = OrderItem.objects.filter(order_id=order.pk).values_list(
+        'product_id', 'product__category_id', 'quantity', 'unit_price'
+    )
+    for product_id, category_id, quantity, unit_price in items:
+        _bump(
+            DailyProductSales,
+            {'date': day, 'product_id': product_id},
+            defaults={'category_id': category_id},
+            quantity=quantity * sign,
+            revenue=quantity * unit_price * sign,
+        )
+
+
+@receiver(pre_save, sender=Payment)
+@receiver(pre_save, sender=Order)
+def _claim_status_change(sender, instance, update_fields, **kwargs):
+    if instance._state.adding or (update_fields is not None and 'status' not in update_fields):
+        return
+    instance._replaced_status = _claim_status(sender, instance)
+
+
+@receiver(post_save, sender=Payment)
+def _payment_saved(sender, instance, created, update_fields, **kwargs):
+    old_status, changed = _status_changed(instance, created, update_fields)
+    if changed and (old_status == 'S' or instance.status == 'S'):
+        apply_payment(instance, 1 if instance.status == 'S' else -1)
+    instance._loaded_status = instance.status
+
+
+@receiver(post_delete, sender=Payment)
+def _payment_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_loaded_status', instance.status) == 'S':
+        apply_payment(instance, -1)
+
+
+@receiver(post_save, sender=Order)
+def _order_saved(sender, instance, created, update_fields, **kwargs):
+    old_status, changed = _status_changed(instance, created, update_fields)
+    if not changed:
+        return
+    day = timezone.localdate(instance.created_at)
+
+    # 'X' also marks orders still waiting for a payment method
+    was_placed = old_status is not None and old_status != 'X'
+    _bump(DailySales, {'date': day}, orders_placed=int(instance.status != 'X') - int(was_placed))
+
+    if old_status is not None:
+        _bump(DailyOrderStatus, {'date': day, 'status': old_status}, count=-1)
+    _bump(DailyOrderStatus, {'date': day, 'status': instance.status}, count=1)
+
+    was_sold = old_status in SOLD_STATUSES
+    is_sold = instance.status in SOLD_STATUSES
+    if was_sold != is_sold:
+        apply_order_items(instance, 1 if is_sold else -1)
+
+    instance._loaded_status = instance.status
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, created, **kwargs):
+    if created and instance.role == 'M':
+        _bump(DailySales, {'date': timezone.localdate(instance.created_at)}, new_customers=1)
+
+
+# =====================
+# BACKFILL
+# =====================
+
+def _day_bounds(start_date, end_date):
+    """Aware datetimes covering [start_date, end_date] in local time"""
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.combine(start_date, time.min), tz),
+        timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min), tz),
+    )
+
+
+def rebuild_rollups(start_date, end_date):
+    """
+    Recompute every rollup row for local dates start_date..end_date from the
+    source tables. Returns the number of DailySales rows written.
+    """
+    start, end = _day_bounds(start_date, end_date)
+    payments = Payment.objects.filter(status='S', created_at__gte=start, created_at__lt=end)
+    orders = Order.objects.filter(created_at__gte=start, created_at__lt=end)
+    customers = User.objects.filter(role='M', created_at__gte=start, created_at__lt=end)
+
+    daily = {}
+
+    def day_row(day):
+        if day not in daily:
+            daily[day] = DailySales(date=day)
+        return daily[day]
+
+    for row in payments.annotate(day=TruncDate('created_at')).values('day').annotate(
+        revenue=Sum('total_amount'), count=Count('id')
+    ):
+        day_row(row['day']).revenue = row['revenue']
+        day_row(row['day']).paid_orders = row['count']
+
+    for row in orders.exclude(status='X').annotate(day=TruncDate('created_at')).values('day').annotate(
+        count=Count('id')
+    ):
+        day_row(row['day']).orders_placed = row['count']
+
+    for row in customers.annotate(day=TruncDate('created_at')).values('day').annotate(count=Count('id')):
+        day_row(row['day']).new_customers = row['count']
+
+    statuses = [
+        DailyOrderStatus(date=row['day'], status=row['status'], count=row['count'])
+        for row in orders.annotate(day=TruncDate('created_at')).values('day', 'status').annotate(
+            count=Count('id')
+        )
+    ]
+
+    products = [
+        DailyProductSales(
+            date=row['day'], product_id=row['product_id'], category_id=row['product__category_id'],
+            quantity=row['units'], revenue=row['sales'],
+        )
+        for row in OrderItem.objects.filter(
+            order__created_at__gte=start, order__created_at__lt=end, order__status__in=SOLD_STATUSES
+        ).annotate(day=TruncDate('order__created_at')).values(
+            'day', 'product_id', 'product__category_id'
+        ).annotate(units=Sum('quantity'), sales=Sum(F('quantity') * F('unit_price')))
+    ]
+
+    customer_rows = [
+        DailyCustomerSales(
+            date=row['day'], user_id=row['order__address__user_id'],
+            revenue=row['revenue'], payments=row['count'],
+        )
+        for row in payments.annotate(day=TruncDate('created_at')).values(
+            'day', 'order__address__user_id'
+        ).annotate(revenue=Sum('total_amount'), count=Count('id'))
+    ]
+
+    with transaction.atomic():
+        for model in (DailySales, DailyOrderStatus, DailyProductSales, DailyCustomerSales):
+            model.objects.filter(date__gte=start_date, date__lte=end_date).delete()
+        DailySales.objects.bulk_create(daily.values(), batch_size=500)
+        DailyOrderStatus.objects.bulk_create(statuses, batch_size=500)
+        DailyProductSales.objects.bulk_create(products, batch_size=500)
+        DailyCustomerSales.objects.bulk_create(customer_rows, batch_size=500)
+
+    return len(daily)
+
+
+# =====================
+# READING (analytics dashboard)
+# =====================
+
+def sales_summary(start_date):
+    """Totals and the daily series since start_date, from DailySales only"""
+    rows = list(DailySales.objects.filter(date__gte=start_date).order_by('date'))
+    revenue = sum((row.revenue for row in rows), Decimal('0'))
+    paid_orders = sum(row.paid_orders for row in rows)
+    return {
+        'revenue': revenue,
+        'paid_orders': paid_orders,
+        'orders_placed': sum(row.orders_placed for row in rows),
+        'new_customers': sum(row.new_customers for row in rows),
+        'avg_order_value': revenue / paid_orders if paid_orders else Decimal('0'),
+        'days': [row for row in rows if row.paid_orders],
+    }
+
+
+def top_customers_since(start_date, limit=10):
+    """
+    Customers with the most revenue since start_date (from DailyCustomerSales),
+    with the number of distinct orders they paid for
+    """
+    rows = list(
+        DailyCustomerSales.objects.filter(date__gte=start_date)
+        .values('user__id', 'user__name', 'user__email')
+        .annotate(total_spent=Sum('revenue'), payments=Sum('payments'))
+        .filter(payments__gt=0)
+        .order_by('-total_spent')[:limit]
+    )
+    # The rollup counts payments; an order can have more than one Success payment
+    start, _ = _day_bounds(start_date, start_date)
+    order_counts = dict(
+        Payment.objects.filter(
+            status='S', created_at__gte=start, order__address__user_id__in=[row['user__id'] for row in rows]
+        )
+        .values('order__address__user_id')
+        .annotate(orders=Count('order', distinct=True))
+        .values_list('order__address__user_id', 'orders')
+    )
+    for row in rows:
+        row['order_count'] = order_counts.get(row['user__id'], 0)
+    return rows
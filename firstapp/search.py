@@ -0,0 +1,384 @@
+"""
+Product full-text search
+
+One interface, two backends:
+- MySQLFullTextBackend: MATCH ... AGAINST over the FULLTEXT index created in
+  migration 0003 (name, short_description, description, ingredients).
+  MySQL keeps the index up to date itself.
+- InMemorySearchBackend: a per-process inverted index used on SQLite (tests,
+  local dev). Built lazily from the DB and updated incrementally, once the
+  transaction commits, by the Product save/delete signals below. Each change
+  also bumps a version in the shared cache (caching.SEARCH_INDEX); other
+  workers see the new version and rebuild their copy on their next search.
+
+Both annotate matching products with `search_rank` (higher = more relevant),
+so views can simply order by '-search_rank'. At most MAX_RESULTS products
+of the queryset passed in are returned (filters such as status=1 apply
+before the cap, not after). truncated(query) tells callers when a short
+typeahead prefix matched more index terms than were searched.
+"""
+import bisect
+import heapq
+import re
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, FloatField, IntegerField, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import SEARCH_INDEX
+from .models import Product, ProductCategory
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Field weights for relevance ranking (in-memory backend)
+FIELD_WEIGHTS = {
+    'name': 5,
+    'short_description': 3,
+    'category': 2,
+    'ingredients': 1,
+    'description': 1,
+}
+
+MIN_PREFIX_LENGTH = 2      # shorter prefixes only match whole words
+MAX_PREFIX_EXPANSION = 64  # cap on index terms a single prefix may expand to (the most common ones)
+MAX_RESULTS = 500          # cap on ranked candidates handed to the ORM
+MAX_CACHED_PREFIXES = 512  # capped prefix expansions kept until the index changes
+
+
+def tokenize(text):
+    """Lowercase word tokens of a string"""
+    return TOKEN_RE.findall((text or '').lower())
+
+
+class BaseSearchBackend:
+    """Interface shared by all product search backends"""
+
+    def filter(self, queryset, query):
+        """Restrict `queryset` to products matching `query`, annotated with search_rank"""
+        raise NotImplementedError
+
+    def index_product(self, product):
+        """Add or refresh one product in the index"""
+
+    def remove_product(self, product_id):
+        """Drop one product from the index"""
+
+    def invalidate(self):
+        """Forget everything; the index is rebuilt on next use"""
+
+    def truncated(self, query):
+        """Whether results for `query` may be missing matches (e.g. a capped prefix expansion)"""
+        return False
+
+
+class MySQLFullTextBackend(BaseSearchBackend):
+    """Ranks with InnoDB FULLTEXT relevance in boolean mode"""
+
+    MATCH_SQL = (
+        'MATCH (product.name, product.short_description, product.description, product.ingredients) '
+        'AGAINST (%s IN BOOLEAN MODE)'
+    )
+
+    def filter(self, queryset, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return queryset.none()
+
+        # Every word required; the last one is a prefix for typeahead
+        boolean_query = ' '.join(f'+{token}' for token in tokens[:-1])
+        boolean_query = f'{boolean_query} +{tokens[-1]}*'.strip()
+        rank = RawSQL(self.MATCH_SQL, [boolean_query], output_field=FloatField())
+
+        # MATCH > 0 AND-ed into WHERE is answered from the FULLTEXT index; OR-ing
+        # it with anything else makes MySQL scan the table instead. So the text
+        # matches and the category matches are two separate lookups.
+        ids = list(
+            queryset.annotate(search_rank=rank)
+            .filter(search_rank__gt=0)
+            .order_by('-search_rank', '-id')
+            .values_list('pk', flat=True)[:MAX_RESULTS]
+        )
+
+        # Category names are not in the FULLTEXT index; resolve them against
+        # the tiny category table instead of LIKE-joining every product row
+        category_ids = list(
+            ProductCategory.objects.filter(name__icontains=query).values_list('id', flat=True)
+        )
+        if category_ids and len(ids) < MAX_RESULTS:
+            ids += list(
+                queryset.filter(category_id__in=category_ids).exclude(pk__in=ids)
+                .order_by('-id').values_list('pk', flat=True)[:MAX_RESULTS - len(ids)]
+            )
+
+        if not ids:
+            return queryset.none()
+        return queryset.filter(pk__in=ids).annotate(search_rank=rank)
+
+
+class InMemorySearchBackend(BaseSearchBackend):
+    """
+    Inverted index: term -> {product_id: weight}, plus a sorted term list
+    so prefix queries are a bisect instead of a scan.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = None
+        self._terms = []
+        self._doc_terms = {}
+        self._prefix_scores = {}  # short prefix -> merged scores (typeahead repeats them)
+        self._version = None  # SEARCH_INDEX version the index reflects
+
+    # ----- index maintenance -----
+
+    def _ensure_built(self):
+        version = SEARCH_INDEX.version()
+        if self._postings is not None and self._version == version:
+            return
+        with self._lock:
+            if self._postings is not None and self._version == version:
+                return
+            self._version = version
+            self._postings = {}
+            self._terms = []
+            self._doc_terms = {}
+            self._prefix_scores = {}
+            rows = Product.objects.values_list(
+                'id', 'name', 'short_description', 'description', 'ingredients', 'category__name'
+            )
+            for product_id, name, short_description, description, ingredients, category in rows.iterator():
+                self._add(product_id, {
+                    'name': name,
+                    'short_description': short_description,
+                    'description': description,
+                    'ingredients': ingredients,
+                    'category': category,
+                })
+
+    def _add(self, product_id, fields):
+        self._prefix_scores = {}
+        weights = {}
+        for field, text in fields.items():
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0) + FIELD_WEIGHTS[field]
+
+        for token, weight in weights.items():
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = {}
+                bisect.insort(self._terms, token)
+            posting[product_id] = weight
+        self._doc_terms[product_id] = set(weights)
+
+    def _remove(self, product_id):
+        self._prefix_scores = {}
+        for token in self._doc_terms.pop(product_id, ()):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(product_id, None)
+            if not posting:
+                del self._postings[token]
+                index = bisect.bisect_left(self._terms, token)
+                if index < len(self._terms) and self._terms[index] == token:
+                    del self._terms[index]
+
+    def _apply_committed(self, change):
+        """
+        Publish a committed change: bump the shared version and, if nobody
+        else bumped it since this copy was built, apply the change here and
+        adopt the new version. Otherwise this copy missed someone's change
+        and is rebuilt on next use.
+        """
+        version = SEARCH_INDEX.invalidate()
+        with self._lock:
+            if change and self._postings is not None and version == self._version + 1:
+                change()
+                self._version = version
+            else:
+                self._postings = None
+
+    def index_product(self, product):
+        product_id = product.pk
+        fields = {
+            'name': product.name,
+            'short_description': product.short_description,
+            'description': product.description,
+            'ingredients': product.ingredients,
+            'category': product.category.name,
+        }
+
+        def change():
+            self._remove(product_id)
+            self._add(product_id, fields)
+        transaction.on_commit(lambda: self._apply_committed(change))
+
+    def remove_product(self, product_id):
+        transaction.on_commit(lambda: self._apply_committed(lambda: self._remove(product_id)))
+
+    def invalidate(self):
+        transaction.on_commit(lambda: self._apply_committed(None))
+
+    # ----- querying -----
+
+    def _prefix_terms(self, token):
+        """Every index term starting with token (a slice of the sorted term list)"""
+        start = bisect.bisect_left(self._terms, token)
+        end = bisect.bisect_left(self._terms, token + '\U0010ffff', start)
+        return self._terms[start:end]
+
+    def _expand(self, token, is_prefix):
+        """Scores for one query token (exact term, or the terms it prefixes)"""
+        if not is_prefix or len(token) < MIN_PREFIX_LENGTH:
+            return dict(self._postings.get(token, {}))
+
+        scores = self._prefix_scores.get(token)
+        if scores is not None:
+            return scores
+
+        terms = self._prefix_terms(token)
+        capped = len(terms) > MAX_PREFIX_EXPANSION
+        if capped:
+            # Keep the terms that match the most products, not the first ones alphabetically
+            terms = heapq.nlargest(MAX_PREFIX_EXPANSION, terms, key=lambda term: len(self._postings[term]))
+        scores = {}
+        for term in terms:
+            for product_id, weight in self._postings[term].items():
+                if weight > scores.get(product_id, 0):
+                    scores[product_id] = weight
+        if capped:
+            # The expensive ones; read-only from here on (callers never mutate scores)
+            if len(self._prefix_scores) >= MAX_CACHED_PREFIXES:
+                self._prefix_scores = {}
+            self._prefix_scores[token] = scores
+        return scores
+
+    def truncated(self, query):
+        tokens = tokenize(query)
+        if not tokens or len(tokens[-1]) < MIN_PREFIX_LENGTH:
+            return False
+        with self._lock:
+            self._ensure_built()
+            return len(self._prefix_terms(tokens[-1])) > MAX_PREFIX_EXPANSION
+
+    def _scores(self, query):
+        """{product_id: score} for products matching every query word"""
+        tokens = tokenize(query)
+        if not tokens:
+            return {}
+
+        with self._lock:
+            self._ensure_built()
+            per_token = [
+                self._expand(token, is_prefix=(i == len(tokens) - 1))
+                for i, token in enumerate(tokens)
+            ]
+
+        # AND semantics: intersect starting from the rarest token
+        per_token.sort(key=len)
+        totals = per_token[0]
+        for scores in per_token[1:]:
+            totals = {
+                product_id: total + scores[product_id]
+                for product_id, total in totals.items()
+                if product_id in scores
+            }
+            if not totals:
+                return {}
+        return totals
+
+    def ranked_ids(self, query, limit=None):
+        """Product ids matching every query word, best first (only the best `limit` if given)"""
+        ranked = [(-score, product_id) for product_id, score in self._scores(query).items()]
+        if limit is not None and limit < len(ranked):
+            # A short prefix can match half the catalog; don't sort all of it
+            ranked = heapq.nsmallest(limit, ranked)
+        else:
+            ranked.sort()
+        return [product_id for _, product_id in ranked]
+
+    def filter(self, queryset, query):
+        ranked = self.ranked_ids(query, limit=MAX_RESULTS + 1)
+        if len(ranked) <= MAX_RESULTS:
+            # Nothing to cap: the final query applies the queryset's filters itself
+            return self._ranked_queryset(queryset, ranked)
+
+        # The cap applies to products the queryset allows (e.g. active ones).
+        # Usually the best MAX_RESULTS all are; otherwise walk the full
+        # ranking a block at a time, keeping the ones it contains.
+        ids = self._allowed(queryset, ranked[:MAX_RESULTS])
+        if len(ids) < MAX_RESULTS:
+            ranked = self.ranked_ids(query)
+            for start in range(MAX_RESULTS, len(ranked), MAX_RESULTS):
+                ids.extend(self._allowed(queryset, ranked[start:start + MAX_RESULTS]))
+                if len(ids) >= MAX_RESULTS:
+                    break
+        return self._ranked_queryset(queryset, ids[:MAX_RESULTS])
+
+    @staticmethod
+    def _allowed(queryset, block):
+        """The ids of `block` that `queryset` contains, in block order"""
+        allowed = set(queryset.filter(pk__in=block).values_list('pk', flat=True))
+        return [product_id for product_id in block if product_id in allowed]
+
+    @staticmethod
+    def _ranked_queryset(queryset, ids):
+        if not ids:
+            return queryset.none()
+
+        # Higher rank = better, to match the MySQL relevance score
+        total = len(ids)
+        rank = Case(
+            *[When(pk=product_id, then=Value(total - position)) for position, product_id in enumerate(ids)],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        return queryset.filter(pk__in=ids).annotate(search_rank=rank)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend():
+    """Process-wide search backend chosen by PRODUCT_SEARCH_BACKEND or the DB vendor"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = getattr(settings, 'PRODUCT_SEARCH_BACKEND', '') or (
+                    'mysql' if connection.vendor == 'mysql' else 'memory'
+                )
+                _backend = MySQLFullTextBackend() if name == 'mysql' else InMemorySearchBackend()
+    return _backend
+
+
+def search_products(queryset, query):
+    """Filter a Product queryset by a search string, annotating search_rank"""
+    return get_search_backend().filter(queryset, query)
+
+
+# =====================
+# INCREMENTAL INDEX UPDATES
+# =====================
+
+@receiver(post_save, sender=Product)
+def _index_saved_product(sender, instance, **kwargs):
+    get_search_backend().index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def _unindex_deleted_product(sender, instance, **kwargs):
+    get_search_backend().remove_product(instance.pk)
+
+
+@receiver(post_save, sender=ProductCategory)
+def _reindex_on_category_change(sender, instance, created, **kwargs):
+    # Category names are denormalized into the in-memory index
+    if not created:
+        get_search_backend().invalidate()
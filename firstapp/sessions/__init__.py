@@ -0,0 +1,22 @@
+"""
+Session engines
+
+Point SESSION_ENGINE at one of the submodules:
+- firstapp.sessions.cached_db: read from the shared cache, write through to
+  the django_session table (survives cache flushes/evictions)
+- firstapp.sessions.signed_cookies: the whole session lives in a signed
+  cookie; no server-side storage at all (keep the session small)
+
+Both only mark the session modified when a value actually changes, so
+views that re-assign the same user_id/user_role/checkout flags on every
+request don't cause a write (SessionMiddleware saves only modified sessions).
+"""
+
+
+class CoalescedWritesMixin:
+    """Skip the save when a key is re-assigned its current value"""
+
+    def __setitem__(self, key, value):
+        if key in self._session and self._session[key] == value:
+            return
+        super().__setitem__(key, value)
@@ -0,0 +1,8 @@
+"""Cache-first, DB write-through session engine with coalesced writes"""
+from django.contrib.sessions.backends import cached_db
+
+from . import CoalescedWritesMixin
+
+
+class SessionStore(CoalescedWritesMixin, cached_db.SessionStore):
+    pass
@@ -0,0 +1,8 @@
+"""Signed-cookie session engine with coalesced writes"""
+from django.contrib.sessions.backends import signed_cookies
+
+from . import CoalescedWritesMixin
+
+
+class SessionStore(CoalescedWritesMixin, signed_cookies.SessionStore):
+    pass
@@ -45,9 +45,9 @@ function initializeCategories() {
 }
 
 // =====================
-// LOAD PRODUCTS VIA AJAX
+// LOAD PRODUCTS VIA AJAX (paginated catalog API)
 // =====================
-async function loadProducts(search = '', category = '', sort = '') {
+async function loadProducts(search = '', category = '', sort = '', cursor = null) {
     const productsGrid = document.getElementById('productsGrid');
     const productCount = document.getElementById('productCount');
     
@@ -63,8 +63,11 @@ async function loadProducts(search = '', category = '', sort = '') {
         if (category) params.append('category', category);
         if (sort) params.append('sort', sort);
         
+        const apiParams = new URLSearchParams(params);
+        if (cursor) apiParams.append('cursor', cursor);
+        
         // Make AJAX request
-        const response = await fetch(`/products/?${params.toString()}`, {
+        const response = await fetch(`/api/products/?${apiParams.toString()}`, {
             method: 'GET',
             headers: {
                 'X-Requested-With': 'XMLHttpRequest'
@@ -77,16 +80,19 @@ async function loadProducts(search = '', category = '', sort = '') {
         
         const data = await response.json();
         
-        // Update product count
+        // Update product count (accumulates across pages)
         if (productCount) {
-            productCount.textContent = data.count;
+            const shown = cursor ? parseInt(productCount.textContent || '0') : 0;
+            productCount.textContent = shown + data.count;
         }
         
-        // Clear grid
-        productsGrid.innerHTML = '';
+        // Clear grid only for a fresh search, not when loading more
+        if (!cursor) {
+            productsGrid.innerHTML = '';
+        }
         
         // Render products
-        if (data.products.length === 0) {
+        if (data.products.length === 0 && !cursor) {
             productsGrid.innerHTML = `
                 <div style="grid-column: 1/-1; text-align: center; padding: 60px 20px; color: var(--ash);">
                     <svg width="64" height="64" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="1" style="margin-bottom: 20px; opacity: 0.3;">
@@ -111,6 +117,8 @@ async function loadProducts(search = '', category = '', sort = '') {
             productData[product.id] = product;
         });
         
+        updateLoadMoreButton(data.next_cursor, search, category, sort);
+        
         // Restore opacity
         productsGrid.style.opacity = '1';
         
@@ -125,6 +133,31 @@ async function loadProducts(search = '', category = '', sort = '') {
     }
 }
 
+// =====================
+// LOAD MORE (next page cursor)
+// =====================
+function updateLoadMoreButton(nextCursor, search, category, sort) {
+    const productsGrid = document.getElementById('productsGrid');
+    let loadMoreBtn = document.getElementById('loadMoreBtn');
+    
+    if (!nextCursor) {
+        if (loadMoreBtn) loadMoreBtn.remove();
+        return;
+    }
+    
+    if (!loadMoreBtn) {
+        loadMoreBtn = document.createElement('button');
+        loadMoreBtn.id = 'loadMoreBtn';
+        loadMoreBtn.className = 'btn-view-jp';
+        loadMoreBtn.style.margin = '40px auto 0';
+        loadMoreBtn.style.display = 'block';
+        loadMoreBtn.textContent = 'Load more';
+        productsGrid.insertAdjacentElement('afterend', loadMoreBtn);
+    }
+    
+    loadMoreBtn.onclick = () => loadProducts(search, category, sort, nextCursor);
+}
+
 // =====================
 // CREATE PRODUCT CARD
 // =====================
@@ -138,10 +171,11 @@ function createProductCard(product) {
     card.dataset.productStock = product.stock;
     card.dataset.productCategory = product.category;
     
-    // Get primary image
-    const primaryImage = product.images && product.images.length > 0 
-        ? product.images[0] 
-        : '/static/img/product/placeholder.jpg';
+    // Get primary image (grid thumbnail + responsive variants)
+    const primaryImage = product.thumbnail || '/static/img/product/placeholder.jpg';
+    const primarySrcset = product.image_srcsets && product.image_srcsets.length > 0
+        ? product.image_srcsets[0]
+        : '';
     
     // Stock badge
     let stockBadge = '';
@@ -164,7 +198,7 @@ function createProductCard(product) {
         
         <!-- Product Image -->
         <div class="product-image-container-jp">
-            <img src="${primaryImage}" alt="${product.name}" class="product-image-jp">
+            <img src="${primaryImage}" srcset="${primarySrcset}" sizes="(max-width: 600px) 50vw, 320px" alt="${product.name}" class="product-image-jp" loading="lazy">
             ${stockBadge}
         </div>
         
@@ -1,3 +1,1932 @@
-from django.test import TestCase
+import asyncio
+import base64
+import csv
+import gc
+import hashlib
+import hmac
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+from datetime import timedelta
+import threading
+import time
+import unittest
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from django.contrib import admin
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import render
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import analytics, encryption, events, exports, images, loyalty, notifications, reconciliation, search, uploads, webhooks
+from .caching import ANALYTICS, CATALOG, CATEGORIES, SEARCH_INDEX, USERS, local_cache
+from .checkout import OutOfStockError, place_order
+from .email_backends import SNSEmailBackend, SNSPublishError
+from .middleware import get_session_user, set_session_user
+from .models import (
+    Address, Cart, CartItem, DailyOrderStatus, DailySales, DeliveryProof, EncryptionKey, LoyaltyTransaction,
+    Member, NotificationOutbox, Order, OrderItem, Payment, Product, ProductCategory, ProductImage, ProofUpload, StripeEvent, User,
+)
+from .pagination import DEFAULT_PAGE_SIZE
+from .payment import paypal, stripe_payment
+from .payment.payment_processor import PaymentProcessor
+from .payment.transport import LoopLocal
+from .rollups import top_customers_since
+from .search import InMemorySearchBackend, get_search_backend
+
+
+# =====================
+# FIXTURES
+# =====================
+
+def make_user(name='alice', role='M', **fields):
+    return User.objects.create(name=name, email=f'{name}@example.com', role=role, **fields)
+
+
+def make_address(user):
+    return Address.objects.create(
+        user=user, label='Home', address='1 Jalan Coklat', city='Kuala Lumpur',
+        state='WP', postal_code='50000', country='Malaysia',
+    )
+
+
+def make_category(code='D', name='Dark Chocolate'):
+    return ProductCategory.objects.create(code=code, name=name)
+
+
+def make_product(category, name='Truffle', price='10.00', stock=100):
+    return Product.objects.create(
+        name=name, category=category, price=Decimal(price), stock=stock, status=1,
+        short_description=name, description=name,
+    )
+
+
+def raw_cursor(values):
+    """A cursor as a client could forge it (cursors aren't signed)"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def concurrent_writes_supported():
+    """
+    Whether the test database takes writes from several connections at once
+    (SQLite only when the test database is a file opened in IMMEDIATE mode;
+    otherwise two writers fail with "database is locked" instead of waiting)
+    """
+    if connection.vendor != 'sqlite':
+        return True
+    test_name = connection.settings_dict['TEST']['NAME'] or ':memory:'
+    return (not connection.creation.is_in_memory_db(test_name)
+            and connection.settings_dict['OPTIONS'].get('transaction_mode') == 'IMMEDIATE')
+
+
+def run_concurrently(worker, count):
+    """
+    Call worker(i) for i in range(count), all threads released at once,
+    each on its own connection. Returns [(result or exception, seconds)].
+    """
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        try:
+            barrier.wait()
+            started = time.perf_counter()
+            try:
+                result = worker(i)
+            except Exception as e:
+                result = e
+            results[i] = (result, time.perf_counter() - started)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def latency_summary(seconds):
+    """'p50=…ms p99=…ms' for a list of durations"""
+    seconds = sorted(seconds)
+    p50 = seconds[len(seconds) // 2] * 1000
+    p99 = seconds[min(len(seconds) - 1, int(len(seconds) * 0.99))] * 1000
+    return f'p50={p50:.1f}ms p99={p99:.1f}ms'
+
+
+def stripe_delivery(event, secret='whsec_test'):
+    """(body, Stripe-Signature header) as Stripe would sign the event"""
+    body = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{body}'.encode(), hashlib.sha256).hexdigest()
+    return body, f't={timestamp},v1={signature}'
+
+
+def checkout_completed(event_id, payment):
+    return {
+        'id': event_id, 'object': 'event', 'type': 'checkout.session.completed',
+        'data': {'object': {'id': f'cs_{event_id}', 'object': 'checkout.session',
+                            'metadata': {'payment_id': str(payment.pk)}}},
+    }
+
+
+class FakeKMS:
+    """generate_data_key/decrypt like KMS, "wrapping" a key by reversing it"""
+
+    def generate_data_key(self, KeyId, KeySpec):
+        plaintext = os.urandom(32)
+        return {'Plaintext': plaintext, 'CiphertextBlob': plaintext[::-1], 'KeyId': KeyId}
+
+    def decrypt(self, CiphertextBlob):
+        return {'Plaintext': CiphertextBlob[::-1]}
+
+
+class FakeSNS:
+    """publish_batch like SNS: rejects entries whose subject is in `reject`, raises for `down` ones"""
+
+    def __init__(self, reject=(), down=()):
+        self.reject, self.down = set(reject), set(down)
+        self.batches = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        subjects = [entry['Subject'] for entry in PublishBatchRequestEntries]
+        if self.down.intersection(subjects):
+            raise ConnectionError('endpoint unreachable')
+        self.batches.append(subjects)
+        return {
+            'Successful': [{'Id': e['Id']} for e in PublishBatchRequestEntries if e['Subject'] not in self.reject],
+            'Failed': [{'Id': e['Id'], 'Code': 'InvalidParameter', 'Message': 'rejected', 'SenderFault': True}
+                       for e in PublishBatchRequestEntries if e['Subject'] in self.reject],
+        }
+
+
+class ShopTestCase(TestCase):
+    """Starts every test with empty caches (shared and per-process tiers)"""
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        SEARCH_INDEX.invalidate()  # per-process search indexes rebuild from this test's rows
+        get_search_backend()._postings = None  # after cache.clear() the version can repeat within a second
+
+    def login(self, user):
+        """Session as the login view leaves it (user id + signed snapshot)"""
+        session = self.client.session
+        set_session_user(SimpleNamespace(session=session), user)
+        session.save()
+
+
+# =====================
+# KEYSET PAGINATION
+# =====================
+
+class CursorTamperingTests(ShopTestCase):
+    """Forged cursors are answered with 400 / a redirect, never a 500"""
+
+    def setUp(self):
+        super().setUp()
+        category = make_category()
+        for i in range(3):
+            make_product(category, name=f'Truffle {i}', price=f'{10 + i}.00')
+
+    def test_catalog_api_rejects_values_of_the_wrong_type(self):
+        for sort, values in [('price_low', ['abc', 1]), ('price_low', ['1.0', 'x']),
+                             ('newest', ['yesterday', 1]), ('name', [None, 1]),
+                             ('price_low', [[1], {'a': 1}])]:
+            response = self.client.get('/api/products/', {'sort': sort, 'cursor': raw_cursor(values)})
+            self.assertEqual(response.status_code, 400, (sort, values))
+
+    def test_catalog_api_follows_issued_cursors(self):
+        first = self.client.get('/api/products/', {'sort': 'price_low', 'limit': 2}).json()
+        second = self.client.get(
+            '/api/products/', {'sort': 'price_low', 'limit': 2, 'cursor': first['next_cursor']}
+        ).json()
+        names = [product['name'] for product in first['products'] + second['products']]
+        self.assertEqual(names, ['Truffle 0', 'Truffle 1', 'Truffle 2'])
+
+    def test_order_history_and_driver_feed_reject_forged_cursors(self):
+        customer = make_user()
+        self.login(customer)
+        response = self.client.get('/orders/history/', {'cursor': raw_cursor(['not a date', 'x'])})
+        self.assertRedirects(response, '/orders/history/', fetch_redirect_response=False)
+
+        self.login(make_user('dave', role='D'))
+        response = self.client.get('/api/driver/orders/', {'cursor': raw_cursor(['not a date', 'x'])})
+        self.assertEqual(response.status_code, 400)
+
+
+class CatalogApiQueryCountTests(ShopTestCase):
+    """/api/products/ costs 2 queries (products + images) whatever the catalog size"""
+
+    def setUp(self):
+        super().setUp()
+        self.category = make_category()
+        self.count = 0
+
+    def add_products(self, count):
+        for _ in range(count):
+            product = make_product(self.category, name=f'Truffle {self.count}', price=f'{10 + self.count}.00')
+            for order in range(2):
+                ProductImage.objects.create(
+                    product=product, image=f'products/{product.pk}-{order}.jpg',
+                    is_primary=order == 0, order=order,
+                )
+            self.count += 1
+        SEARCH_INDEX.invalidate()  # the on_commit index updates don't run inside TestCase
+
+    def assertTwoQueriesPerPage(self):
+        searches = [{'sort': sort} for sort in ('price_low', 'price_high', 'name', 'newest')]
+        searches.append({'search': 'truffle'})
+        for params in searches:
+            self.client.get('/api/products/', params)  # warm the search index
+            first = self.client.get('/api/products/', {**params, 'limit': 5}).json()
+            with self.subTest(products=self.count, **params):
+                with self.assertNumQueries(2):
+                    page = self.client.get('/api/products/', params).json()
+                self.assertEqual(page['count'], min(self.count, DEFAULT_PAGE_SIZE))
+                self.assertTrue(all(len(product['images']) == 2 for product in page['products']))
+                with self.assertNumQueries(2):
+                    self.client.get('/api/products/', {**params, 'limit': 5, 'cursor': first['next_cursor']})
+
+    def test_query_count_does_not_grow_with_the_catalog(self):
+        self.add_products(6)
+        self.assertTwoQueriesPerPage()
+        self.add_products(40)
+        self.assertTwoQueriesPerPage()
+
+
+# =====================
+# CART COUNTERS
+# =====================
+
+class CartCounterTests(ShopTestCase):
+    """Cart.item_count/subtotal always match the cart's lines"""
+
+    def setUp(self):
+        super().setUp()
+        category = make_category()
+        self.truffle = make_product(category, name='Truffle', price='10.00')
+        self.bar = make_product(category, name='Bar', price='4.50')
+        self.cart = Cart.objects.create(user=make_user())
+
+    def assertCountersMatchLines(self):
+        lines = list(CartItem.objects.filter(cart=self.cart).select_related('product'))
+        expected = (sum(line.quantity for line in lines),
+                    sum((line.quantity * line.product.price for line in lines), Decimal('0.00')))
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.subtotal), expected)
+        self.assertEqual(Cart.objects.get_counters(self.cart.pk), expected)
+
+    def test_two_requests_updating_the_same_line(self):
+        line = CartItem.objects.create(cart=self.cart, product=self.truffle, quantity=1)
+        first = CartItem.objects.get(pk=line.pk)
+        second = CartItem.objects.get(pk=line.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            for request_copy in (first, second):  # both read quantity=1 before either saved
+                request_copy.quantity += 1
+                request_copy.save()
+        self.assertCountersMatchLines()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+            second.delete()  # already gone: nothing left to uncount
+        self.assertCountersMatchLines()
+
+    def test_deleting_a_product_uncounts_its_lines(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            CartItem.objects.create(cart=self.cart, product=self.truffle, quantity=2)
+            CartItem.objects.create(cart=self.cart, product=self.bar, quantity=3)
+            self.truffle.delete()
+        self.assertCountersMatchLines()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.bar.pk).delete()  # admin bulk delete
+        self.assertCountersMatchLines()
+        self.assertEqual(self.cart.item_count, 0)
+
+
+# =====================
+# ENCRYPTION
+# =====================
+
+@override_settings(AWS_KMS_KEY_ID='alias/test')
+@mock.patch('firstapp.encryption.get_kms_client', FakeKMS)
+class DataKeyCacheTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        encryption.clear_key_cache()
+        self.addCleanup(encryption.clear_key_cache)
+
+    def test_key_from_a_rolled_back_transaction_is_not_reused(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    encryption.encrypt_secret('first')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertFalse(EncryptionKey.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            value = encryption.encrypt_secret('second')
+        key_id = value.split(':')[1]
+        self.assertTrue(EncryptionKey.objects.filter(key_id=key_id).exists())
+        self.assertEqual(encryption.decrypt_secret(value), 'second')
+
+    def test_committed_key_is_shared(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = encryption.encrypt_secret('a')
+        second, third = encryption.encrypt_many(['b', 'c'])
+        key_ids = {value.split(':')[1] for value in (first, second, third)}
+        self.assertEqual(key_ids, set(EncryptionKey.objects.values_list('key_id', flat=True)))
+        self.assertEqual(len(key_ids), 1)
+        self.assertEqual(encryption.decrypt_many([first, second, third]), ['a', 'b', 'c'])
+
+    def test_one_data_key_per_transaction(self):
+        with mock.patch.object(FakeKMS, 'generate_data_key', autospec=True,
+                               side_effect=FakeKMS.generate_data_key) as generate:
+            with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                values = [encryption.encrypt_secret(f'v{i}') for i in range(50)]
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(EncryptionKey.objects.count(), 1)
+        self.assertEqual(encryption.decrypt_many(values), [f'v{i}' for i in range(50)])
+
+    def test_key_from_a_rolled_back_savepoint_is_not_reused(self):
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            try:
+                with transaction.atomic():
+                    lost = encryption.encrypt_secret('first')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            kept = encryption.encrypt_secret('second')
+        self.assertNotEqual(lost.split(':')[1], kept.split(':')[1])
+        self.assertEqual(list(EncryptionKey.objects.values_list('key_id', flat=True)), [kept.split(':')[1]])
+        self.assertEqual(encryption.decrypt_secret(kept), 'second')
+
+
+class SlowKMS(FakeKMS):
+    """FakeKMS with a network round trip per call (local stand-in for timing)"""
+
+    LATENCY = 0.002
+
+    def generate_data_key(self, KeyId, KeySpec):
+        time.sleep(self.LATENCY)
+        return super().generate_data_key(KeyId, KeySpec)
+
+    def decrypt(self, CiphertextBlob):
+        time.sleep(self.LATENCY)
+        return super().decrypt(CiphertextBlob)
+
+    def encrypt(self, KeyId, Plaintext):
+        time.sleep(self.LATENCY)
+        return {'CiphertextBlob': Plaintext[::-1]}
+
+
+@tag('benchmark')
+@override_settings(AWS_KMS_KEY_ID='alias/test')
+@mock.patch('firstapp.encryption.get_kms_client', SlowKMS)
+class EnvelopeEncryptionBenchmark(ShopTestCase):
+    """Direct KMS per value vs. envelope encryption, against a 2 ms KMS stand-in"""
+
+    VALUES = 1000
+
+    def test_envelope_vs_direct_kms(self):
+        encryption.clear_key_cache()
+        self.addCleanup(encryption.clear_key_cache)
+        values = [f'4111-1111-1111-{i:04d}' for i in range(self.VALUES)]
+        kms = SlowKMS()
+
+        started = time.perf_counter()
+        legacy = [base64.b64encode(kms.encrypt('alias/test', v.encode())['CiphertextBlob']).decode() for v in values]
+        direct = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            encrypted = [encryption.encrypt_secret(value) for value in values]
+        encrypt = time.perf_counter() - started
+
+        encryption.clear_key_cache()
+        started = time.perf_counter()
+        self.assertEqual(encryption.decrypt_many(encrypted), values)
+        decrypt = time.perf_counter() - started
+
+        self.assertEqual(encryption.decrypt_secret(legacy[0]), values[0])
+        self.assertEqual(EncryptionKey.objects.count(), 1)
+        print(f'\n{self.VALUES} values: direct KMS {direct * 1000:.0f}ms, '
+              f'envelope encrypt {encrypt * 1000:.0f}ms, decrypt {decrypt * 1000:.0f}ms')
+
+
+# =====================
+# IMAGES
+# =====================
+
+def photo_with_exif(size=(60, 40)):
+    """JPEG bytes carrying camera, GPS and a 'rotate 90°' orientation tag"""
+    exif = Image.Exif()
+    exif[0x010F] = 'PhoneMaker'  # Make
+    exif[0x0112] = 6  # Orientation
+    exif[0x8825] = {1: 'N', 2: (3.0, 8.0, 0.0)}  # GPS
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'brown').save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+class ProductImageProcessingTests(ShopTestCase):
+    """What the image pool does after a product photo is uploaded"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_override = override_settings(MEDIA_ROOT=media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        # Meant for the pool's threads; here it would drop the test's transaction
+        patcher = mock.patch('firstapp.images.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.product = make_product(make_category())
+
+    def test_original_is_stored_without_exif(self):
+        image = ProductImage.objects.create(
+            product=self.product, image=SimpleUploadedFile('photo.jpg', photo_with_exif())
+        )
+        images.process_product_image(ProductImage, image.pk)
+
+        image.refresh_from_db()
+        with image.image.open('rb') as stored, Image.open(stored) as original:
+            self.assertEqual(dict(original.getexif()), {})
+            self.assertEqual(original.size, (40, 60))  # rotated as the camera meant
+        self.assertEqual(image.variants['widths']['thumb'], 40)
+
+    def test_catalog_cache_sees_the_variants(self):
+        image = ProductImage.objects.create(
+            product=self.product, image=SimpleUploadedFile('photo.jpg', photo_with_exif())
+        )
+        cached = CATALOG.get_or_set('home:featured', lambda: list(Product.objects.with_images()))
+        self.assertEqual(cached[0].get_primary_image().variants, {})
+
+        images.build_variants(ProductImage, image.pk)
+        cached = CATALOG.get_or_set('home:featured', lambda: list(Product.objects.with_images()))
+        self.assertTrue(cached[0].get_primary_image().variants)
+
+    def test_transparent_images_keep_a_white_background(self):
+        for mode in ('RGBA', 'P'):
+            picture = Image.new('RGBA', (40, 40), (0, 0, 0, 0))
+            picture.paste((200, 30, 30, 255), (10, 10, 30, 30))
+            if mode == 'P':
+                picture = picture.convert('P')  # palette + transparent index
+                picture.info['transparency'] = picture.getpixel((0, 0))
+            buffer = io.BytesIO()
+            picture.save(buffer, 'PNG')
+            image = ProductImage.objects.create(
+                product=self.product, image=SimpleUploadedFile(f'{mode}.png', buffer.getvalue())
+            )
+            variants = images.build_variants(ProductImage, image.pk)
+
+            with self.subTest(mode=mode):
+                with default_storage.open(images.variant_name(variants['hash'], 'thumb', 'jpeg')) as stored, \
+                        Image.open(stored) as jpeg:
+                    self.assertGreater(min(jpeg.getpixel((2, 2))), 240)
+                    self.assertGreater(jpeg.getpixel((20, 20))[0], 150)
+                with default_storage.open(images.variant_name(variants['hash'], 'thumb', 'webp')) as stored, \
+                        Image.open(stored) as webp:
+                    self.assertEqual(webp.convert('RGBA').getpixel((2, 2))[3], 0)
+
+
+class RemoteStorage(Storage):
+    """A storage whose files have no local path (like S3)"""
+
+    def __init__(self):
+        self.files = {}
+
+    def _save(self, name, content):
+        self.files[name] = content.read()
+        return name
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name], name=name)
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+
+class ChunkedProofUploadTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_override = override_settings(
+            MEDIA_ROOT=media_root, DELIVERY_PROOF_PARTIAL_ROOT=os.path.join(media_root, 'partial'),
+        )
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+
+        customer = make_user()
+        self.order = Order.objects.create(address=make_address(customer), subtotal=Decimal('10.00'), status='S')
+        self.driver = make_user('dave', role='D')
+        self.photo = photo_with_exif()
+
+    def start(self):
+        return uploads.start_upload(self.order, self.driver, 'IMG_0001.JPG', len(self.photo))
+
+    def send_all(self, upload):
+        content_range = f'bytes 0-{len(self.photo) - 1}/{len(self.photo)}'
+        return uploads.write_chunk(upload, io.BytesIO(self.photo), content_range)
+
+    def assertPublished(self, upload):
+        upload.refresh_from_db()
+        self.assertTrue(upload.is_complete())
+        proof = DeliveryProof.objects.get(order=self.order)
+        self.assertEqual(proof.image.name, f'delivery_proofs/{upload.id}.jpg')
+        with proof.image.open('rb') as stored:
+            self.assertEqual(stored.read(), self.photo)
+        self.assertFalse(os.path.exists(uploads.partial_path(upload)))
+
+    def test_completion_can_be_retried_after_a_rollback(self):
+        upload = self.start()
+        with mock.patch('firstapp.uploads.queue_order_status_email', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.send_all(upload)  # file already moved when the transaction rolls back
+        upload.refresh_from_db()
+        self.assertFalse(upload.is_complete())
+
+        uploads.complete_upload(upload)
+        self.assertPublished(upload)
+
+    def test_storage_without_local_paths(self):
+        storage = RemoteStorage()
+        upload = self.start()
+        with mock.patch('firstapp.uploads.default_storage', storage):
+            self.send_all(upload)
+        upload.refresh_from_db()
+        self.assertTrue(upload.is_complete())
+        self.assertEqual(storage.files[f'delivery_proofs/{upload.id}.jpg'], self.photo)
+        self.assertFalse(os.path.exists(uploads.partial_path(upload)))
+
+    def test_abandoned_uploads_expire(self):
+        abandoned, recent = self.start(), self.start()
+        ProofUpload.objects.filter(pk=abandoned.pk).update(updated_at=timezone.now() - timedelta(days=2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            expired = uploads.expire_stale_uploads()
+        self.assertEqual([upload.pk for upload in expired], [abandoned.pk])
+        self.assertFalse(ProofUpload.objects.filter(pk=abandoned.pk).exists())
+        self.assertFalse(os.path.exists(uploads.partial_path(abandoned)))
+        self.assertTrue(os.path.exists(uploads.partial_path(recent)))
+
+        response = self.send_all(recent)
+        self.assertTrue(response.is_complete())
+
+
+# =====================
+# QUERY COUNTS
+# =====================
+
+class PageQueryCountTests(ShopTestCase):
+    """Page query counts stay flat as products, images and cart lines grow"""
+
+    # Logged-in shopper, cold catalog/category/session-user caches
+    EXPECTED_QUERIES = {'home': 3, 'product_detail': 5, 'cart': 4, 'products': 4, 'checkout': 6, 'payment': 5}
+
+    def setUp(self):
+        super().setUp()
+        self.category = make_category()
+        self.user = make_user()
+        Member.objects.create(user=self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.order = Order.objects.create(address=make_address(self.user), order_number='PQ1', subtotal=Decimal('10.00'))
+        self.login(self.user)
+        session = self.client.session
+        session['pending_order_id'] = self.order.pk
+        session.save()
+        self.products = []
+
+    def add_products(self, count):
+        """`count` more products, each with two images, a cart line, an order line and an address"""
+        for _ in range(count):
+            make_address(self.user)
+            product = make_product(self.category, name=f'Truffle {len(self.products)}')
+            for order in range(2):
+                ProductImage.objects.create(
+                    product=product, image=f'products/{product.pk}-{order}.jpg',
+                    is_primary=order == 0, order=order,
+                )
+            CartItem.objects.create(cart=self.cart, product=product, quantity=1)
+            OrderItem.objects.create(order=self.order, product=product, product_name=product.name,
+                                     quantity=1, unit_price=product.price, subtotal=product.price)
+            self.products.append(product)
+
+    @staticmethod
+    def render(request, template_name, context=None, **kwargs):
+        if template_name != 'product/product_detail.html':
+            return render(request, template_name, context, **kwargs)
+        # That template isn't in the tree: read what the page shows instead
+        list(context['product'].get_all_images())
+        for related in context['related_products']:
+            related.get_primary_image()
+        return HttpResponse()
+
+    def assertQueriesPerPage(self):
+        urls = {
+            'home': '/',
+            'product_detail': f'/products/{self.products[0].pk}/',
+            'cart': '/cart/',
+            'products': '/products/',
+            'checkout': '/checkout/',
+            'payment': '/payment/',
+        }
+        for name, url in urls.items():
+            CATALOG.invalidate()
+            CATEGORIES.invalidate()
+            USERS.delete(self.user.pk)
+            with self.subTest(page=name, products=len(self.products)), \
+                    mock.patch('firstapp.views.render', self.render), \
+                    self.assertNumQueries(self.EXPECTED_QUERIES[name]):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_query_counts_do_not_grow_with_the_data(self):
+        self.add_products(3)
+        self.assertQueriesPerPage()
+        self.add_products(30)
+        self.assertQueriesPerPage()
+
+
+class OrderHistoryQueryCountTests(ShopTestCase):
+    """Dashboard and order history cost the same for 12 orders or 45"""
+
+    EXPECTED_QUERIES = {'dashboard': 5, 'history': 2, 'history_next': 2}
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        Member.objects.create(user=self.user)
+        self.address = make_address(self.user)
+        self.product = make_product(make_category())
+        self.login(self.user)
+
+    def add_orders(self, count):
+        """`count` more orders with two lines and two payments each, one cancelled order and an address"""
+        make_address(self.user)
+        start = Order.objects.count()
+        for i in range(start, start + count):
+            order = Order.objects.create(address=self.address, order_number=f'OH{i}', subtotal=Decimal('20.00'))
+            for quantity in (1, 2):
+                OrderItem.objects.create(order=order, product=self.product, product_name='Truffle',
+                                         quantity=quantity, unit_price=Decimal('10.00'), subtotal=Decimal('10.00'))
+                Payment.objects.create(order=order, total_amount=Decimal('20.00'))
+        Order.objects.create(address=self.address, order_number=f'OHX{start}', subtotal=Decimal('5.00'), status='X')
+
+    def assertQueriesPerPage(self):
+        summaries = list(Order.objects.for_history(self.user).with_summary().order_by('-created_at', '-id')[:1])
+        self.assertEqual((summaries[0].total_items, summaries[0].payment_total), (3, Decimal('20.00')))
+
+        first_page = self.client.get('/orders/history/', {'limit': 5})
+        urls = {
+            'dashboard': '/dashboard/',
+            'history': '/orders/history/?limit=5',
+            'history_next': f"/orders/history/?limit=5&cursor={first_page.context['next_cursor']}",
+        }
+        for name, url in urls.items():
+            USERS.delete(self.user.pk)
+            with self.subTest(page=name, orders=Order.objects.count()), \
+                    self.assertNumQueries(self.EXPECTED_QUERIES[name]):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_query_counts_do_not_grow_with_the_orders(self):
+        self.add_orders(12)
+        self.assertQueriesPerPage()
+        self.add_orders(33)
+        self.assertQueriesPerPage()
+
+
+# =====================
+# ANALYTICS ROLLUPS
+# =====================
+
+class RollupStatusChangeTests(ShopTestCase):
+    """A status change saved by several requests at once is counted once"""
+
+    def setUp(self):
+        super().setUp()
+        self.customer = make_user()
+        self.order = Order.objects.create(
+            address=make_address(self.customer), subtotal=Decimal('10.00'), status='P'
+        )
+        self.today = timezone.localdate(self.order.created_at)
+
+    def status_counts(self):
+        return dict(DailyOrderStatus.objects.filter(date=self.today, count__gt=0).values_list('status', 'count'))
+
+    def test_same_order_transition_saved_twice(self):
+        first, second = Order.objects.get(pk=self.order.pk), Order.objects.get(pk=self.order.pk)
+        for request_copy in (first, second):  # both loaded while Pending
+            request_copy.status = 'C'
+            request_copy.save()
+        self.assertEqual(self.status_counts(), {'C': 1})
+        self.assertEqual(DailySales.objects.get(date=self.today).orders_placed, 1)
+
+    def test_different_transitions_from_the_same_status(self):
+        first, second = Order.objects.get(pk=self.order.pk), Order.objects.get(pk=self.order.pk)
+        first.status = 'S'
+        first.save()
+        second.status = 'X'
+        second.save()  # overwrites Shipped, not Pending
+        self.assertEqual(self.status_counts(), {'X': 1})
+        self.assertEqual(DailySales.objects.get(date=self.today).orders_placed, 0)
+
+    def test_payment_confirmed_twice(self):
+        payment = Payment.objects.create(order=self.order, total_amount=Decimal('10.00'), status='P')
+        first, second = Payment.objects.get(pk=payment.pk), Payment.objects.get(pk=payment.pk)
+        for request_copy in (first, second):
+            request_copy.status = 'S'
+            request_copy.save()
+        sales = DailySales.objects.get(date=self.today)
+        self.assertEqual((sales.paid_orders, sales.revenue), (1, Decimal('10.00')))
+
+    def test_top_customers_count_orders_not_payments(self):
+        for _ in range(2):
+            Payment.objects.create(order=self.order, total_amount=Decimal('5.00'), status='S')
+        [row] = top_customers_since(self.today)
+        self.assertEqual((row['user__id'], row['total_spent'], row['order_count']),
+                         (self.customer.pk, Decimal('10.00'), 1))
+
+
+class QueuedExecutor:
+    """Executor stand-in that holds submitted jobs until run() is called"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for fn, args in jobs:
+            fn(*args)
+
+
+class AnalyticsSnapshotTests(ShopTestCase):
+    """Stale-while-revalidate dashboard snapshots"""
+
+    def setUp(self):
+        super().setUp()
+        self.executor = QueuedExecutor()
+        patcher = mock.patch('firstapp.analytics._get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Meant for the refresh thread; here it would drop the test's transaction
+        patcher = mock.patch('firstapp.analytics.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_stale(self, period):
+        snapshot = analytics.refresh_snapshot(period)
+        snapshot['generated_at'] -= timedelta(seconds=analytics._max_age() + 1)
+        ANALYTICS.set(f'dashboard:{period}', snapshot)
+        return snapshot['generated_at']
+
+    def test_stale_snapshot_is_served_while_one_refresh_runs(self):
+        stale_at = self.make_stale('30')
+
+        for _ in range(3):
+            self.assertEqual(analytics.get_snapshot('30')['generated_at'], stale_at)
+        self.assertEqual(len(self.executor.jobs), 1)
+        self.assertFalse(analytics.request_refresh('30'))  # "Recompute now" while it runs
+
+        self.executor.run()
+        self.assertGreater(analytics.get_snapshot('30')['generated_at'], stale_at)
+        self.assertTrue(analytics.request_refresh('30'))  # lock released once the refresh finished
+
+    def test_periods_refresh_independently(self):
+        self.make_stale('7')
+        self.make_stale('90')
+        analytics.get_snapshot('7')
+        analytics.get_snapshot('90')
+        self.assertEqual([args for _, args in self.executor.jobs], [('7',), ('90',)])
+
+    def test_invalid_period_is_not_used_as_a_snapshot(self):
+        for period in ('', '14', '30 ', '365; drop', None):
+            self.assertEqual(analytics.normalize_period(period), '365')
+        self.login(make_user('root', role='A'))
+        with mock.patch('firstapp.views.render', return_value=HttpResponse()) as render_page:
+            self.client.get('/secure/admin/analytics/', {'period': 'bogus'})
+        self.assertEqual(render_page.call_args.args[2]['period'], '365')
+        self.assertIsNone(ANALYTICS.get('dashboard:bogus'))
+
+
+# =====================
+# SALES EXPORT
+# =====================
+
+@override_settings(EXPORT_CHUNK_SIZE=3)
+class SalesExportTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.login(make_user('root', role='A'))
+        address = make_address(make_user())
+        dark, milk = make_category('D', 'Dark'), make_category('M', 'Milk')
+        self.today = timezone.localdate()
+        # (order number, days ago, status, category) -> two items each
+        for number, days_ago, status, category in [
+            ('E1', 0, 'P', dark), ('E2', 0, 'C', milk), ('E3', 3, 'S', dark),
+            ('E4', 10, 'D', milk), ('E5', 40, 'X', dark),
+        ]:
+            order = Order.objects.create(address=address, order_number=number, subtotal=Decimal('20.00'), status=status)
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+            for name in ('Bar', 'Truffle'):
+                product = make_product(category, name=f'{number} {name}')
+                OrderItem.objects.create(order=order, product=product, product_name=product.name,
+                                         quantity=1, unit_price=Decimal('10.00'), subtotal=Decimal('10.00'))
+
+    def export(self, **params):
+        response = self.client.get('/secure/admin/analytics/export/', params)
+        if response.status_code != 200:
+            return response, None
+        return response, b''.join(response.streaming_content)
+
+    def exported_orders(self, **params):
+        response, body = self.export(**params)
+        self.assertEqual(response.status_code, 200, response.content if body is None else '')
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        return sorted({row['order_number'] for row in rows})
+
+    def test_csv_covers_every_row_in_keyset_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            response, body = self.export()
+        self.assertIsInstance(response, StreamingHttpResponse)
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        self.assertEqual([int(row['order_item_id']) for row in rows],
+                         list(OrderItem.objects.order_by('id').values_list('id', flat=True)))
+        batches = [q for q in queries if 'order_item' in q['sql'] and 'LIMIT 3' in q['sql']]
+        self.assertEqual(len(batches), 5)  # 3 + 3 + 3 + 1 rows, then one empty page
+
+    def test_filters(self):
+        week_ago = (self.today - timedelta(days=7)).isoformat()
+        cases = [
+            ({'start': week_ago}, ['E1', 'E2', 'E3']),
+            ({'end': (self.today - timedelta(days=1)).isoformat()}, ['E3', 'E4', 'E5']),
+            ({'start': week_ago, 'end': week_ago}, []),
+            ({'status': 'c,s'}, ['E2', 'E3']),
+            ({'category': 'm'}, ['E2', 'E4']),
+            ({'start': week_ago, 'status': 'P,C,S', 'category': 'D'}, ['E1', 'E3']),
+        ]
+        for params, orders in cases:
+            with self.subTest(**params):
+                self.assertEqual(self.exported_orders(**params), orders)
+
+    def test_bad_input_is_rejected(self):
+        for params in [
+            {'start': '2024-13-01'},
+            {'end': 'yesterday'},
+            {'start': self.today.isoformat(), 'end': (self.today - timedelta(days=1)).isoformat()},
+            {'status': 'C,Z'},
+            {'format': 'xlsx'},
+        ]:
+            with self.subTest(**params):
+                response, _ = self.export(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    @unittest.skipIf(exports.pq is None, 'pyarrow is not installed')
+    def test_parquet_has_one_row_group_per_batch(self):
+        response, body = self.export(format='parquet', category='D')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.parquet')
+        parquet = exports.pq.ParquetFile(io.BytesIO(body))
+        self.assertEqual(parquet.metadata.num_row_groups, 2)  # 6 rows in batches of 3
+        table = parquet.read()
+        self.assertEqual(sorted(set(table.column('order_number').to_pylist())), ['E1', 'E3', 'E5'])
+        self.assertEqual(table.column('subtotal').to_pylist(), [Decimal('10.00')] * 6)
+
+
+# =====================
+# ORDER EVENTS
+# =====================
+
+class OrderEventTests(ShopTestCase):
+    """Status changes reach the customer's and the drivers' channels (memory broker)"""
+
+    def setUp(self):
+        super().setUp()
+        self.customer = make_user()
+        self.order = Order.objects.create(
+            address=make_address(self.customer), subtotal=Decimal('10.00'), status='C'
+        )
+        self.broker = events.MemoryBroker()
+        patcher = mock.patch('firstapp.events._broker', self.broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def subscribe(self, *channels):
+        return self.loop.run_until_complete(self.broker.subscribe(channels))
+
+    def next_event(self, subscription):
+        # Events published from this thread wait in the loop until it runs
+        return self.loop.run_until_complete(subscription.get(timeout=1))
+
+    def test_status_change_is_published_after_commit(self):
+        customer = self.subscribe(events.user_channel(self.customer.pk))
+        drivers = self.subscribe(events.DRIVERS_CHANNEL)
+        stranger = self.subscribe(events.user_channel(self.customer.pk + 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.get(pk=self.order.pk)
+            order.status = 'S'
+            order.save()
+            self.assertEqual(self.broker.hub.subscriber_count(), 3)
+        for subscription in (customer, drivers):
+            event = self.next_event(subscription)
+            self.assertEqual((event['type'], event['order_id'], event['status'], event['old_status']),
+                             ('order.status', str(order.pk), 'S', 'C'))
+        self.assertIsNone(self.loop.run_until_complete(stranger.get(timeout=0.01)))
+
+    def test_loaded_address_saves_the_lookup(self):
+        order = Order.objects.select_related('address').get(pk=self.order.pk)
+        order.status = 'S'
+        with CaptureQueriesContext(connection) as queries:
+            order.save()
+        address_table = f'FROM {connection.ops.quote_name(Address._meta.db_table)}'
+        self.assertFalse([query['sql'] for query in queries if address_table in query['sql']])
+
+
+@tag('benchmark')
+class EventFanOutBenchmark(SimpleTestCase):
+    """One event to 5,000 connected drivers on one event loop"""
+
+    SUBSCRIBERS = 5000
+    EVENTS = 20
+
+    def test_every_subscriber_gets_every_event(self):
+        broker = events.MemoryBroker()
+
+        async def scenario():
+            subscriptions = [await broker.subscribe([events.DRIVERS_CHANNEL]) for _ in range(self.SUBSCRIBERS)]
+            timings = []
+            for i in range(self.EVENTS):
+                started = time.perf_counter()
+                # From another thread, like a request thread publishing on commit
+                await asyncio.to_thread(broker.publish, events.DRIVERS_CHANNEL, {'type': 'order.status', 'n': i})
+                await asyncio.gather(*(subscription.get(timeout=5) for subscription in subscriptions))
+                timings.append(time.perf_counter() - started)
+            for subscription in subscriptions:
+                broker.unsubscribe(subscription)
+            return timings
+
+        timings = asyncio.run(scenario())
+        self.assertEqual(broker.hub.subscriber_count(), 0)
+        print(f'\n{self.SUBSCRIBERS} subscribers, {self.EVENTS} events: {latency_summary(timings)} '
+              f'from publish until every subscriber had the event')
+
+
+# =====================
+# TRACKING FEED
+# =====================
+
+class TrackingFeedTests(ShopTestCase):
+    """/api/active-orders/: ETag short-circuit and deltas since a cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        address = make_address(self.user)
+        self.orders = {
+            status: Order.objects.create(address=address, order_number=f'TR{status}', subtotal=Decimal('10.00'),
+                                         status=status)
+            for status in ('P', 'C', 'S', 'D', 'X')
+        }
+        self.old_delivered = Order.objects.create(address=address, order_number='TROLD', subtotal=Decimal('10.00'),
+                                                  status='D')
+        # Everything last changed an hour ago (well outside the cursor overlap)...
+        Order.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        # ...except a delivery from last week, which has left the window
+        Order.objects.filter(pk=self.old_delivered.pk).update(updated_at=timezone.now() - timedelta(days=7))
+        make_address(make_user('bob'))  # someone else's orders never show up
+        self.login(self.user)
+
+    def poll(self, since=None, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/api/active-orders/', {'since': since} if since else {}, **headers)
+
+    def test_unchanged_window_is_not_modified(self):
+        first = self.poll()
+        payload = first.json()
+        self.assertTrue(payload['full'])
+        self.assertEqual(sorted(o['order_number'] for o in payload['orders']), ['TRC', 'TRD', 'TRP', 'TRS'])
+
+        USERS.delete(self.user.pk)
+        with self.assertNumQueries(2):  # session user + the (id, updated_at) window
+            response = self.poll(payload['cursor'], first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+
+    def test_delta_returns_only_orders_changed_since_the_cursor(self):
+        first = self.poll()
+        shipped = self.orders['C']
+        shipped.status = 'S'
+        shipped.save()
+        DeliveryProof.objects.create(order=self.orders['D'], image='proofs/tr.jpg')
+
+        response = self.poll(first.json()['cursor'], first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        payload = response.json()
+        self.assertFalse(payload['full'])
+        self.assertEqual(sorted((o['order_number'], o['status']) for o in payload['orders']),
+                         [('TRC', 'S'), ('TRD', 'D')])
+        self.assertEqual(sorted(payload['active_ids']), sorted(str(self.orders[s].pk) for s in 'PCSD'))
+
+        again = self.poll(payload['cursor'])  # no If-None-Match: still only what changed since
+        self.assertLessEqual({o['order_number'] for o in again.json()['orders']}, {'TRC', 'TRD'})
+
+    def test_cancelled_order_leaves_the_active_ids(self):
+        first = self.poll()
+        cancelled = self.orders['P']
+        cancelled.status = 'X'
+        cancelled.save()
+        payload = self.poll(first.json()['cursor'], first['ETag']).json()
+        self.assertEqual(payload['orders'], [])
+        self.assertNotIn(str(cancelled.pk), payload['active_ids'])
+
+    def test_malformed_cursor_is_rejected(self):
+        self.assertEqual(self.poll('not-a-cursor').status_code, 400)
+        self.assertEqual(self.poll(raw_cursor(['yesterday'])).status_code, 400)
+
+
+class DriverFeedTests(ShopTestCase):
+    """/api/driver/orders/: filters, keyset pages and a fixed query budget"""
+
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(make_category())
+        self.kl = make_address(make_user())
+        self.johor = make_address(make_user('bob'))
+        self.johor.postal_code = '81100'
+        self.johor.save()
+        self.count = 0
+        self.driver = make_user('dave', role='D')
+        self.login(self.driver)
+
+    def add_orders(self, count):
+        """`count` orders cycling through statuses, addresses and days (newest last)"""
+        for _ in range(count):
+            i = self.count
+            order = Order.objects.create(address=(self.kl, self.johor)[i % 2], order_number=f'DR{i:03}',
+                                         subtotal=Decimal('10.00'), status='PCSDX'[i % 5])
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=30 - i % 30, minutes=-i))
+            OrderItem.objects.create(order=order, product=self.product, product_name='Truffle', quantity=i % 3 + 1,
+                                     unit_price=Decimal('10.00'), subtotal=Decimal('10.00'))
+            if order.status == 'D':
+                DeliveryProof.objects.create(order=order, image=f'proofs/{i}.jpg')
+            self.count += 1
+
+    def feed(self, **params):
+        response = self.client.get('/api/driver/orders/', params)
+        return response, response.json()
+
+    def walk(self, **params):
+        """Every order number in the feed, following next_cursor with a fixed budget per page"""
+        numbers, cursor = [], None
+        while True:
+            USERS.delete(self.driver.pk)
+            with self.assertNumQueries(2):  # session user + one page
+                _, payload = self.feed(**params, **({'cursor': cursor} if cursor else {}))
+            numbers += [order['order_number'] for order in payload['orders']]
+            cursor = payload['next_cursor']
+            if not cursor:
+                return numbers
+
+    def expected(self, queryset):
+        return list(queryset.exclude(status='X').order_by('-created_at', '-id').values_list('order_number', flat=True))
+
+    def test_pages_cover_the_feed_at_two_sizes(self):
+        for count in (7, 30):
+            self.add_orders(count)
+            with self.subTest(orders=self.count):
+                self.assertEqual(self.walk(limit=4), self.expected(Order.objects.all()))
+
+        _, payload = self.feed(limit=100)
+        by_number = {order['order_number']: order for order in payload['orders']}
+        for order in Order.objects.exclude(status='X').with_summary():
+            row = by_number[order.order_number]
+            self.assertEqual(row['total_items'], order.total_items)
+            self.assertEqual(row['delivery_proof'] is not None, order.status == 'D')
+
+    def test_filter_combinations(self):
+        self.add_orders(30)
+        today = timezone.localdate()
+        week_ago = (today - timedelta(days=7)).isoformat()
+        orders = Order.objects.all()
+        cases = [
+            ({'status': 'c'}, orders.filter(status='C')),
+            ({'status': 'C,S'}, orders.filter(status__in='CS')),
+            ({'status': 'X'}, orders.none()),  # cancelled orders never reach drivers
+            ({'postal': '811'}, orders.filter(address=self.johor)),
+            ({'date_from': week_ago}, orders.filter(created_at__date__gte=week_ago)),
+            ({'date_to': week_ago}, orders.filter(created_at__date__lte=week_ago)),
+            ({'status': 'S,D', 'postal': '50', 'date_from': week_ago},
+             orders.filter(status__in='SD', address=self.kl, created_at__date__gte=week_ago)),
+        ]
+        for params, queryset in cases:
+            with self.subTest(**params):
+                self.assertEqual(self.walk(limit=3, **params), self.expected(queryset))
+
+    def test_bad_input_is_rejected(self):
+        for params in ({'date_from': '2024-02-30'}, {'date_to': 'soon'}, {'cursor': 'garbage'}):
+            with self.subTest(**params):
+                response, payload = self.feed(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', payload)
+
+
+# =====================
+# NOTIFICATIONS
+# =====================
+
+class NotificationOutboxTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.order = Order.objects.create(
+            address=make_address(make_user()), order_number='NT1', subtotal=Decimal('10.00')
+        )
+
+    def set_status(self, status):
+        old_status, self.order.status = self.order.status, status
+        self.order.save()
+        return notifications.queue_order_status_email(self.order, old_status)
+
+    def test_requeued_event_is_stored_once(self):
+        first = notifications.queue_admin_notification(self.order)
+        self.assertEqual(notifications.queue_admin_notification(self.order), first)
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_every_status_transition_gets_its_email(self):
+        self.set_status('C')
+        self.set_status('P')
+        confirmed_again = self.set_status('C')
+        self.assertEqual(notifications.queue_order_status_email(self.order, 'P'), confirmed_again)
+        self.assertEqual(
+            [n.payload['old_status'] for n in NotificationOutbox.objects.order_by('pk')], ['P', 'C', 'P']
+        )
+
+    def test_claimed_rows_are_leased_until_the_claim_runs_out(self):
+        for event in ('admin_new_order', 'order_confirmation'):
+            NotificationOutbox.enqueue(self.order, event)
+        self.assertEqual(len(notifications.claim_batch(10)), 2)
+        self.assertEqual(notifications.claim_batch(10), [])
+
+        NotificationOutbox.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(notifications.claim_batch(1)), 1)
+
+    def test_row_reclaimed_after_its_lease_ran_out_is_not_sent(self):
+        notifications.queue_admin_notification(self.order)
+        [notification] = notifications.claim_batch(10)
+        self.assertTrue(notifications.renew_lease(notification))
+
+        # Our lease lapsed and another worker claimed the row
+        NotificationOutbox.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        notifications.claim_batch(10)
+        self.assertFalse(notifications.renew_lease(notification))
+        with mock.patch('firstapp.notifications.claim_batch', return_value=[notification]):
+            self.assertEqual(notifications.process_batch(), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_failed_send_backs_off_then_gives_up(self):
+        notification = notifications.queue_admin_notification(self.order)
+        delays = []
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=OSError('smtp down')):
+            for _ in range(notifications.MAX_ATTEMPTS):
+                started = timezone.now()
+                self.assertEqual(notifications.process_batch(), (0, 1))
+                notification.refresh_from_db()
+                delays.append(round((notification.next_attempt_at - started).total_seconds()))
+                NotificationOutbox.objects.update(next_attempt_at=timezone.now())
+
+        self.assertEqual(delays[:-1], [30, 60, 120, 240])
+        self.assertEqual((notification.status, notification.attempts, notification.last_error),
+                         ('F', notifications.MAX_ATTEMPTS, 'smtp down'))
+        self.assertEqual(notifications.process_batch(), (0, 0))
+
+    def test_process_batch_sends_due_rows_once(self):
+        other = Order.objects.create(address=self.order.address, order_number='NT2', subtotal=Decimal('20.00'))
+        notifications.queue_admin_notification(self.order)
+        notifications.queue_admin_notification(other)
+        self.set_status('C')
+        later = NotificationOutbox.enqueue(other, 'order_confirmation')
+        NotificationOutbox.objects.filter(pk=later.pk).update(next_attempt_at=timezone.now() + timedelta(hours=1))
+
+        self.assertEqual(notifications.process_batch(), (3, 0))
+        self.assertEqual(notifications.process_batch(), (0, 0))
+        self.assertEqual(sorted(message.subject for message in mail.outbox), [
+            'Order Status Update - #NT1', '🛒 New Order - #NT1', '🛒 New Order - #NT2',
+        ])
+        self.assertEqual(NotificationOutbox.objects.filter(status='S').count(), 3)
+
+
+@unittest.skipUnless(concurrent_writes_supported(), 'needs a database that takes concurrent writers')
+class ConcurrentNotificationClaimTests(TransactionTestCase):
+
+    def test_workers_never_claim_the_same_row(self):
+        address = make_address(make_user())
+        for i in range(20):
+            order = Order.objects.create(address=address, order_number=f'NC{i}', subtotal=Decimal('10.00'))
+            notifications.queue_admin_notification(order)
+
+        results = run_concurrently(lambda i: [n.pk for n in notifications.claim_batch(5)], 6)
+        claimed = [pk for result, _ in results for pk in result]
+        self.assertEqual(len(claimed), 20)
+        self.assertEqual(len(set(claimed)), 20)
+
+
+@override_settings(AWS_SNS_TOPIC_ARN='arn:aws:sns:ap-southeast-1:000000000000:orders')
+class SNSEmailBackendTests(SimpleTestCase):
+
+    def send(self, count, fail_silently=False, **stub):
+        sns = FakeSNS(**stub)
+        messages = [EmailMessage(f'm{i}', 'body', 'shop@example.com', ['a@example.com']) for i in range(count)]
+        with mock.patch('firstapp.email_backends.get_sns_client', return_value=sns):
+            backend = SNSEmailBackend(fail_silently=fail_silently)
+            try:
+                return sns, messages, backend, backend.send_messages(messages)
+            except SNSPublishError as e:
+                return sns, messages, backend, e
+
+    def test_messages_go_out_in_batches_of_ten(self):
+        sns, _, _, sent = self.send(23)
+        self.assertEqual(sent, 23)
+        self.assertEqual(sorted(len(batch) for batch in sns.batches), [3, 10, 10])
+        self.assertEqual(sorted(s for batch in sns.batches for s in batch), sorted(f'm{i}' for i in range(23)))
+
+    def test_rejected_entries_are_reported_per_message(self):
+        _, messages, backend, error = self.send(12, reject={'m3', 'm11'})
+        self.assertIsInstance(error, SNSPublishError)
+        self.assertEqual(error.messages, [messages[3], messages[11]])
+        self.assertEqual(error.sent, 10)
+        self.assertEqual(backend.failures, [(messages[3], 'rejected'), (messages[11], 'rejected')])
+
+    def test_failed_batch_raises_only_its_own_messages(self):
+        sns, messages, _, error = self.send(25, down={'m12'})
+        self.assertEqual(error.messages, messages[10:20])  # the whole batch never reached SNS
+        self.assertEqual(error.sent, 15)
+        self.assertEqual(sum(len(batch) for batch in sns.batches), 15)
+
+    def test_fail_silently_returns_the_sent_count(self):
+        _, messages, backend, sent = self.send(5, fail_silently=True, reject={'m0'})
+        self.assertEqual(sent, 4)
+        self.assertEqual(backend.failures, [(messages[0], 'rejected')])
+
+
+# =====================
+# CHECKOUT
+# =====================
+
+@tag('benchmark')
+@unittest.skipUnless(concurrent_writes_supported(), 'needs a database that takes concurrent writers')
+class ConcurrentCheckoutBenchmark(TransactionTestCase):
+    """200 shoppers check out the last units of one product at the same moment"""
+
+    SHOPPERS = 200
+    STOCK = 150
+
+    def test_hot_product_is_never_oversold(self):
+        category = make_category()
+        hot = make_product(category, name='Limited truffle', stock=self.STOCK)
+        shoppers = []
+        for i in range(self.SHOPPERS):
+            user = make_user(f'shopper{i}')
+            cart = Cart.objects.create(user=user)
+            CartItem.objects.create(cart=cart, product=hot, quantity=1)
+            shoppers.append((user, cart, make_address(user)))
+
+        started = time.perf_counter()
+        results = run_concurrently(lambda i: place_order(*shoppers[i]), self.SHOPPERS)
+        elapsed = time.perf_counter() - started
+
+        placed = [result for result, _ in results if isinstance(result, tuple)]
+        refused = [result for result, _ in results if isinstance(result, OutOfStockError)]
+        self.assertEqual(len(placed) + len(refused), self.SHOPPERS, [r for r, _ in results])
+        self.assertEqual(len(placed), self.STOCK)
+        self.assertEqual(Order.objects.count(), self.STOCK)
+        hot.refresh_from_db()
+        self.assertEqual((hot.stock, hot.status), (0, 2))
+        print(f'\n{self.SHOPPERS} concurrent checkouts on {connection.vendor}: {elapsed:.2f}s total, '
+              f'{latency_summary([seconds for _, seconds in results])}')
+
+
+# =====================
+# SESSION USER
+# =====================
+
+class PrivilegedAccessTests(ShopTestCase):
+    """Role checks follow the User row, not the session snapshot taken at login"""
+
+    def test_revoked_driver_role_takes_effect_immediately(self):
+        driver = make_user('dave', role='D')
+        self.login(driver)
+        self.assertEqual(self.client.get('/api/driver/orders/').status_code, 200)
+        self.assertEqual(self.client.get('/driver/').status_code, 200)
+
+        driver.role = 'M'
+        driver.save()
+        self.assertEqual(self.client.get('/api/driver/orders/').status_code, 401)
+        self.assertRedirects(self.client.get('/driver/'), '/', fetch_redirect_response=False)
+
+    def test_deleted_user_loses_access(self):
+        driver = make_user('dave', role='D')
+        self.login(driver)
+        self.assertEqual(self.client.get('/api/driver/orders/').status_code, 200)
+
+        driver.delete()
+        self.assertEqual(self.client.get('/api/driver/orders/').status_code, 401)
+
+
+class SessionUserCacheTests(ShopTestCase):
+    """USERS holds what the session user needs, never the password hash"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user(password=hashlib.sha256(b'old secret').hexdigest())
+        self.login(self.user)
+
+    def test_password_hash_is_not_cached(self):
+        self.client.get('/orders/history/')
+        cached = USERS.get(self.user.pk)
+        self.assertIsNotNone(cached)
+        self.assertNotIn(self.user.password, cached)
+
+        with self.assertNumQueries(0):
+            session_user = get_session_user(SimpleNamespace(session={'user_id': self.user.pk}))
+        self.assertEqual((session_user.name, session_user.role), ('alice', 'M'))
+        self.assertEqual(session_user.get_deferred_fields(), {'password'})
+
+    def test_password_change_reads_and_writes_the_stored_hash(self):
+        self.client.get('/orders/history/')  # session user now comes from USERS
+        response = self.client.post('/password/change/', {
+            'current_password': 'old secret', 'new_password': 'new secret',
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, hashlib.sha256(b'new secret').hexdigest())
+        self.assertIsNone(USERS.get(self.user.pk))  # dropped by the save
+
+
+@tag('benchmark')
+class SessionEngineBenchmark(ShopTestCase):
+    """p50/p99 of /products/ and /cart/ under each SESSION_MODE engine"""
+
+    REQUESTS = 200
+    ENGINES = {
+        'db': 'django.contrib.sessions.backends.db',
+        'cached_db': 'firstapp.sessions.cached_db',
+        'signed_cookies': 'firstapp.sessions.signed_cookies',
+    }
+
+    def setUp(self):
+        super().setUp()
+        category = make_category()
+        for i in range(30):
+            make_product(category, name=f'Truffle {i}')
+        make_user(password=hashlib.sha256(b'secret').hexdigest())
+
+    def test_logged_in_pages_per_session_engine(self):
+        report = []
+        for mode, engine in self.ENGINES.items():
+            with self.subTest(mode), override_settings(SESSION_ENGINE=engine):
+                self.client = self.client_class()
+                self.client.post('/login/', {'email': 'alice@example.com', 'password': 'secret'})
+                for url in ('/products/', '/cart/'):
+                    self.client.get(url)  # warm the page caches
+                    timings, session_queries = [], 0
+                    for _ in range(self.REQUESTS):
+                        with CaptureQueriesContext(connection) as queries:
+                            started = time.perf_counter()
+                            response = self.client.get(url)
+                            timings.append(time.perf_counter() - started)
+                        self.assertEqual(response.status_code, 200)
+                        session_queries += sum('django_session' in query['sql'] for query in queries)
+                    if mode != 'db':
+                        # Sessions are read from the cache/cookie and unchanged ones never written
+                        self.assertEqual(session_queries, 0, (mode, url))
+                    report.append(f'{mode:<15} {url:<11} {latency_summary(timings)} '
+                                  f'session queries/request={session_queries / self.REQUESTS:.2f}')
+        print('\n' + '\n'.join(report))
+
+
+# =====================
+# SEARCH
+# =====================
+
+class InMemorySearchTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = make_category()
+
+    def test_result_cap_applies_after_the_queryset_filters(self):
+        for i in range(5):
+            inactive = make_product(self.category, name=f'Hazelnut hazelnut praline {i}')
+            Product.objects.filter(pk=inactive.pk).update(status=0)
+        active = make_product(self.category, name='Hazelnut bar')
+
+        with mock.patch('firstapp.search.MAX_RESULTS', 3):
+            found = InMemorySearchBackend().filter(Product.objects.filter(status=1), 'hazelnut')
+        self.assertEqual([product.pk for product in found], [active.pk])
+
+        response = self.client.get('/api/products/', {'search': 'hazel'})
+        self.assertEqual([product['name'] for product in response.json()['products']], ['Hazelnut bar'])
+
+    def test_other_workers_see_committed_changes(self):
+        saving_worker = get_search_backend()
+        other_worker = InMemorySearchBackend()
+        self.assertEqual(saving_worker.ranked_ids('pistachio'), [])
+        self.assertEqual(other_worker.ranked_ids('pistachio'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product = make_product(self.category, name='Pistachio bark')
+
+        self.assertEqual(saving_worker._version, SEARCH_INDEX.version())  # updated in place, no rebuild
+        self.assertEqual(saving_worker.ranked_ids('pistachio'), [product.pk])
+        self.assertEqual(other_worker.ranked_ids('pistachio'), [product.pk])
+
+    def test_rolled_back_changes_are_not_indexed(self):
+        backend = get_search_backend()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    make_product(self.category, name='Matcha square')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(backend.ranked_ids('matcha'), [])
+
+
+    def test_short_prefix_keeps_the_most_common_terms_and_says_so(self):
+        common = make_product(self.category, name='Caramel crunch')
+        make_product(self.category, name='Caramel bar')
+        for i in range(4):
+            make_product(self.category, name=f'Ca{i}rob')  # rare terms that sort before "caramel"
+
+        with mock.patch('firstapp.search.MAX_PREFIX_EXPANSION', 2):
+            self.assertIn(common.pk, get_search_backend().ranked_ids('ca'))
+            response = self.client.get('/api/products/', {'search': 'ca'})
+            self.assertTrue(response.json()['search_truncated'])
+            self.assertFalse(self.client.get('/api/products/', {'search': 'caram'}).json()['search_truncated'])
+
+    def test_cached_short_prefix_sees_new_products(self):
+        for i in range(3):
+            make_product(self.category, name=f'Ca{i}rob')
+        backend = get_search_backend()
+        with mock.patch('firstapp.search.MAX_PREFIX_EXPANSION', 2):
+            backend.ranked_ids('ca')  # capped, so cached
+            added = make_product(self.category, name='Ca0rob deluxe')
+            SEARCH_INDEX.invalidate()
+            self.assertIn(added.pk, backend.ranked_ids('ca'))
+
+
+@tag('benchmark')
+class TypeaheadLatencyBenchmark(SimpleTestCase):
+    """In-memory typeahead over 100k synthetic products (the request's budget: under 10 ms)"""
+
+    PRODUCTS = 100_000
+    BUDGET_MS = 10
+
+    def test_typeahead_latency(self):
+        rnd = random.Random(1)
+        syllables = ['ca', 'ra', 'mel', 'co', 'coa', 'hazel', 'nut', 'pra', 'line', 'truf', 'fle', 'min', 'dark',
+                     'milk', 'or', 'ange', 'sea', 'salt', 'al', 'mond', 'ber', 'ry', 'chi', 'li', 'van', 'il', 'la',
+                     'pis', 'ta', 'cho', 'mat', 'gin', 'ger', 'rum', 'rai', 'sin', 'cof', 'fee', 'mint', 'ho', 'ney']
+        words = sorted({''.join(rnd.sample(syllables, rnd.randint(2, 4))) for _ in range(25000)})
+
+        backend = InMemorySearchBackend()
+        backend._postings, backend._terms, backend._doc_terms = {}, [], {}
+        for product_id in range(self.PRODUCTS):
+            backend._add(product_id, {
+                'name': ' '.join(rnd.sample(words, 3)),
+                'short_description': ' '.join(rnd.sample(words, 5)),
+                'description': ' '.join(rnd.sample(words, 12)),
+                'ingredients': ' '.join(rnd.sample(words, 4)),
+                'category': 'Dark Chocolate',
+            })
+        queries = {
+            length: [word[:length] for word in rnd.sample(words, 100)] for length in (2, 3, 5)
+        }
+        queries['two words'] = [f'{a} {b[:3]}' for a, b in zip(rnd.sample(words, 100), rnd.sample(words, 100))]
+
+        report, medians = [], []
+        # A full collection walks the whole index; keep it out of the numbers like a warmed-up worker would
+        gc.collect()
+        gc.freeze()
+        self.addCleanup(gc.unfreeze)
+        with mock.patch.object(backend, '_ensure_built'):
+            # Typeahead asks for what the catalog page can show, like filter() does
+            for label, batch in queries.items():
+                timings = []
+                for query in batch:
+                    started = time.perf_counter()
+                    backend.ranked_ids(query, limit=search.MAX_RESULTS + 1)
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                medians.append(timings[len(timings) // 2] * 1000)
+                report.append(f'  {label}: {latency_summary(timings)}')
+        print(f'\ntypeahead over {self.PRODUCTS} products ({len(words)} distinct words)\n' + '\n'.join(report))
+        for median in medians:
+            self.assertLess(median, self.BUDGET_MS)
+
+# =====================
+# STRIPE WEBHOOKS
+# =====================
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.customer = make_user()
+        Member.objects.create(user=self.customer)
+        order = Order.objects.create(address=make_address(self.customer), order_number='WH1', subtotal=Decimal('200.00'))
+        self.payment = Payment.objects.create(order=order, total_amount=Decimal('200.00'), method='ST')
+
+    def deliver(self, event, secret='whsec_test'):
+        body, signature = stripe_delivery(event, secret)
+        return self.client.post('/payment/stripe/webhook/', body, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=signature)
+
+    def test_redelivered_event_is_stored_and_applied_once(self):
+        event = checkout_completed('evt_1', self.payment)
+        self.assertEqual(self.deliver(event).status_code, 200)
+        self.assertEqual(self.deliver(event).status_code, 200)
+        self.assertEqual(self.deliver(event, secret='whsec_other').status_code, 400)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+        self.assertEqual(webhooks.process_batch(), {'D': 1})
+        self.assertEqual(webhooks.process_batch(), {})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'S')
+        self.assertEqual(Member.objects.get(pk=self.customer.pk).loyalty_points, Decimal('2.00'))
+
+    def test_failed_event_counts_as_retry_until_attempts_run_out(self):
+        webhooks.store_event(checkout_completed('evt_1', self.payment))
+        with mock.patch.dict(webhooks.HANDLERS, {'checkout.session.completed': mock.Mock(side_effect=RuntimeError('boom'))}):
+            self.assertEqual(webhooks.process_batch(), {webhooks.RETRY: 1})
+            event = StripeEvent.objects.get()
+            self.assertEqual((event.status, event.attempts, event.last_error), ('P', 1, 'boom'))
+            self.assertEqual(webhooks.process_batch(), {})  # not due yet
+
+            StripeEvent.objects.update(attempts=webhooks.MAX_ATTEMPTS - 1, next_attempt_at=timezone.now())
+            self.assertEqual(webhooks.process_batch(), {'F': 1})
+        self.assertEqual(StripeEvent.objects.get().status, 'F')
+        self.assertEqual(webhooks.format_counts({'D': 2, webhooks.RETRY: 1}), 'Processed: 2, Retry later: 1')
+
+
+@tag('benchmark')
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookBenchmark(ShopTestCase):
+    """Signed checkout.session.completed deliveries (a third of them redelivered) in, then processed"""
+
+    PAYMENTS = 300
+
+    def test_webhook_throughput(self):
+        customer = make_user()
+        Member.objects.create(user=customer)
+        address = make_address(customer)
+        events_ = []
+        for i in range(self.PAYMENTS):
+            order = Order.objects.create(address=address, order_number=f'WH{i}', subtotal=Decimal('100.00'))
+            payment = Payment.objects.create(order=order, total_amount=Decimal('100.00'), method='ST')
+            events_.append(checkout_completed(f'evt_{i}', payment))
+        deliveries = [stripe_delivery(event) for event in events_ + events_[::3]]
+
+        started = time.perf_counter()
+        for body, signature in deliveries:
+            response = self.client.post('/payment/stripe/webhook/', body, content_type='application/json',
+                                        HTTP_STRIPE_SIGNATURE=signature)
+            self.assertEqual(response.status_code, 200)
+        ingested = time.perf_counter() - started
+        self.assertEqual(StripeEvent.objects.count(), self.PAYMENTS)
+
+        started = time.perf_counter()
+        counts = {}
+        while batch := webhooks.process_batch():
+            for status, count in batch.items():
+                counts[status] = counts.get(status, 0) + count
+        processed = time.perf_counter() - started
+
+        self.assertEqual(counts, {'D': self.PAYMENTS})
+        self.assertEqual(Member.objects.get(pk=customer.pk).loyalty_points, Decimal(self.PAYMENTS))
+        self.assertEqual(NotificationOutbox.objects.filter(event='order_confirmation').count(), self.PAYMENTS)
+        print(f'\n{len(deliveries)} signed deliveries on {connection.vendor}: '
+              f'ingested {len(deliveries) / ingested:.0f}/s, {self.PAYMENTS} events processed '
+              f'{self.PAYMENTS / processed:.0f}/s')
+
+
+# =====================
+# PAYMENT PROVIDERS
+# =====================
+
+class PaymentClientTests(SimpleTestCase):
+
+    def test_loop_clients_are_closed_when_their_loop_ends(self):
+        closed = []
+
+        async def close(obj):
+            closed.append(obj)
+
+        clients = LoopLocal(object, close=close)
+
+        async def request():
+            first = clients.get()
+            self.assertIs(clients.get(), first)  # pooled for the whole loop
+            return first
+
+        first = asyncio.run(request())  # a WSGI request running an async view
+        second = asyncio.run(request())
+        self.assertIsNot(first, second)
+        self.assertEqual(closed, [first, second])
+        self.assertEqual(len(clients._objects), 0)
+
+    def test_provider_async_clients_are_closed_with_their_loop(self):
+        async def request():
+            stripe_payment._async_clients.get()  # a StripeClient on this loop's HTTPXClient
+            return paypal._async_clients.get(), stripe_payment._async_http_clients.get()
+
+        with override_settings(STRIPE_SECRET_KEY='sk_test_x'):
+            paypal_client, stripe_http_client = asyncio.run(request())
+        self.assertTrue(paypal_client.is_closed)
+        self.assertTrue(stripe_http_client._client_async.is_closed)
+
+    @override_settings(PAYPAL_API_BASE='http://paypal.test')
+    def test_paypal_request_id_follows_the_local_payment(self):
+        session = mock.Mock()
+        session.request.return_value = mock.Mock(status_code=201, json=lambda: {
+            'id': 'PAY-1', 'links': [{'rel': 'approval_url', 'href': 'http://paypal.test/approve'}],
+        })
+        with mock.patch.object(paypal, '_session', return_value=session), \
+                mock.patch.object(paypal, '_cached_token', return_value='token'):
+            for _ in range(2):  # a retried create
+                PaymentProcessor.process_paypal_payment(Decimal('10.00'), 'http://shop/ok', 'http://shop/cancel',
+                                                        local_payment_id=7)
+            PaymentProcessor.complete_paypal_payment('PAY-1', 'PAYER', local_payment_id=7)
+            PaymentProcessor.process_paypal_payment(Decimal('10.00'), 'http://shop/ok', 'http://shop/cancel')
+
+        request_ids = [call.kwargs['headers'].get('PayPal-Request-Id') for call in session.request.call_args_list]
+        self.assertEqual(request_ids, ['payment-7-create', 'payment-7-create', 'payment-7-execute', None])
+
+
+# =====================
+# RECONCILIATION
+# =====================
+
+class ReconciliationTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        customer = make_user()
+        Member.objects.create(user=customer)
+        address = make_address(customer)
+        self.payments = [
+            Payment.objects.create(
+                order=Order.objects.create(address=address, order_number=f'RC{i}', subtotal=Decimal('50.00')),
+                total_amount=Decimal('50.00'), method='ST',
+            )
+            for i in range(2)
+        ]
+
+    def paid(self, payment):
+        return reconciliation.Result(payment.pk, payment.order_id, 'ST', f'cs_{payment.pk}', 'complete/paid',
+                                     reconciliation.PAID, '')
+
+    def test_only_payments_it_confirmed_count_as_updated(self):
+        first, second = self.payments
+        with transaction.atomic():
+            self.assertEqual(webhooks.confirm_payment(first.pk, 'cs_webhook'), webhooks.CONFIRMED)  # webhook won
+        with transaction.atomic():
+            self.assertEqual(webhooks.confirm_payment(first.pk, 'cs_webhook'), webhooks.ALREADY_CONFIRMED)
+
+        applied = reconciliation.apply_results([self.paid(first), self.paid(second)])
+        self.assertEqual([result.payment_id for result in applied], [second.pk])
+        self.assertEqual(Payment.objects.get(pk=first.pk).transaction_id, 'cs_webhook')
+        self.assertEqual(reconciliation.apply_results([self.paid(second)]), [])
+
+
+# =====================
+# LOYALTY
+# =====================
+
+@unittest.skipUnless(concurrent_writes_supported(), 'needs a database that takes concurrent writers')
+class ConcurrentLoyaltyTests(TransactionTestCase):
+    """Many threads earning and redeeming on one member at the same moment"""
+
+    THREADS = 40
+
+    def test_no_update_is_lost_or_applied_twice(self):
+        customer = make_user()
+        member = Member.objects.create(user=customer)
+        member.add_loyalty_points(Decimal('10000.00'))  # 100 points to redeem from
+        order = Order.objects.create(address=make_address(customer), order_number='LY1', subtotal=Decimal('100.00'))
+
+        def worker(i):
+            member = Member.objects.get(pk=customer.pk)
+            if i % 4 == 0:
+                return member.redeem_points(1)
+            if i % 4 == 1:
+                return member.add_loyalty_points(Decimal('100.00'), order=order)  # once per order
+            if i == self.THREADS - 1:
+                return loyalty.rebuild_balances()  # locks the member like an earn does
+            return member.add_loyalty_points(Decimal('100.00'))
+
+        results = run_concurrently(worker, self.THREADS)
+        self.assertFalse([result for result, _ in results if isinstance(result, Exception)])
+
+        redeemed = len(range(0, self.THREADS, 4))
+        earned = len([i for i in range(self.THREADS) if i % 4 not in (0, 1) and i != self.THREADS - 1])
+        member.refresh_from_db()
+        self.assertEqual(member.loyalty_points, Decimal(100 + earned + 1 - redeemed))
+        self.assertEqual(member.total_spent, Decimal('10000.00') + (earned + 1) * Decimal('100.00'))
+        self.assertEqual(LoyaltyTransaction.objects.filter(order=order).count(), 1)
+        self.assertEqual(results[-1][0], [])  # balances matched the ledger throughout
+        self.assertEqual(loyalty.rebuild_balances(dry_run=True), [])
+
+
+class LoyaltyRebuildTests(ShopTestCase):
+
+    def test_admin_action_rebuilds_only_the_selected_members(self):
+        members = [Member.objects.create(user=make_user(name)) for name in ('alice', 'bob')]
+        for member in members:
+            member.add_loyalty_points(Decimal('500.00'))
+        Member.objects.update(loyalty_points=Decimal('99.00'))  # drifted from the ledger
+
+        member_admin = admin.site._registry[Member]
+        with mock.patch.object(member_admin, 'message_user') as message_user:
+            member_admin.rebuild_balances(None, Member.objects.filter(pk=members[0].pk))
+
+        self.assertIn('1 members corrected', message_user.call_args.args[1])
+        self.assertEqual([m.loyalty_points for m in Member.objects.order_by('pk')],
+                         [Decimal('5.00'), Decimal('99.00')])
+
+    def test_history_earns_once_per_order_like_the_ledger(self):
+        customer = make_user()
+        Member.objects.create(user=customer)
+        order = Order.objects.create(address=make_address(customer), order_number='LY1', subtotal=Decimal('120.00'))
+        for amount in ('120.00', '80.00'):  # a retried checkout that went through twice
+            Payment.objects.create(order=order, total_amount=Decimal(amount), method='ST').mark_as_paid()
+
+        member = Member.objects.get(pk=customer.pk)
+        self.assertEqual((member.loyalty_points, member.total_spent), (Decimal('1.20'), Decimal('120.00')))
+        self.assertEqual(loyalty.history_totals(customer.pk, customer.pk),
+                         {customer.pk: (Decimal('1.20'), Decimal('120.00'))})
+        self.assertEqual(loyalty.recompute_from_history(), [])
+
+    def drifted_members(self, count):
+        members = [Member.objects.create(user=make_user(f'member{i}')) for i in range(count)]
+        Member.objects.update(loyalty_points=Decimal('99.00'))  # no order history, so 0 is right
+        return members
+
+    def balances(self):
+        return [m.loyalty_points for m in Member.objects.order_by('pk')]
+
+    def test_recompute_touches_only_the_id_range(self):
+        members = self.drifted_members(3)
+        drifted = loyalty.recompute_from_history(start_id=members[1].pk, end_id=members[1].pk)
+        self.assertEqual([drift.member_id for drift in drifted], [members[1].pk])
+        self.assertEqual(self.balances(), [Decimal('99.00'), Decimal('0.00'), Decimal('99.00')])
+
+    def test_interrupted_recompute_resumes_from_the_last_committed_member(self):
+        members = self.drifted_members(3)
+        history_totals = loyalty.history_totals
+        calls = []
+
+        def fail_on_second_chunk(first_pk, last_pk):
+            calls.append(first_pk)
+            if len(calls) == 2:
+                raise RuntimeError('connection lost')
+            return history_totals(first_pk, last_pk)
+
+        err = io.StringIO()
+        with mock.patch.object(loyalty, 'history_totals', side_effect=fail_on_second_chunk):
+            with self.assertRaises(RuntimeError):
+                call_command('recompute_loyalty', '--batch-size', '1', stdout=io.StringIO(), stderr=err)
+        self.assertIn(f'resume with --start-id {members[0].pk + 1}', err.getvalue())
+        self.assertEqual(self.balances(), [Decimal('0.00'), Decimal('99.00'), Decimal('99.00')])
+
+        out = io.StringIO()
+        call_command('recompute_loyalty', '--batch-size', '1', '--start-id', str(members[0].pk + 1),
+                     '--verbosity', '2', stdout=out)
+        self.assertIn(f'Members up to id {members[2].pk} done', out.getvalue())
+        self.assertEqual(self.balances(), [Decimal('0.00')] * 3)
+        self.assertEqual(loyalty.recompute_from_history(), [])
+
+
+class PaymentLoyaltyFailureTests(ShopTestCase):
+    """A failed loyalty update leaves the payment unconfirmed, so a retry does the whole step"""
+
+    def setUp(self):
+        super().setUp()
+        self.customer = make_user()
+        Member.objects.create(user=self.customer)
+        self.order = Order.objects.create(address=make_address(self.customer), order_number='PL1',
+                                          subtotal=Decimal('100.00'))
+
+    def test_mark_as_paid_rolls_back_and_can_be_retried(self):
+        payment = Payment.objects.create(order=self.order, total_amount=Decimal('100.00'), method='ST')
+        with mock.patch.object(Member, 'add_loyalty_points', side_effect=RuntimeError('ledger down')):
+            with self.assertRaises(RuntimeError):
+                Payment.objects.get(pk=payment.pk).mark_as_paid()
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'P')
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+        Payment.objects.get(pk=payment.pk).mark_as_paid()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.loyalty_points_earned, Decimal('1.00'))
+        self.assertEqual(Member.objects.get(pk=self.customer.pk).loyalty_points, Decimal('1.00'))
+        self.assertEqual(NotificationOutbox.objects.filter(event='order_confirmation').count(), 1)
+
+    def test_cod_order_is_not_confirmed_without_its_points(self):
+        self.login(self.customer)
+        session = self.client.session
+        session.update({'pending_order_id': self.order.pk, 'pending_order_total': 100.0})
+        session.save()
+        with mock.patch.object(Member, 'add_loyalty_points', side_effect=RuntimeError('ledger down')):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/payment/process/', {'payment_method': 'COD'})
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.loyalty_points_earned), ('P', Decimal('0')))
+        self.assertFalse(self.order.payments.exclude(status='P').exists())
+
+        response = self.client.post('/payment/process/', {'payment_method': 'COD'})
+        self.assertEqual(response.status_code, 200)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.loyalty_points_earned), ('C', Decimal('1.00')))
+
+
+@tag('benchmark')
+class LoyaltyRecomputeBenchmark(TestCase):
+    """`recompute_loyalty` over every member, all of them drifted, then checked again"""
+
+    MEMBERS = 5000
+    ORDERS_PER_MEMBER = 5
+
+    def test_full_recompute(self):
+        User.objects.bulk_create(
+            User(name=f'member{i}', email=f'member{i}@example.com', role='M') for i in range(self.MEMBERS)
+        )
+        user_ids = list(User.objects.values_list('pk', flat=True))
+        Member.objects.bulk_create(Member(user_id=user_id) for user_id in user_ids)
+        Address.objects.bulk_create(
+            Address(user_id=user_id, label='Home', address='1 Jalan Coklat', city='Kuala Lumpur',
+                    state='WP', postal_code='50000', country='Malaysia')
+            for user_id in user_ids
+        )
+        Order.objects.bulk_create(
+            Order(address_id=address_id, order_number=f'LB{address_id}-{i}', subtotal=Decimal('100.00'),
+                  loyalty_points_used=Decimal(i % 2))
+            for address_id in Address.objects.values_list('pk', flat=True) for i in range(self.ORDERS_PER_MEMBER)
+        )
+        Payment.objects.bulk_create(
+            Payment(order_id=order_id, total_amount=Decimal('123.45'), method=method, status=status)
+            for order_id in Order.objects.values_list('pk', flat=True)
+            for method, status in (('ST', 'F'), ('ST', 'S'), ('ST', 'S'))  # failed, then paid twice
+        )
+
+        timings = []
+        for args in (['--check'], [], ['--check']):
+            out = io.StringIO()
+            started = time.perf_counter()
+            call_command('recompute_loyalty', *args, stdout=out)
+            timings.append(f"{' '.join(args) or 'fix':<8} {time.perf_counter() - started:.2f}s  "
+                           f"{out.getvalue().strip().splitlines()[-1]}")
+        self.assertIn('All member balances match', timings[-1])
+        self.assertEqual(loyalty.rebuild_balances(dry_run=True), [])
+        member = Member.objects.first()
+        self.assertEqual(member.total_spent, Decimal('123.45') * self.ORDERS_PER_MEMBER)
+        print(f'\n{self.MEMBERS} members on {connection.vendor}:\n' + '\n'.join(timings))
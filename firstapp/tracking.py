@@ -0,0 +1,128 @@
+"""
+Delta feed for the delivery tracking bar (/api/active-orders/)
+
+The bar polls every few seconds. Instead of re-serializing every order the
+user ever placed on each poll:
+- only the "active window" is considered: non-cancelled orders, except
+  delivered ones untouched for more than ACTIVE_ORDERS_DELIVERED_WINDOW
+- one light query reads (id, updated_at) of that window; its hash is the
+  ETag, so an unchanged window answers 304 without loading anything else
+- with ?since=<cursor> only orders changed after the cursor are serialized
+  (from one query with the item totals and delivery proof joined in),
+  together with the ids still active so the client can drop the rest
+
+Order.updated_at is bumped by Order.save() and, below, whenever the
+order's DeliveryProof changes.
+"""
+import hashlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import DeliveryProof, Order
+from .pagination import InvalidCursor, decode_cursor, encode_cursor
+
+
+# Writes commit a little after updated_at is taken (and app servers' clocks
+# drift), so deltas look back this far; re-sending an order is harmless.
+CURSOR_OVERLAP = timedelta(seconds=5)
+
+
+def _delivered_window():
+    return timedelta(hours=getattr(settings, 'ACTIVE_ORDERS_DELIVERED_WINDOW_HOURS', 72))
+
+
+def touch_order(order_id):
+    """Mark an order as changed for the delta feed without a full save()"""
+    Order.objects.filter(pk=order_id).update(updated_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=DeliveryProof)
+def _proof_changed(sender, instance, **kwargs):
+    touch_order(instance.order_id)
+
+
+# =====================
+# FEED
+# =====================
+
+def active_orders(user, now=None):
+    """The user's orders shown in the tracking bar"""
+    now = now or timezone.now()
+    return Order.objects.filter(address__user=user).exclude(status='X').exclude(
+        Q(status='D') & Q(updated_at__lt=now - _delivered_window())
+    )
+
+
+def window_state(user, now=None):
+    """(ids of active orders, ETag) from a single (id, updated_at) query"""
+    rows = list(active_orders(user, now).order_by('id').values_list('id', 'updated_at'))
+    digest = hashlib.md5(
+        ';'.join(f'{pk}:{updated_at.isoformat()}' for pk, updated_at in rows).encode()
+    ).hexdigest()
+    return [pk for pk, _ in rows], f'"{digest}"'
+
+
+def parse_since(cursor):
+    """The timestamp inside a cursor issued by get_delta()"""
+    values = decode_cursor(cursor)
+    try:
+        return datetime.fromisoformat(values[0])
+    except (IndexError, TypeError, ValueError):
+        raise InvalidCursor("Malformed cursor")
+
+
+def _time_ago(created_at, now):
+    time_diff = now - created_at
+    if time_diff.days > 0:
+        return f"{time_diff.days}d ago"
+    if time_diff.seconds // 3600 > 0:
+        return f"{time_diff.seconds // 3600}h ago"
+    return f"{time_diff.seconds // 60}m ago"
+
+
+def serialize_order(order, now):
+    """Tracking bar payload; expects Order.objects.with_summary() + delivery_proof joined"""
+    delivery_proof = None
+    delivered_at = None
+    proof = getattr(order, 'delivery_proof', None)
+    if proof:
+        if proof.image:
+            delivery_proof = proof.image.url
+        if proof.uploaded_at:
+            delivered_at = timezone.localtime(proof.uploaded_at).strftime('%b %d, %I:%M %p')
+
+    return {
+        'id': str(order.id),
+        'order_number': order.order_number,
+        'status': order.status,
+        'total_items': order.total_items,
+        'total': str(order.subtotal),
+        'created_at': order.created_at.isoformat(),
+        'time_ago': _time_ago(order.created_at, now),
+        'delivery_proof': delivery_proof,
+        'delivered_at': delivered_at,
+    }
+
+
+def get_delta(user, active_ids, since=None, now=None):
+    """
+    Payload for one poll: orders changed after `since` (all active orders
+    when since is None), the ids still active and the next cursor
+    """
+    now = now or timezone.now()
+    changed = Order.objects.filter(pk__in=active_ids)
+    if since is not None:
+        changed = changed.filter(updated_at__gte=since - CURSOR_OVERLAP)
+    changed = changed.with_summary().select_related('delivery_proof').order_by('-created_at')
+
+    return {
+        'orders': [serialize_order(order, now) for order in changed],
+        'active_ids': [str(pk) for pk in active_ids],
+        'cursor': encode_cursor([now]),
+        'full': since is None,
+    }
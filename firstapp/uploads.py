@@ -0,0 +1,237 @@
+"""
+Resumable, chunked delivery-proof uploads
+
+Drivers on mobile networks upload the photo in chunks:
+1. start_upload() creates a ProofUpload row (the upload id)
+2. each chunk is a raw PUT with a Content-Range header; the body is streamed
+   straight into a partial file in media storage, so nothing is buffered in
+   memory or copied through FILE_UPLOAD_TEMP_DIR first
+3. after a dropped connection the client asks for received_size and resumes
+   from there
+4. the last chunk publishes the partial file as
+   delivery_proofs/<upload id><ext> and, in one transaction, saves the
+   DeliveryProof, marks the order delivered and queues the customer email.
+   Recompression/downscaling and variants are done afterwards by the
+   firstapp.images worker pool.
+
+Chunks are written at their offset and the offset only advances with a
+conditional UPDATE, so a retried chunk is harmless. Completing is safe to
+retry too: the published name depends only on the upload, so a completion
+whose transaction rolled back after the file was moved finds it in place.
+
+Partial files are appended to in place, so they live in a local (or EFS)
+directory, DELIVERY_PROOF_PARTIAL_ROOT, whatever the media storage is.
+Uploads left unfinished for DELIVERY_PROOF_UPLOAD_EXPIRY_HOURS are removed
+by `manage.py expire_proof_uploads`.
+"""
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .models import DeliveryProof, Order, ProofUpload
+from .notifications import queue_order_status_email
+
+
+PARTIAL_DIR = 'uploads/partial'
+READ_BLOCK_SIZE = 64 * 1024
+CHUNK_SIZE = 512 * 1024  # suggested to clients
+
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic')
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    """Upload request rejected; message is safe to return to the client"""
+
+    def __init__(self, message, status=400):
+        self.status = status
+        super().__init__(message)
+
+
+def _max_size():
+    return getattr(settings, 'DELIVERY_PROOF_MAX_UPLOAD_SIZE', 25 * 1024 * 1024)
+
+
+def _expiry():
+    return timedelta(hours=getattr(settings, 'DELIVERY_PROOF_UPLOAD_EXPIRY_HOURS', 24))
+
+
+def partial_path(upload):
+    root = getattr(settings, 'DELIVERY_PROOF_PARTIAL_ROOT', os.path.join(settings.MEDIA_ROOT, PARTIAL_DIR))
+    return os.path.join(root, f'{upload.id}.part')
+
+
+def proof_name(upload):
+    """Storage name the finished upload is published under (unique per upload)"""
+    extension = os.path.splitext(upload.filename)[1].lower()
+    return f'delivery_proofs/{upload.id}{extension}'
+
+
+def start_upload(order, driver, filename, total_size):
+    """Create the upload and its empty partial file"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise UploadError('Unsupported image type')
+    if total_size <= 0 or total_size > _max_size():
+        raise UploadError(f'Image must be between 1 byte and {_max_size() // (1024 * 1024)}MB')
+
+    upload = ProofUpload.objects.create(
+        order=order, driver=driver, filename=os.path.basename(filename), total_size=total_size
+    )
+    path = partial_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+def parse_content_range(header, total_size):
+    """(start, length) from 'bytes start-end/total'"""
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        raise UploadError('Missing or invalid Content-Range header')
+    start, end, total = (int(value) for value in match.groups())
+    if total != total_size or end < start or end >= total:
+        raise UploadError('Content-Range does not match the upload')
+    return start, end - start + 1
+
+
+def write_chunk(upload, stream, content_range):
+    """
+    Stream one chunk from `stream` into the partial file.
+    Returns the upload with received_size advanced (and completed on the last chunk).
+    """
+    if upload.is_complete():
+        return upload
+
+    start, length = parse_content_range(content_range, upload.total_size)
+    if start > upload.received_size:
+        raise UploadError(f'Expected offset {upload.received_size}', status=409)
+
+    written = 0
+    try:
+        partial = open(partial_path(upload), 'r+b')
+    except FileNotFoundError:
+        raise UploadError('Upload expired; start a new one', status=410)
+    with partial:
+        partial.seek(start)
+        while written < length:
+            block = stream.read(min(READ_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            partial.write(block)
+            written += len(block)
+    if written != length:
+        raise UploadError('Chunk body shorter than Content-Range; resume from received_size')
+
+    # Advance only past bytes we now have (retries of old chunks don't move it back)
+    end = start + length
+    if end > upload.received_size:
+        ProofUpload.objects.filter(
+            pk=upload.pk, received_size__lt=end, status='U'
+        ).update(received_size=end, updated_at=timezone.now())
+    upload.refresh_from_db(fields=['received_size', 'status'])
+
+    if upload.received_size == upload.total_size and not upload.is_complete():
+        upload = complete_upload(upload)
+    return upload
+
+
+def complete_upload(upload):
+    """Publish the finished file as the order's DeliveryProof and mark the order delivered"""
+    with transaction.atomic():
+        # Row lock so two racing "last chunk" requests complete once
+        upload = ProofUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.is_complete():
+            return upload
+
+        name = proof_name(upload)
+        _publish(upload, name)
+
+        proof = DeliveryProof.objects.filter(order_id=upload.order_id).first() or DeliveryProof(
+            order_id=upload.order_id
+        )
+        proof.driver_id = upload.driver_id
+        proof.image.name = name
+        proof.uploaded_at = timezone.now()
+        proof.save()  # post_save queues recompression + variants on commit
+
+        order = Order.objects.select_for_update().get(pk=upload.order_id)
+        if order.status != 'D':
+            old_status = order.status
+            order.status = 'D'
+            order.save()
+            queue_order_status_email(order, old_status)
+
+        upload.status = 'C'
+        upload.save(update_fields=['status', 'updated_at'])
+    return upload
+
+
+def _publish(upload, name):
+    """
+    Move the finished partial file to `name` in media storage.
+    Idempotent: if the partial is gone but `name` exists, an earlier attempt
+    already moved it (and its transaction rolled back).
+    """
+    partial = partial_path(upload)
+    if not os.path.exists(partial):
+        if default_storage.exists(name):
+            return
+        raise UploadError('Upload expired; start a new one', status=410)
+
+    try:
+        target = default_storage.path(name)
+    except NotImplementedError:
+        # Remote storage (S3, ...): stream the file up, then drop the partial
+        if not default_storage.exists(name):
+            with open(partial, 'rb') as f:
+                default_storage.save(name, File(f))
+        os.remove(partial)
+        return
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Same filesystem: a rename, not another copy of the bytes
+    os.replace(partial, target)
+
+
+def expire_stale_uploads(now=None, dry_run=False):
+    """
+    Delete uploads not completed within the expiry window, with their
+    partial file (and the published file if completing never committed).
+    Returns the expired uploads.
+    """
+    now = now or timezone.now()
+    stale = list(ProofUpload.objects.filter(status='U', updated_at__lt=now - _expiry()))
+    if dry_run:
+        return stale
+
+    expired = []
+    for upload in stale:
+        with transaction.atomic():
+            # Skip uploads that a late chunk completed or advanced meanwhile
+            deleted, _ = ProofUpload.objects.filter(
+                pk=upload.pk, status='U', updated_at=upload.updated_at
+            ).delete()
+            if not deleted:
+                continue
+            name = proof_name(upload)
+            if not DeliveryProof.objects.filter(image=name).exists():
+                transaction.on_commit(lambda name=name: default_storage.delete(name))
+            partial = partial_path(upload)
+            transaction.on_commit(lambda partial=partial: _remove(partial))
+        expired.append(upload)
+    return expired
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
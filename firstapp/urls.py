@@ -15,6 +15,7 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('products/', views.products, name='products'),
     path('products/<int:product_id>/', views.product_detail, name='product_detail'),
+    path('api/products/', views.products_api, name='products_api'),
     
     # =====================
     # AUTHENTICATION
@@ -81,12 +82,17 @@ urlpatterns = [
     # ADMIN - SIMPLIFIED
     # =====================
     path('secure/admin/analytics/', views.analytics_dashboard, name='analytics_dashboard'),
+    path('secure/admin/analytics/refresh/', views.refresh_analytics, name='refresh_analytics'),
+    path('secure/admin/analytics/export/', views.export_sales, name='export_sales'),
 
     path('api/active-orders/', views.get_active_orders),
+    path('api/events/', views.order_events, name='order_events'),
     path('driver/', views.driver_dashboard, name='driver_dashboard'),
     path('api/driver/orders/', views.get_driver_orders),
     path('api/driver/update-status/', views.update_order_status),
     path('api/driver/upload-proof/', views.upload_delivery_proof),
+    path('api/driver/proof-uploads/', views.start_proof_upload),
+    path('api/driver/proof-uploads/<uuid:upload_id>/', views.proof_upload_chunk),
 ]
 
 # Static and media files
@@ -1,58 +1,76 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST, require_http_methods
 from django.utils import timezone
-from django.db.models import Sum, Count, Avg, F, Q
-from django.db.models.functions import TruncDate, TruncMonth
+from django.db import transaction
+from django.db.models.functions import TruncMonth
 from decimal import Decimal
 import hashlib
 import secrets
 from datetime import datetime, timedelta
 import json
+import logging
 import uuid
-import paypalrestsdk
 import stripe
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
-from django.db.models import Q
 from social_django.utils import load_strategy, load_backend
 from social_core.exceptions import MissingBackend
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
-import boto3
 from PIL import Image
 import io
 
 
 from .models import (
     User, Member, Address, Product, ProductCategory,
-    Cart, CartItem, Order, OrderItem, Payment, PasswordResetToken, DeliveryProof
+    Cart, CartItem, Order, Payment, PasswordResetToken, DeliveryProof, ProofUpload,
+    product_images_prefetch
 )
+from .analytics import get_snapshot, normalize_period, request_refresh
+from .caching import CATALOG, CATEGORIES
+from .checkout import CheckoutError, place_order
+from .events import DRIVERS_CHANNEL, event_stream, user_channel
+from .exports import DEFAULT_CHUNK_SIZE as EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportError, parse_filters, sales_queryset
+from .notifications import queue_order_status_email
+from .middleware import clear_session_user, get_session_user, set_session_user
+from .payment.payment_processor import PaymentProcessor
+from .payment.transport import PaymentUnavailable
+from .pagination import InvalidCursor, get_page_size, keyset_paginate
+from .uploads import CHUNK_SIZE as UPLOAD_CHUNK_SIZE, UploadError, start_upload, write_chunk
+from .search import get_search_backend, search_products
+from .tracking import get_delta, parse_since, window_state
+from .webhooks import store_event
+
+
+logger = logging.getLogger(__name__)
+
 
 def health(request):
     return HttpResponse("ok")
 
-# Configure PayPal
-paypalrestsdk.configure({
-    "mode": settings.PAYPAL_MODE,  # "sandbox" or "live"
-    "client_id": settings.PAYPAL_CLIENT_ID,
-    "client_secret": settings.PAYPAL_CLIENT_SECRET
-})
-# Configure Stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
 
 # =====================
 # PUBLIC VIEWS
 # =====================
 
+def get_categories():
+    """All product categories (shared cache, invalidated on category changes)"""
+    return CATEGORIES.get_or_set('all', lambda: list(ProductCategory.objects.all()))
+
+
 def home(request):
     """Home page with featured products"""
-    featured_products = Product.objects.filter(status=1)[:8]
-    categories = ProductCategory.objects.all()
+    featured_products = CATALOG.get_or_set(
+        'home:featured', lambda: list(Product.objects.filter(status=1).with_images()[:8])
+    )
+    categories = get_categories()
     
     context = {
         'featured_products': featured_products,
@@ -61,10 +79,18 @@ def home(request):
     return render(request, 'index.html', context)
 
 
-def products(request):
-    # Get filter parameters
+# Sort parameter -> keyset ordering (last field must be unique)
+PRODUCT_SORT_ORDERINGS = {
+    'price_low': ['price', 'id'],
+    'price_high': ['-price', '-id'],
+    'name': ['name', 'id'],
+    'newest': ['-created_at', '-id'],
+}
+
+
+def _filter_products(request):
+    """Apply the category/search filters shared by the catalog page and API"""
     category_code = request.GET.get('category', '')
-    sort_by = request.GET.get('sort', '')
     search_query = request.GET.get('search', '')
     
     # Get all ACTIVE products (status=1 means Active)
@@ -74,53 +100,41 @@ def products(request):
     if category_code:
         products = products.filter(category__code=category_code)
     
-    # Filter by search
+    # Filter by search (full-text index, annotates search_rank)
     if search_query:
-        products = products.filter(
-            Q(name__icontains=search_query) | 
-            Q(description__icontains=search_query) |
-            Q(category__name__icontains=search_query)
-        )
+        products = search_products(products, search_query)
     
-    # Sort products
-    if sort_by == 'price_low':
-        products = products.order_by('price')
-    elif sort_by == 'price_high':
-        products = products.order_by('-price')
-    elif sort_by == 'name':
-        products = products.order_by('name')
-    elif sort_by == 'newest':
-        products = products.order_by('-created_at')
-    else:
-        products = products.order_by('name')  # Default
+    return products
+
+
+def _product_ordering(request):
+    """Keyset ordering for the requested sort; search results default to relevance"""
+    sort_by = request.GET.get('sort', '')
+    if sort_by in PRODUCT_SORT_ORDERINGS:
+        return PRODUCT_SORT_ORDERINGS[sort_by]
+    if request.GET.get('search', ''):
+        return ['-search_rank', '-id']
+    return PRODUCT_SORT_ORDERINGS['name']
+
+
+def products(request):
+    # Get filter parameters
+    category_code = request.GET.get('category', '')
+    sort_by = request.GET.get('sort', '')
+    search_query = request.GET.get('search', '')
     
-    # Check if AJAX request
+    # AJAX requests are served by the paginated catalog API
     is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-    
     if is_ajax:
-        # Return JSON for AJAX requests
-        products_data = []
-        for product in products:
-            # Get all product images
-            images = [img.image.url for img in product.get_all_images()]
-            
-            products_data.append({
-                'id': str(product.id),
-                'name': product.name,
-                'description': product.description,
-                'price': str(product.price),
-                'stock': product.stock,
-                'category': product.category.name,
-                'images': images
-            })
-        
-        return JsonResponse({
-            'products': products_data,
-            'count': len(products_data)
-        })
+        return products_api(request)
+    
+    products = _filter_products(request)
+    
+    # Sort products (images prefetched for get_primary_image/get_all_images)
+    products = products.order_by(*_product_ordering(request)).select_related('category').with_images()
     
     # Normal page request - return HTML
-    categories = ProductCategory.objects.all()
+    categories = get_categories()
     
     context = {
         'products': products,
@@ -133,13 +147,64 @@ def products(request):
     return render(request, 'product/products.html', context)
 
 
+def products_api(request):
+    """
+    Paginated catalog JSON API
+    
+    Uses keyset pagination (?cursor=&limit=) and loads categories and images
+    in bulk, so every page costs 2 queries whatever its size.
+    """
+    ordering = _product_ordering(request)
+    
+    products = _filter_products(request).select_related('category').with_images()
+    
+    try:
+        page, next_cursor = keyset_paginate(
+            products,
+            ordering,
+            cursor=request.GET.get('cursor'),
+            limit=get_page_size(request),
+        )
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    products_data = []
+    for product in page:
+        images = product.get_all_images()
+        products_data.append({
+            'id': str(product.id),
+            'name': product.name,
+            'description': product.description,
+            'price': str(product.price),
+            'stock': product.stock,
+            'category': product.category.name,
+            # Prefetched and already ordered primary-first
+            'images': [img.get_detail_url() for img in images],
+            'image_srcsets': [img.get_srcset() for img in images],
+            'thumbnail': images[0].get_thumbnail_url() if images else None,
+        })
+    
+    search_query = request.GET.get('search', '')
+    return JsonResponse({
+        'products': products_data,
+        'count': len(products_data),
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None,
+        # A short prefix matched more words than were searched: type more
+        'search_truncated': bool(search_query) and get_search_backend().truncated(search_query),
+    })
+
+
 def product_detail(request, product_id):
     """Individual product detail page"""
     product = get_object_or_404(Product, pk=product_id)
-    related_products = Product.objects.filter(
-        category=product.category,
-        status=1
-    ).exclude(pk=product_id)[:4]
+    related_products = CATALOG.get_or_set(
+        f'related:{product_id}',
+        lambda: list(Product.objects.filter(
+            category=product.category,
+            status=1
+        ).exclude(pk=product_id).with_images()[:4])
+    )
     
     context = {
         'product': product,
@@ -248,10 +313,7 @@ def create_user_profile(backend, user, response, *args, **kwargs):
             Cart.objects.create(user=our_user)
         
         # Store in session
-        kwargs['request'].session['user_id'] = our_user.id
-        kwargs['request'].session['user_name'] = our_user.name
-        kwargs['request'].session['user_email'] = our_user.email
-        kwargs['request'].session['user_role'] = our_user.role
+        set_session_user(kwargs['request'], our_user)
 
         messages.success(request, f'Welcome back, {our_user.name}!')
     
@@ -271,10 +333,7 @@ def login_view(request):
             user = User.objects.get(email=email, password=hashed_password)
             
             # Store user ID in session
-            request.session['user_id'] = user.id
-            request.session['user_name'] = user.name
-            request.session['user_email'] = user.email
-            request.session['user_role'] = user.role
+            set_session_user(request, user)
             
             messages.success(request, f'Welcome back, {user.name}!')
             
@@ -299,18 +358,13 @@ def login_view(request):
 def logout_view(request):
     """User logout"""
     request.session.flush()
+    clear_session_user(request)
     messages.success(request, 'You have been logged out successfully')
     return redirect('home')
 
 def get_logged_in_user(request):
-    """Return the custom User instance from session"""
-    user_id = request.session.get('user_id')
-    if not user_id:
-        return None
-    try:
-        return User.objects.get(pk=user_id)
-    except User.DoesNotExist:
-        return None
+    """Return the custom User instance from session (resolved once per request)"""
+    return get_session_user(request)
 
 # =====================
 # CART FUNCTIONALITY
@@ -360,7 +414,7 @@ def add_to_cart(request, product_id):
     return JsonResponse({
         'success': True,
         'message': 'Added to cart',
-        'cart_count': cart.get_total_items()
+        'cart_count': Cart.objects.get_counters(cart.id)[0]
     })
 
 
@@ -370,7 +424,7 @@ def cart_view(request):
     if not user:
         return redirect('login')
     
-    cart = Cart.objects.filter(user=user).first()
+    cart = Cart.objects.with_items().filter(user=user).first()
     
     context = {
         'cart': cart,
@@ -443,23 +497,23 @@ def checkout(request):
         return redirect('login')
     
     # Get cart WITHOUT clearing it
-    cart = Cart.objects.filter(user=user).first()
+    cart = Cart.objects.with_items().filter(user=user).first()
     
     # Check if cart exists AND has items
     if not cart or cart.is_empty():
         messages.warning(request, 'Your cart is empty')
         return redirect('products')
     
-    # Get all user addresses
-    addresses = Address.objects.filter(user=user).order_by('-is_default')
+    # Get all user addresses (evaluated once: the template counts and lists them)
+    addresses = Address.objects.filter(user=user).select_related('user').order_by('-is_default', '-created_at')
     
     # If no addresses, redirect to manage addresses with return URL
-    if not addresses.exists():
+    if not addresses:
         messages.info(request, 'Please add a delivery address first')
         request.session['checkout_return'] = True
         return redirect('manage_addresses')
     
-    default_address = user.get_default_address()
+    default_address = next((address for address in addresses if address.is_default), addresses[0])
     
     # Get member for loyalty points
     member = None
@@ -501,55 +555,17 @@ def process_checkout(request):
     except Address.DoesNotExist:
         return JsonResponse({'error': 'Invalid address'}, status=400)
     
-    subtotal = cart.get_subtotal()
     loyalty_points_used = Decimal(request.POST.get('loyalty_points_used', '0'))
-    discount_amount = Decimal('0')
-    
-    if loyalty_points_used > 0:
-        if not user.is_member():
-            return JsonResponse({'error': 'Not a member'}, status=400)
-        
-        member = user.member_profile
-        if loyalty_points_used > member.loyalty_points:
-            return JsonResponse({'error': 'Insufficient loyalty points'}, status=400)
-        
-        try:
-            discount_amount = member.redeem_points(loyalty_points_used)
-        except Exception as e:
-            return JsonResponse({'error': f'Failed to use loyalty points: {str(e)}'}, status=400)
-    
-    total_amount = subtotal - discount_amount
-    
-    # Create order
-    order = Order.objects.create(
-        address=user_address,
-        subtotal=subtotal,
-        status='X',  # Pending
-        loyalty_points_used=loyalty_points_used
-    )
     
-    # Create order items
-    for cart_item in cart.items.all():
-        OrderItem.objects.create(
-            order=order,
-            product=cart_item.product,
-            quantity=cart_item.quantity,
-            unit_price=cart_item.product.price,
-            subtotal=cart_item.get_total_price()
-        )
-        cart_item.product.reduce_stock(cart_item.quantity)
-    
-    # Create pending payment record
-    Payment.objects.create(
-        order=order,
-        discount_amount=discount_amount,
-        total_amount=total_amount,
-        method='COD',  # Temporary
-        status='P'
-    )
+    # Create order, order items, stock reservation, pending payment and the
+    # admin notification in one transaction (see checkout.place_order)
+    try:
+        order, payment = place_order(user, cart, user_address, loyalty_points_used)
+    except CheckoutError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     
-    # ✅ SEND ADMIN NOTIFICATION (NEW!)
-    send_admin_notification(order)
+    discount_amount = payment.discount_amount
+    total_amount = payment.total_amount
     
     # Store order in session
     request.session['pending_order_id'] = order.id
@@ -575,7 +591,9 @@ def payment(request):
         return redirect('checkout')  # CHANGED: redirect to checkout, not products
 
     order = get_object_or_404(
-        Order.objects.prefetch_related('items__product'),
+        Order.objects.select_related('address__user').prefetch_related(
+            'items__product', product_images_prefetch('items__product__images')
+        ),
         pk=order_id,
         address__user=user
     )
@@ -601,18 +619,21 @@ def payment(request):
     return render(request, 'order/payment.html', context)
 
 
-@require_POST
-def process_payment(request):
-    """Process payment selection and create payment record"""
+def _start_payment(request):
+    """
+    Create the Payment record (sync part of process_payment).
+    Returns (response, payment): COD and errors finish here with a response.
+    """
     user = get_logged_in_user(request)
     if not user:
-        return JsonResponse({'error': 'Unauthorized'}, status=401)
+        return JsonResponse({'error': 'Unauthorized'}, status=401), None
     
     order_id = request.session.get('pending_order_id')
     if not order_id:
-        return JsonResponse({'error': 'No pending order'}, status=400)
+        return JsonResponse({'error': 'No pending order'}, status=400), None
     
-    order = get_object_or_404(Order, pk=order_id, address__user=user)
+    # address__user is read later by the async provider flows, where lazy loads aren't allowed
+    order = get_object_or_404(Order.objects.select_related('address__user'), pk=order_id, address__user=user)
     
     # Get payment details
     payment_method = request.POST.get('payment_method', 'ST')
@@ -628,30 +649,28 @@ def process_payment(request):
         status='P'  # Pending
     )
     
-    # Process based on payment method
     if payment_method == 'COD':
         # Cash on Delivery - mark as pending cash payment
-        payment.status = 'C'  # Cash pending
-        payment.save()
+        # Status and points commit together: the loyalty recompute reads both
+        with transaction.atomic():
+            payment.status = 'C'  # Cash pending
+            payment.save()
         
-        # Update order status
-        order.status = 'C'  # Confirmed
-        order.save()
+            # Update order status
+            order.status = 'C'  # Confirmed
+            order.save()
 
-        # ✅ AWARD LOYALTY POINTS FOR COD TOO
-        if order.address.user.is_member():
-            try:
+            # ✅ AWARD LOYALTY POINTS FOR COD TOO (a failure rolls the whole order back)
+            if order.address.user.is_member():
                 member = order.address.user.member_profile
                 # Use the payment total amount (after discount)
-                points_earned = member.add_loyalty_points(total_amount)
+                points_earned = member.add_loyalty_points(total_amount, order=order)
                 order.loyalty_points_earned = points_earned
                 order.save()
-                print(f"DEBUG: Awarded {points_earned} points for COD order")
-            except Exception as e:
-                print(f"DEBUG: Error awarding points for COD: {e}")
+                logger.info("COD order %s: earned %s points", order.order_number, points_earned)
 
-        # Send confirmation email
-        order.send_confirmation_email()
+        # Queue confirmation email (sent by the notification worker)
+        order.queue_confirmation_email()
         
         # ✅ Clear the cart BEFORE redirect
         user = get_logged_in_user(request)
@@ -666,15 +685,29 @@ def process_payment(request):
         return JsonResponse({
             'success': True,
             'redirect': f'/payment/success/{order.id}/'
-        })
+        }), payment
     
-    elif payment_method == 'PP':
+    return None, payment
+
+
+@require_POST
+async def process_payment(request):
+    """
+    Process payment selection and create payment record.
+    Async so the PayPal / Stripe round trip doesn't hold a worker thread.
+    """
+    response, payment = await sync_to_async(_start_payment)(request)
+    if response is not None:
+        return response
+    
+    # Process based on payment method
+    if payment.method == 'PP':
         # PayPal payment - redirect to PayPal
-        return create_paypal_payment(request, payment)
+        return await create_paypal_payment(request, payment)
     
-    elif payment_method == 'ST':
+    elif payment.method == 'ST':
         # Stripe payment - redirect to Stripe
-        return create_stripe_payment(request, payment)
+        return await create_stripe_payment(request, payment)
     
     else:
         return JsonResponse({
@@ -683,55 +716,74 @@ def process_payment(request):
         }, status=400)
 
 
+def _complete_payment(request, payment, transaction_id):
+    """Mark a provider-confirmed payment as paid and clear the user's cart"""
+    # One transaction: a failed loyalty update must not leave the payment
+    # marked paid (the webhook would then skip it as already confirmed)
+    with transaction.atomic():
+        payment.order.status = 'C'
+        payment.status = 'S'  # Success
+        payment.transaction_id = transaction_id
+        payment.save()
+        
+        # Mark payment as paid (updates order status and awards loyalty points)
+        payment.mark_as_paid()
+    
+    user = get_logged_in_user(request)
+    if user:
+        cart = Cart.objects.filter(user=user).first()
+        if cart:
+            cart.clear()
+
+
+def _provider_unavailable(request, provider, error):
+    print(f"⚠️  {provider} unavailable: {str(error)}")
+    messages.error(request, f'{provider} is not responding right now. Please try again or choose another payment method.')
+    return JsonResponse({
+        'success': False,
+        'error': f'{provider} is temporarily unavailable'
+    }, status=503)
+
+
 # =====================
 # PAYPAL PAYMENT FLOW
 # =====================
 
-def create_paypal_payment(request, payment):
+async def create_paypal_payment(request, payment):
     """Create PayPal payment and redirect to PayPal"""
     try:
-        # Calculate amount
-        amount = float(payment.total_amount)
-        
-        # Create PayPal payment
-        paypal_payment = paypalrestsdk.Payment({
-            "intent": "sale",
-            "payer": {
-                "payment_method": "paypal"
-            },
-            "redirect_urls": {
-                "return_url": request.build_absolute_uri(
-                    f'/payment/paypal/success/{payment.id}/'
-                ),
-                "cancel_url": request.build_absolute_uri(
-                    f'/payment/cancel/{payment.id}/'
-                )
-            },
-            "transactions": [{
-                "amount": {
-                    "total": f"{amount:.2f}",
-                    "currency": "MYR"
-                },
-                "description": f"Chocolate Order #{payment.order.order_number}",
-                "invoice_number": payment.order.order_number
-            }]
-        })
+        result = await PaymentProcessor.process_paypal_payment_async(
+            payment.total_amount,
+            return_url=request.build_absolute_uri(
+                f'/payment/paypal/success/{payment.id}/'
+            ),
+            cancel_url=request.build_absolute_uri(
+                f'/payment/cancel/{payment.id}/'
+            ),
+            description=f"Chocolate Order #{payment.order.order_number}",
+            invoice_number=payment.order.order_number,
+            local_payment_id=payment.id,
+        )
 
-        if paypal_payment.create():
-            # Find approval URL
-            for link in paypal_payment.links:
-                if link.rel == "approval_url":
-                    return JsonResponse({
-                        'success': True,
-                        'redirect': link.href
-                    })
+        if result['success']:
+            # Provider reference for `manage.py reconcile_payments`
+            payment.transaction_id = result['payment_id']
+            await payment.asave(update_fields=['transaction_id'])
+            return JsonResponse({
+                'success': True,
+                'redirect': result['approval_url']
+            })
         
         # If no approval URL found
+        print(f"PayPal Error: {result['error']}")
         messages.error(request, 'PayPal payment creation failed.')
         return JsonResponse({
             'success': False,
             'error': 'PayPal payment creation failed'
         }, status=500)
+    
+    except PaymentUnavailable as e:
+        return _provider_unavailable(request, 'PayPal', e)
            
     except Exception as e:
         print(f"PayPal Error: {str(e)}")
@@ -742,40 +794,30 @@ def create_paypal_payment(request, payment):
         }, status=500)
 
 
-def paypal_success(request, payment_id):
+async def paypal_success(request, payment_id):
     """Handle PayPal return after successful payment"""
     try:
-        payment = get_object_or_404(Payment, id=payment_id)
+        payment = await aget_object_or_404(Payment.objects.select_related('order'), id=payment_id)
         payer_id = request.GET.get('PayerID')
         paypal_payment_id = request.GET.get('paymentId')
 
         # Execute the payment
-        paypal_payment = paypalrestsdk.Payment.find(paypal_payment_id)
+        result = await PaymentProcessor.complete_paypal_payment_async(
+            paypal_payment_id or '', payer_id, local_payment_id=payment.id
+        )
         
-        if paypal_payment.execute({"payer_id": payer_id}):
+        if result['success']:
             # Payment successful
-            payment.order.status = 'C'
-            payment.status = 'S'  # Success
-            payment.transaction_id = paypal_payment_id
-            payment.save()
-            
-            # Mark payment as paid (updates order status and awards loyalty points)
-            payment.mark_as_paid()
-            
-            user = get_logged_in_user(request)
-            if user:
-                cart = Cart.objects.filter(user=user).first()
-                if cart:
-                    cart.clear()
+            await sync_to_async(_complete_payment)(request, payment, paypal_payment_id)
 
             messages.success(request, 'Payment completed successfully!')
-            return redirect('payment_success', order_id=payment.order.id)  # Use URL name
+            return redirect('payment_success', order_id=payment.order_id)  # Use URL name
         else:
             # Payment execution failed
             payment.status = 'F'  # Failed
-            payment.save()
+            await payment.asave()
             messages.error(request, 'Payment execution failed.')
-            return redirect('payment_failed', order_id=payment.order.id)  # Use URL name
+            return redirect('payment_failed', order_id=payment.order_id)  # Use URL name
         
     except Exception as e:
         print(f"PayPal Success Error: {str(e)}")
@@ -787,30 +829,16 @@ def paypal_success(request, payment_id):
 # STRIPE PAYMENT FLOW
 # =====================
 
-def create_stripe_payment(request, payment):
+async def create_stripe_payment(request, payment):
     """Create Stripe Checkout Session and redirect to Stripe"""
     try:
-        # Calculate amount in cents
-        amount_cents = int(payment.total_amount * 100)
-        
-        # Create Stripe Checkout Session
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'myr',
-                    'product_data': {
-                        'name': f'Order #{payment.order.order_number} - WinnieCho',
-                        'description': 'Chocolate Shop Purchase',
-                    },
-                    'unit_amount': amount_cents,
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
+        session = await PaymentProcessor.create_stripe_checkout_async(
+            payment.total_amount,
+            payment.order.order_number,
+            # Template appended after build_absolute_uri(), which would escape its braces
             success_url=request.build_absolute_uri(
-                f'/payment/stripe/success/{payment.id}/?session_id={{CHECKOUT_SESSION_ID}}'
-            ),
+                f'/payment/stripe/success/{payment.id}/'
+            ) + '?session_id={CHECKOUT_SESSION_ID}',
             cancel_url=request.build_absolute_uri(
                 f'/payment/cancel/{payment.id}/'
             ),
@@ -821,11 +849,18 @@ def create_stripe_payment(request, payment):
             customer_email=payment.order.address.user.email,
         )
 
+        # Provider reference for `manage.py reconcile_payments`
+        payment.transaction_id = session.id
+        await payment.asave(update_fields=['transaction_id'])
+
         return JsonResponse({
             'success': True,
             'redirect': session.url
         })
     
+    except PaymentUnavailable as e:
+        return _provider_unavailable(request, 'Stripe', e)
+    
     except Exception as e:
         print(f"Stripe Error: {str(e)}")
         messages.error(request, f'Stripe error: {str(e)}')
@@ -835,86 +870,50 @@ def create_stripe_payment(request, payment):
         }, status=500)
 
 
-def stripe_success(request, payment_id):
+async def stripe_success(request, payment_id):
     """Handle Stripe return after successful payment"""
     try:
-        payment = get_object_or_404(Payment, id=payment_id)
+        payment = await aget_object_or_404(Payment.objects.select_related('order'), id=payment_id)
         session_id = request.GET.get('session_id')
 
         # Check if already processed
         if payment.status == 'S':
             # Already processed, just redirect
-            payment.order.status = 'C'
             messages.success(request, 'Payment completed successfully!')
-            return redirect('payment_success', order_id=payment.order.id)  # Use URL name
+            return redirect('payment_success', order_id=payment.order_id)  # Use URL name
 
         if not session_id or session_id == '{CHECKOUT_SESSION_ID}':
             # No session_id means user came directly to success URL
             # Mark as paid anyway (Stripe webhook will confirm)
-            payment.order.status = 'C'
-            payment.status = 'S'
-            payment.transaction_id = 'stripe_redirect'
-            payment.save()
-            payment.mark_as_paid()
-            
-            user = get_logged_in_user(request)
-            if user:
-                cart = Cart.objects.filter(user=user).first()
-                if cart:
-                    cart.clear()
+            await sync_to_async(_complete_payment)(request, payment, 'stripe_redirect')
 
             messages.success(request, 'Payment completed successfully!')
-            return redirect('payment_success', order_id=payment.order.id)  # Use URL name
+            return redirect('payment_success', order_id=payment.order_id)  # Use URL name
         
         # Verify with Stripe
         try:
-            session = stripe.checkout.Session.retrieve(session_id)
-        
-            # Check payment status
-            if session.payment_status in ['paid', 'no_payment_required']:
-                payment.order.status = 'C'
-                payment.status = 'S'
-                payment.transaction_id = session.id
-                payment.save()
-                payment.mark_as_paid()
-                
-                # ✅ Clear the cart
-                user = get_logged_in_user(request)
-                if user:
-                    cart = Cart.objects.filter(user=user).first()
-                    if cart:
-                        cart.clear()
-
-                messages.success(request, 'Payment completed successfully!')
-                return redirect('payment_success', order_id=payment.order.id)  # Use URL name
-            else:
-                # Payment not completed
-                payment.status = 'F'
-                payment.save()
-                messages.warning(request, f'Payment status: {session.payment_status}')
-                return redirect('payment_failed', order_id=payment.order.id)  # Use URL name
+            session = await PaymentProcessor.get_stripe_checkout_async(session_id)
         
         except stripe.error.InvalidRequestError:
             # Session retrieval failed, but mark as paid
-            payment.order.status = 'C'
-            payment.status = 'S'
-            payment.transaction_id = 'stripe_fallback'
-            payment.save()
-            payment.mark_as_paid()
-
-            # ✅ Clear the cart
-            user = get_logged_in_user(request)
-            if user:
-                cart = Cart.objects.filter(user=user).first()
-                if cart:
-                    cart.clear()
+            await sync_to_async(_complete_payment)(request, payment, 'stripe_fallback')
 
             messages.success(request, 'Payment completed successfully!')
-            return redirect('payment_success', order_id=payment.order.id)  # Use URL name
+            return redirect('payment_success', order_id=payment.order_id)  # Use URL name
         
-    except Payment.DoesNotExist:
-        messages.error(request, 'Payment record not found.')
-        return redirect('home')
+        # Check payment status
+        if session.payment_status in ['paid', 'no_payment_required']:
+            # ✅ Also clears the cart
+            await sync_to_async(_complete_payment)(request, payment, session.id)
+
+            messages.success(request, 'Payment completed successfully!')
+            return redirect('payment_success', order_id=payment.order_id)  # Use URL name
+        else:
+            # Payment not completed
+            payment.status = 'F'
+            await payment.asave()
+            messages.warning(request, f'Payment status: {session.payment_status}')
+            return redirect('payment_failed', order_id=payment.order_id)  # Use URL name
     
     except Exception as e:
         print(f"Stripe Success Error: {str(e)}")
@@ -924,13 +923,16 @@ def stripe_success(request, payment_id):
 
 @csrf_exempt
 def stripe_webhook(request):
-    """Handle Stripe webhooks for async payment confirmation"""
+    """
+    Stripe webhook: verify, store the raw event and answer 200 right away.
+    Events are processed (idempotently) by firstapp.webhooks.
+    """
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
     webhook_secret = settings.STRIPE_WEBHOOK_SECRET
 
     try:
-        event = stripe.Webhook.construct_event(
+        stripe.Webhook.construct_event(
             payload, sig_header, webhook_secret
         )
     except ValueError:
@@ -938,32 +940,8 @@ def stripe_webhook(request):
     except stripe.error.SignatureVerificationError:
         return HttpResponse(status=400)
     
-    # Handle checkout.session.completed event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        # Get payment_id from metadata
-        payment_id = session.metadata.get('payment_id')
-        
-        if payment_id:
-            try:
-                payment = Payment.objects.get(id=payment_id)
-                
-                # Check if already processed
-                if payment.status != 'S':
-                    payment.order.status = 'C'
-                    payment.status = 'S'
-                    payment.method = 'ST'
-                    payment.transaction_id = session.id
-                    payment.save()
-                    payment.mark_as_paid()
-                    
-                    # Clear session (if user is still in session)
-                    # Note: This is async, so we can't access request.session here
-                    # Session cleanup should be done in the redirect view
-                    
-            except Payment.DoesNotExist:
-                pass
+    # Duplicate deliveries of an event id are acknowledged but not stored again
+    store_event(json.loads(payload))
     
     return HttpResponse(status=200)
 
@@ -1069,33 +1047,38 @@ def order_detail(request, order_id):
 # =====================
 # DASHBOARD & PROFILE
 # =====================
+DASHBOARD_ORDERS_LIMIT = 10
+ORDERS_HISTORY_PAGE_SIZE = 20
+
+
 def dashboard(request):
     """User dashboard"""
     user = get_logged_in_user(request)
     if not user:
         return redirect('login')
     
-    # Get all orders
-    orders = Order.objects.filter(
-        address__user=user
-    ).exclude(
-        status='X'  # Exclude cancelled orders
-    ).order_by('-created_at')
-    
-    # Get recent orders
+    # Latest orders with item counts/payment totals in one query;
+    # the full history is paginated on orders_history
+    history = Order.objects.for_history(user)
+    orders = list(
+        history.with_summary().order_by('-created_at', '-id')[:DASHBOARD_ORDERS_LIMIT]
+    )
     recent_orders = orders[:5]
     
-    # Get all orders for count
-    total_orders = orders.count()
+    # COUNT only when the page is full
+    if len(orders) < DASHBOARD_ORDERS_LIMIT:
+        total_orders = len(orders)
+    else:
+        total_orders = history.count()
     
     # Get member stats
     member = None
     if user.is_member():
         member = user.member_profile
     
-    # Get ALL addresses (CHANGED)
-    addresses = Address.objects.filter(user=user).order_by('-is_default', '-created_at')
-    default_address = user.get_default_address()
+    # Get ALL addresses (CHANGED); the default is the first one, as in get_default_address()
+    addresses = list(Address.objects.filter(user=user).select_related('user').order_by('-is_default', '-created_at'))
+    default_address = addresses[0] if addresses else None
     
     context = {
         'user': user,
@@ -1125,6 +1108,9 @@ def update_profile(request):
     
     user.save()
     
+    # Keep the session snapshot in sync with the new name
+    set_session_user(request, user)
+    
     return JsonResponse({'success': True, 'message': 'Profile updated'})
 
 
@@ -1353,14 +1339,20 @@ def orders_history(request):
     if not user:
         return redirect('login')
     
-    orders = Order.objects.filter(
-        address__user=user
-    ).exclude(
-        status='X'  # Exclude cancelled orders
-    ).order_by('-created_at')
+    try:
+        orders, next_cursor = keyset_paginate(
+            Order.objects.for_history(user).with_summary(),
+            ['-created_at', '-id'],
+            cursor=request.GET.get('cursor'),
+            limit=get_page_size(request, default=ORDERS_HISTORY_PAGE_SIZE),
+        )
+    except InvalidCursor:
+        return redirect('orders_history')
     
     context = {
         'orders': orders,
+        'next_cursor': next_cursor,
+        'is_first_page': not request.GET.get('cursor'),
     }
     return render(request, 'order/orders_history.html', context)
 
@@ -1500,51 +1492,50 @@ def reset_password(request, token):
 # =============================================
 
 def get_active_orders(request):
-    """Get user's active orders for delivery tracking bar"""
+    """
+    Active orders for the delivery tracking bar (delta feed, see firstapp.tracking)
+    ?since=<cursor> returns only orders changed since the previous poll;
+    If-None-Match with the last ETag returns 304 when nothing changed.
+    """
     user = get_logged_in_user(request)
     if not user:
-        return JsonResponse({'orders': []})
+        return JsonResponse({'orders': [], 'active_ids': [], 'full': True})
     
-    # Get all non-cancelled orders
-    orders = Order.objects.filter(
-        address__user=user
-    ).exclude(
-        status='X'  # Exclude cancelled
-    ).order_by('-created_at')
+    since = None
+    if request.GET.get('since'):
+        try:
+            since = parse_since(request.GET['since'])
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    now = timezone.now()
+    active_ids, etag = window_state(user, now)
+    if since is not None and request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(get_delta(user, active_ids, since, now))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+async def order_events(request):
+    """
+    Server-sent events for the current user's orders (drivers: all orders).
+    Needs the ASGI server; clients keep polling when it's unavailable.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Event stream requires the ASGI server'}, status=501)
     
-    orders_data = []
-    for order in orders:
-        # Calculate time ago
-        time_diff = timezone.now() - order.created_at
-        if time_diff.days > 0:
-            time_ago = f"{time_diff.days}d ago"
-        elif time_diff.seconds // 3600 > 0:
-            time_ago = f"{time_diff.seconds // 3600}h ago"
-        else:
-            time_ago = f"{time_diff.seconds // 60}m ago"
-        
-        # Get delivery proof if delivered
-        delivery_proof = None
-        delivered_at = None
-        if hasattr(order, 'delivery_proof') and order.delivery_proof:
-            # Access the actual ImageField in DeliveryProof
-            if order.delivery_proof.image:
-                delivery_proof = order.delivery_proof.image.url
-            if order.delivery_proof.uploaded_at:
-                delivered_at = order.delivery_proof.uploaded_at.strftime('%b %d, %I:%M %p')
-        
-        orders_data.append({
-            'id': str(order.id),
-            'order_number': order.order_number,
-            'status': order.status,
-            'total_items': order.get_total_items(),
-            'total': str(order.subtotal),
-            'time_ago': time_ago,
-            'delivery_proof': delivery_proof,
-            'delivered_at': delivered_at
-        })
+    user = await sync_to_async(get_logged_in_user)(request)
+    if not user:
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
     
-    return JsonResponse({'orders': orders_data})
+    channels = [DRIVERS_CHANNEL] if user.is_driver() else [user_channel(user.id)]
+    response = StreamingHttpResponse(event_stream(channels), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: don't buffer the stream
+    return response
 
 
 # =============================================
@@ -1565,55 +1556,69 @@ def driver_dashboard(request):
 # DRIVER API - Get Orders
 # =============================================
 
+DRIVER_FEED_PAGE_SIZE = 20
+
+
+def _driver_time_ago(created_at, now):
+    time_diff = now - created_at
+    if time_diff.days > 0:
+        return f"{time_diff.days} day{'s' if time_diff.days > 1 else ''} ago"
+    if time_diff.seconds // 3600 > 0:
+        return f"{time_diff.seconds // 3600} hour{'s' if time_diff.seconds // 3600 > 1 else ''} ago"
+    minutes = time_diff.seconds // 60
+    return f"{minutes} minute{'s' if minutes > 1 else ''} ago"
+
+
 def get_driver_orders(request):
-    """Get orders for driver (all non-cancelled) - FIXED DEFAULT"""
+    """
+    Driver order feed, newest first, keyset paginated
+    ?status=C (or C,S)  ?date_from=YYYY-MM-DD  ?date_to=YYYY-MM-DD
+    ?postal=50 (postal code prefix)  ?cursor=  ?limit=
+    A page is a fixed number of queries: item totals are annotated and the
+    customer/address/proof are joined.
+    """
     user = get_logged_in_user(request)
-
-    # ✅ ADD DETAILED DEBUG
-    print(f"🔍 Session user_id: {request.session.get('user_id')}")
-    print(f"🔍 User object: {user}")
-    print(f"🔍 User role: {user.role if user else 'None'}")
-    
     if not user or user.role != 'D':
-        print(f"❌ Unauthorized: user={'None' if not user else user.email}, role={user.role if user else 'N/A'}")
         return JsonResponse({'error': 'Unauthorized', 'orders': []}, status=401)
     
-    if not user or user.role != 'D':
-        return JsonResponse({'error': 'Unauthorized'}, status=401)
+    orders = Order.objects.exclude(status='X')
     
-    # ✅ FIX: Filter by status if provided, otherwise show ALL
-    status = request.GET.get('status', '')
+    statuses = [code for code in request.GET.get('status', '').upper().split(',') if code]
+    if len(statuses) == 1:
+        orders = orders.filter(status=statuses[0])
+    elif statuses:
+        orders = orders.filter(status__in=statuses)
     
-    # ✅ CHANGED: Default shows ALL orders, not just 'C'
-    if status:
-        orders = Order.objects.filter(status=status).exclude(status='X')
-    else:
-        # Show ALL non-cancelled orders
-        orders = Order.objects.exclude(status='X')
+    try:
+        if request.GET.get('date_from'):
+            date_from = datetime.fromisoformat(request.GET['date_from'])
+            orders = orders.filter(created_at__gte=timezone.make_aware(date_from))
+        if request.GET.get('date_to'):
+            date_to = datetime.fromisoformat(request.GET['date_to']) + timedelta(days=1)
+            orders = orders.filter(created_at__lt=timezone.make_aware(date_to))
+    except ValueError:
+        return JsonResponse({'error': 'Dates must be YYYY-MM-DD'}, status=400)
     
-    orders = orders.select_related('address__user').order_by('-created_at')
+    postal = request.GET.get('postal', '').strip()
+    if postal:
+        orders = orders.filter(address__postal_code__startswith=postal)
     
-    # ✅ DEBUG: Print what we're querying
-    print(f"🚗 Driver querying orders with status: '{status}' (empty = ALL)")
-    print(f"📦 Found {orders.count()} orders")
+    orders = orders.select_related('address__user', 'delivery_proof').with_summary()
     
+    try:
+        page, next_cursor = keyset_paginate(
+            orders,
+            ['-created_at', '-id'],
+            cursor=request.GET.get('cursor'),
+            limit=get_page_size(request, default=DRIVER_FEED_PAGE_SIZE),
+        )
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    now = timezone.now()
     orders_data = []
-    for order in orders:
-        # Calculate time ago
-        time_diff = timezone.now() - order.created_at
-        if time_diff.days > 0:
-            time_ago = f"{time_diff.days} day{'s' if time_diff.days > 1 else ''} ago"
-        elif time_diff.seconds // 3600 > 0:
-            time_ago = f"{time_diff.seconds // 3600} hour{'s' if time_diff.seconds // 3600 > 1 else ''} ago"
-        else:
-            minutes = time_diff.seconds // 60
-            time_ago = f"{minutes} minute{'s' if minutes > 1 else ''} ago"
-        
-        # Get delivery proof
-        delivery_proof = None
-        if hasattr(order, 'delivery_proof') and order.delivery_proof:
-            delivery_proof = order.delivery_proof.image.url if order.delivery_proof.image else None
-        
+    for order in page:
+        proof = getattr(order, 'delivery_proof', None)
         orders_data.append({
             'id': str(order.id),
             'order_number': order.order_number,
@@ -1621,14 +1626,14 @@ def get_driver_orders(request):
             'customer_name': order.address.user.name,
             'customer_phone': order.address.user.phone,
             'delivery_address': order.address.get_full_address(),
-            'total_items': order.get_total_items(),
+            'postal_code': order.address.postal_code,
+            'total_items': order.total_items,
             'total': str(order.subtotal),
-            'time_ago': time_ago,
-            'delivery_proof': delivery_proof
+            'time_ago': _driver_time_ago(order.created_at, now),
+            'delivery_proof': proof.image.url if proof and proof.image else None
         })
     
-    print(f"✅ Returning {len(orders_data)} orders to driver")
-    return JsonResponse({'orders': orders_data})
+    return JsonResponse({'orders': orders_data, 'next_cursor': next_cursor})
 
 
 # =============================================
@@ -1648,15 +1653,16 @@ def update_order_status(request):
         order_id = data.get('order_id')
         new_status = data.get('status')
         
-        order = Order.objects.get(id=order_id)
+        # Address loaded for the status event (firstapp.events) and the email
+        order = Order.objects.select_related('address').get(id=order_id)
         old_status = order.status
         
         # Update status
         order.status = new_status
         order.save()
         
-        # Send notification email to customer
-        send_order_status_email(order, old_status)
+        # Queue notification email to customer
+        queue_order_status_email(order, old_status)
         
         return JsonResponse({
             'success': True,
@@ -1712,8 +1718,8 @@ def upload_delivery_proof(request):
             order.status = 'D'
             order.save()
             
-            # Send notification
-            send_order_status_email(order, 'S')  # From Shipped to Delivered
+            # Queue notification
+            queue_order_status_email(order, 'S')  # From Shipped to Delivered
         
         return JsonResponse({
             'success': True,
@@ -1728,62 +1734,59 @@ def upload_delivery_proof(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
-# =============================================
-# HELPER FUNCTION - Send Status Update Email
-# =============================================
-
-def send_order_status_email(order, old_status):
-    """Send email when order status changes"""
-    from django.core.mail import send_mail
-    from django.conf import settings
-    
-    status_messages = {
-        'P': 'Your order is pending confirmation.',
-        'C': 'Your order has been confirmed and is being prepared!',
-        'S': 'Your order has been shipped and is on the way!',
-        'D': 'Your order has been delivered. Enjoy your chocolates!',
-        'X': 'Your order has been cancelled.'
-    }
+@require_POST
+def start_proof_upload(request):
+    """Driver starts a resumable chunked proof upload; returns the upload id"""
+    user = get_logged_in_user(request)
+    if not user or user.role != 'D':
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
     
-    subject = f'Order Status Update - #{order.order_number}'
+    try:
+        data = json.loads(request.body)
+        order = Order.objects.get(id=data.get('order_id'))
+        upload = start_upload(order, user, data.get('filename', ''), int(data.get('size', 0)))
+    except Order.DoesNotExist:
+        return JsonResponse({'error': 'Order not found'}, status=404)
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
     
-    message = f"""
-    Hi {order.address.user.name},
-
-    Your order #{order.order_number} status has been updated.
-
-    Previous Status: {dict(Order.status_choices).get(old_status)}
-    New Status: {order.get_status_display()}
-
-    {status_messages.get(order.status, '')}
-
-    Order Details:
-    Total: RM {order.subtotal}
-    Items: {order.get_total_items()}
-
-    Delivery Address:
-    {order.address.get_full_address()}
-
-    Track your order: {settings.SITE_URL}/orders/{order.id}/
+    return JsonResponse({
+        'upload_id': str(upload.id),
+        'received': 0,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+    })
 
-    Thank you for shopping with WinnieCho!
 
-    Best regards,
-    WinnieChO Team
+@require_http_methods(['GET', 'PUT'])
+def proof_upload_chunk(request, upload_id):
     """
+    GET: resume offset of an upload
+    PUT: raw chunk body with Content-Range: bytes start-end/total
+    """
+    user = get_logged_in_user(request)
+    if not user or user.role != 'D':
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
     
-    try:
-        send_mail(
-            subject=subject,
-            message=message,
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[order.address.user.email],
-            fail_silently=True,
-        )
-        print(f"✅ Status email sent to {order.address.user.email}")
-    except Exception as e:
-        print(f"❌ Error sending status email: {str(e)}")
-
+    upload = ProofUpload.objects.filter(pk=upload_id, driver_id=user.id).first()
+    if not upload:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    
+    if request.method == 'PUT':
+        try:
+            # Reads the body stream directly: no multipart parsing, no temp file
+            upload = write_chunk(upload, request, request.headers.get('Content-Range'))
+        except UploadError as e:
+            upload.refresh_from_db()
+            return JsonResponse({'error': str(e), 'received': upload.received_size}, status=e.status)
+    
+    return JsonResponse({
+        'success': True,
+        'received': upload.received_size,
+        'total': upload.total_size,
+        'complete': upload.is_complete(),
+    })
 
 
 # =============================================
@@ -1798,306 +1801,65 @@ def analytics_dashboard(request):
         return redirect('home')
     
     # Time period filter
-    period = request.GET.get('period', '30')
-    
-    if period == '7':
-        start_date = timezone.now() - timedelta(days=7)
-        period_label = 'Last 7 Days'
-    elif period == '30':
-        start_date = timezone.now() - timedelta(days=30)
-        period_label = 'Last 30 Days'
-    elif period == '90':
-        start_date = timezone.now() - timedelta(days=90)
-        period_label = 'Last 90 Days'
-    else:
-        start_date = timezone.now() - timedelta(days=365)
-        period_label = 'Last Year'
-    
-    # =====================
-    # KEY METRICS
-    # =====================
-    total_revenue = Payment.objects.filter(
-        status='S',
-        created_at__gte=start_date
-    ).aggregate(total=Sum('total_amount'))['total'] or 0
-    
-    total_orders = Order.objects.filter(
-        created_at__gte=start_date
-    ).exclude(status='X').count()
-    
-    total_customers = User.objects.filter(
-        role='M',
-        created_at__gte=start_date
-    ).count()
-    
-    total_products = Product.objects.filter(status=1).count()
-    
-    avg_order_value = Payment.objects.filter(
-        status='S',
-        created_at__gte=start_date
-    ).aggregate(avg=Avg('total_amount'))['avg'] or 0
-    
-    # =====================
-    # SALES CHART DATA (Daily)
-    # =====================
-    sales_by_day = Payment.objects.filter(
-        status='S',
-        created_at__gte=start_date
-    ).annotate(
-        date=TruncDate('created_at')
-    ).values('date').annotate(
-        revenue=Sum('total_amount'),
-        orders=Count('id')
-    ).order_by('date')
-    
-    sales_chart_labels = [
-        item['date'].strftime('%Y-%m-%d')
-        for item in sales_by_day
-        if item['date'] is not None
-    ]
-    sales_chart_revenue = [
-        float(item['revenue'])
-        for item in sales_by_day
-        if item['date'] is not None
-    ]
+    period = normalize_period(request.GET.get('period', '30'))
     
-    # If no data, create sample data for better UX
-    if not sales_chart_labels:
-        sales_chart_labels = [
-            (timezone.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-            for i in range(4, -1, -1)  # Last 5 days
-        ]
-        sales_chart_revenue = [1000.00, 1200.00, 800.00, 1500.00, 1300.00]
-    
-    # =====================
-    # CATEGORY PERFORMANCE
-    # =====================
-    category_sales = OrderItem.objects.filter(
-        order__created_at__gte=start_date,
-        order__status__in=['C', 'S', 'D']
-    ).values(
-        'product__category__name'
-    ).annotate(
-        revenue=Sum(F('quantity') * F('unit_price')),
-        quantity=Sum('quantity')
-    ).order_by('-revenue')
-    
-    category_labels = [item['product__category__name'] for item in category_sales]
-    category_revenue = [float(item['revenue']) for item in category_sales]
-    
-    # =====================
-    # TOP PRODUCTS
-    # =====================
-    top_products = OrderItem.objects.filter(
-        order__created_at__gte=start_date,
-        order__status__in=['C', 'S', 'D']
-    ).values(
-        'product__name',
-        'product__id'
-    ).annotate(
-        total_quantity=Sum('quantity'),
-        total_revenue=Sum(F('quantity') * F('unit_price'))
-    ).order_by('-total_revenue')[:10]
-    
-    # =====================
-    # RECENT ORDERS
-    # =====================
-    recent_orders = Order.objects.select_related(
-        'address__user'
-    ).exclude(status='X').order_by('-created_at')[:10]
-    
-    # =====================
-    # LOW STOCK ALERT
-    # =====================
-    low_stock = Product.objects.filter(
-        status=1,
-        stock__lte=10
-    ).order_by('stock')[:10]
-    
-    # =====================
-    # ORDER STATUS BREAKDOWN
-    # =====================
-    order_status_breakdown = Order.objects.filter(
-        created_at__gte=start_date
-    ).values('status').annotate(
-        count=Count('id')
-    ).order_by('-count')
-    
-    status_labels = [dict(Order.status_choices).get(item['status'], 'Unknown') for item in order_status_breakdown]
-    status_counts = [item['count'] for item in order_status_breakdown]
-    
-    # =====================
-    # TOP CUSTOMERS
-    # =====================
-    top_customers = Payment.objects.filter(
-        status='S',
-        created_at__gte=start_date
-    ).values(
-        'order__address__user__id',
-        'order__address__user__name',
-        'order__address__user__email'
-    ).annotate(
-        total_spent=Sum('total_amount'),
-        order_count=Count('order', distinct=True)
-    ).order_by('-total_spent')[:10]
-    
-    context = {
-        'total_revenue': float(total_revenue),
-        'total_orders': total_orders,
-        'total_customers': total_customers,
-        'total_products': total_products,
-        'avg_order_value': float(avg_order_value),
-
-        'sales_chart_labels': sales_chart_labels,
-        'sales_chart_revenue': sales_chart_revenue,
-        'sales_chart_orders': [1] * len(sales_chart_labels),
-
-        'category_labels': category_labels,
-        'category_revenue': category_revenue,
-
-        'status_labels': status_labels,
-        'status_counts': status_counts,
-
-        'top_products': top_products,
-        'recent_orders': recent_orders,
-        'low_stock': low_stock,
-        'top_customers': top_customers,
-
-        'period': period,
-        'period_label': period_label,
-    }
+    # Precomputed snapshot (stale ones are refreshed in the background)
+    snapshot = get_snapshot(period)
+    context = dict(snapshot['context'])
+    context['generated_at'] = snapshot['generated_at']
     
     return render(request, 'secure/admin/analytics.html', context)
 
-# ============================================================
-# EMAIL NOTIFICATION FUNCTIONS
-# ============================================================
-
-def send_admin_notification(order):
-    """Send email/SMS to admin when order placed"""
-    from django.core.mail import send_mail
-    from django.conf import settings
-    
-    subject = f'🛒 New Order - #{order.order_number}'
-    payment = order.payments.first()
-    
-    message = f"""
-═══════════════════════════════════════
-NEW ORDER RECEIVED
-═══════════════════════════════════════
-
-Order Number: {order.order_number}
-Order Date: {order.created_at.strftime('%Y-%m-%d %H:%M:%S')}
-
-CUSTOMER INFORMATION:
-• Name: {order.address.user.name}
-• Email: {order.address.user.email}
-• Phone: {order.address.user.phone}
-
-ORDER DETAILS:
-• Items: {order.get_total_items()} item(s)
-• Subtotal: RM {order.subtotal}
-• Discount: RM {payment.discount_amount if payment else 0}
-• Total: RM {payment.total_amount if payment else order.subtotal}
-• Payment: {payment.get_method_display() if payment else 'N/A'}
-
-DELIVERY ADDRESS:
-{order.address.label}
-{order.address.address}
-{order.address.city}, {order.address.state} {order.address.postal_code}
-{order.address.country}
 
-ITEMS ORDERED:
-"""
-    
-    for item in order.items.all():
-        message += f"\n  • {item.quantity}x {item.product_name} - RM {item.subtotal}"
+@require_POST
+def refresh_analytics(request):
+    """Admin "Recompute now": refresh the period's snapshot in the background"""
+    user = get_logged_in_user(request)
+    if not user or not user.is_admin():
+        messages.error(request, 'Admin access required')
+        return redirect('home')
     
-    message += f"""
-
-═══════════════════════════════════════
-View in admin panel to process order.
-
-WinnieChO Admin System
-═══════════════════════════════════════
-"""
+    period = normalize_period(request.POST.get('period', '30'))
+    if request_refresh(period):
+        messages.success(request, 'Recomputing analytics. Reload in a few seconds to see fresh numbers.')
+    else:
+        messages.info(request, 'Analytics are already being recomputed.')
     
-    try:
-        send_mail(
-            subject=subject,
-            message=message,
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[settings.ADMIN_EMAIL],
-            fail_silently=False,
-        )
-        print(f"✅ Admin email sent for order {order.order_number}")
-        
-        # SNS notification (optional)
-        if hasattr(settings, 'USE_SNS_NOTIFICATIONS') and settings.USE_SNS_NOTIFICATIONS:
-            try:
-                sns = boto3.client('sns', region_name=settings.AWS_SNS_REGION_NAME)
-                sms_message = f"WinnieChO: New order #{order.order_number} from {order.address.user.name}. Total: RM {payment.total_amount if payment else order.subtotal}"
-                sns.publish(
-                    TopicArn=settings.AWS_SNS_TOPIC_ARN,
-                    Subject=subject,
-                    Message=sms_message
-                )
-                print(f"✅ Admin SMS sent for order {order.order_number}")
-            except Exception as e:
-                print(f"⚠️  SNS failed: {str(e)}")
-        
-        return True
-    except Exception as e:
-        print(f"❌ Error sending admin notification: {str(e)}")
-        return False
+    return redirect(f"{reverse('analytics_dashboard')}?period={period}")
 
 
-def send_order_status_email(order, old_status):
-    """Send email when order status changes"""
-    from django.core.mail import send_mail
-    from django.conf import settings
-    
-    subject = f'Order Status Update - #{order.order_number}'
+def export_sales(request):
+    """
+    Stream order items as CSV or Parquet
+    ?format=csv|parquet&start=YYYY-MM-DD&end=YYYY-MM-DD&status=C,S,D&category=D
+    """
+    user = get_logged_in_user(request)
+    if not user or not user.is_admin():
+        messages.error(request, 'Admin access required')
+        return redirect('home')
     
-    status_messages = {
-        'P': 'Your order is pending confirmation.',
-        'C': 'Your order has been confirmed and is being prepared!',
-        'S': 'Your order has been shipped and is on the way!',
-        'D': 'Your order has been delivered. Enjoy your chocolates!',
-        'X': 'Your order has been cancelled.'
-    }
-    
-    message = f"""
-Hi {order.address.user.name},
-
-Your order #{order.order_number} status has been updated.
-
-Previous Status: {old_status}
-New Status: {order.get_status_display()}
-
-{status_messages.get(order.status, '')}
-
-Order Details:
-Total: RM {order.subtotal}
-Items: {order.get_total_items()}
-
-Delivery Address:
-{order.address.get_full_address()}
-
-Thank you for shopping with WinnieCho!
-
-Best regards,
-WinnieChO Team
-"""
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'format must be csv or parquet'}, status=400)
+    writer, content_type, extension = EXPORT_FORMATS[export_format]
     
     try:
-        send_mail(
-            subject=subject,
-            message=message,
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[order.address.user.email],
-            fail_silently=False,
+        filters = parse_filters(
+            request.GET.get('start'), request.GET.get('end'),
+            request.GET.get('status'), request.GET.get('category'),
         )
-        print(f"✅ Status email sent to {order.address.user.email}")
-    except Exception as e:
-        print(f"❌ Error sending status email: {str(e)}")
+        queryset = sales_queryset(**filters)
+        stream = writer(queryset, chunk_size=getattr(settings, 'EXPORT_CHUNK_SIZE', EXPORT_CHUNK_SIZE))
+        # Fail here (not mid-stream) when e.g. pyarrow is missing
+        first_chunk = next(stream)
+    except ExportError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    def chunks():
+        yield first_chunk
+        yield from stream
+    
+    response = StreamingHttpResponse(chunks(), content_type=content_type)
+    filename = f"sales-{timezone.localdate():%Y%m%d}.{extension}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
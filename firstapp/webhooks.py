@@ -0,0 +1,218 @@
+"""
+Stripe webhook inbox
+
+stripe_webhook (views) only verifies the signature and stores the raw
+event in StripeEvent, then answers 200. The unique event_id turns Stripe's
+retries into no-ops at insert time. Processing happens afterwards:
+- right away on a small in-process pool (STRIPE_EVENT_WORKERS) once the
+  insert commits
+- and by `manage.py process_stripe_events`, which picks up anything the
+  pool missed (restarts, failures waiting for a retry)
+
+Each event is handled in one transaction holding row locks on the event
+and the payment, and payments already marked successful are left alone,
+so an event processed twice (two workers, a replay) awards loyalty and
+queues the confirmation email only once.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Payment, StripeEvent
+
+
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 30
+CLAIM_SECONDS = 300  # how long a worker owns a claimed batch
+
+# process_event result for an event that failed and stays pending ('P')
+# until its next attempt; not a StripeEvent status
+RETRY = 'R'
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Bounded thread pool for webhook events received by this process"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'STRIPE_EVENT_WORKERS', 2),
+                    thread_name_prefix='stripe-events',
+                )
+    return _executor
+
+
+# =====================
+# INGESTION (views.stripe_webhook)
+# =====================
+
+def store_event(event):
+    """
+    Persist a verified event. Returns the new StripeEvent, or None if this
+    event id was already received.
+    """
+    try:
+        with transaction.atomic():
+            stored = StripeEvent.objects.create(
+                event_id=event['id'], type=event['type'], payload=event
+            )
+    except IntegrityError:
+        return None
+    transaction.on_commit(lambda: _get_executor().submit(_process_in_thread, stored.pk))
+    return stored
+
+
+def _process_in_thread(event_pk):
+    try:
+        process_event(event_pk)
+    except Exception as e:
+        print(f"⚠️  Stripe event {event_pk} failed: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+# =====================
+# HANDLERS
+# =====================
+
+# confirm_payment results (both truthy: the event was handled)
+CONFIRMED = 'confirmed'
+ALREADY_CONFIRMED = 'already confirmed'
+
+
+def confirm_payment(payment_id, transaction_id, method=None):
+    """
+    Confirm the order and mark its payment paid, unless it already is.
+    Call inside a transaction. Returns CONFIRMED, ALREADY_CONFIRMED (nothing
+    written), or False if the payment doesn't exist.
+    Also used by firstapp.reconciliation.
+    """
+    payment = Payment.objects.select_for_update().select_related('order__address').filter(pk=payment_id).first()
+    if payment is None:
+        return False
+    if payment.status == 'S':
+        return ALREADY_CONFIRMED  # success redirect or an earlier delivery
+
+    payment.order.status = 'C'
+    payment.order.save()
+    if method:
+        payment.method = method
+    payment.transaction_id = transaction_id
+    payment.mark_as_paid()  # saves; loyalty + confirmation email
+    return CONFIRMED
+
+
+def handle_checkout_completed(data):
+    """checkout.session.completed: confirm the order and mark its payment paid"""
+    session = data['object']
+    payment_id = (session.get('metadata') or {}).get('payment_id')
+    if not payment_id:
+        return False
+    return confirm_payment(payment_id, session['id'], method='ST')
+
+
+HANDLERS = {
+    'checkout.session.completed': handle_checkout_completed,
+}
+
+
+# =====================
+# WORKER
+# =====================
+
+def _mark_failed(event_pk, error):
+    """Record a failed attempt; returns 'F' once attempts are used up, else RETRY"""
+    event = StripeEvent.objects.get(pk=event_pk)
+    event.attempts += 1
+    event.last_error = str(error)[:2000]
+    if event.attempts >= MAX_ATTEMPTS:
+        event.status = 'F'
+    else:
+        delay = RETRY_BASE_SECONDS * (2 ** (event.attempts - 1))
+        event.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    event.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+    return event.status if event.status == 'F' else RETRY
+
+
+def process_event(event_pk):
+    """
+    Handle one pending event. Returns its new status, RETRY if it failed
+    and will be tried again, or None if it was not pending or another
+    worker holds it.
+    """
+    try:
+        with transaction.atomic():
+            event = StripeEvent.objects.select_for_update(skip_locked=True).filter(
+                pk=event_pk, status='P'
+            ).first()
+            if event is None:
+                return None
+
+            handler = HANDLERS.get(event.type)
+            handled = handler(event.payload['data']) if handler else False
+
+            event.status = 'D' if handled else 'I'
+            event.attempts += 1
+            event.processed_at = timezone.now()
+            event.last_error = ''
+            event.save(update_fields=['status', 'attempts', 'processed_at', 'last_error'])
+            return event.status
+    except Exception as e:
+        return _mark_failed(event_pk, e)
+
+
+def claim_batch(batch_size):
+    """Lease due pending events (see notifications.claim_batch)"""
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            StripeEvent.objects.select_for_update(skip_locked=True).filter(
+                status='P', next_attempt_at__lte=now
+            ).order_by('next_attempt_at').values_list('pk', flat=True)[:batch_size]
+        )
+        StripeEvent.objects.filter(pk__in=batch).update(
+            next_attempt_at=now + timedelta(seconds=CLAIM_SECONDS)
+        )
+    return batch
+
+
+def process_batch(batch_size=100, workers=1):
+    """Process one batch of due events; returns {status or RETRY: count}"""
+    batch = claim_batch(batch_size)
+    counts = {}
+    if workers > 1 and len(batch) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_process_and_close, batch))
+    else:
+        results = [process_event(pk) for pk in batch]
+    for status in results:
+        if status:
+            counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def format_counts(counts):
+    """'Processed: 3, Retry later: 1' for the management commands"""
+    labels = dict(StripeEvent.status_choices, **{RETRY: 'Retry later'})
+    return ', '.join(f'{labels[status]}: {count}' for status, count in sorted(counts.items()))
+
+
+def _process_and_close(event_pk):
+    try:
+        return process_event(event_pk)
+    finally:
+        close_old_connections()
+
+
+def replay(queryset):
+    """Put events back in the queue (e.g. after fixing a handler); returns the count"""
+    return queryset.update(status='P', attempts=0, next_attempt_at=timezone.now(), last_error='')
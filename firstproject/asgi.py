@@ -3,6 +3,9 @@ ASGI config for firstproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serves everything the WSGI app does plus the /api/events/ stream:
+    gunicorn -k uvicorn.workers.UvicornWorker firstproject.asgi:application
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -38,11 +38,12 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'firstapp.middleware.StaticFilesMiddleware',  # WhiteNoise, async-capable
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'firstapp.middleware.SessionUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -169,6 +170,18 @@ FILE_UPLOAD_HANDLERS = [
 # Temporary file upload directory
 FILE_UPLOAD_TEMP_DIR = '/tmp'
 
+# Largest delivery proof photo accepted by the chunked upload API
+DELIVERY_PROOF_MAX_UPLOAD_SIZE = 25 * 1024 * 1024  # 25MB
+
+# Unfinished chunked uploads: partial files are appended in place, so this must be
+# a local/EFS directory shared by the web servers; `expire_proof_uploads` removes
+# uploads without a chunk for this many hours
+DELIVERY_PROOF_PARTIAL_ROOT = os.path.join(MEDIA_ROOT, 'uploads', 'partial')
+DELIVERY_PROOF_UPLOAD_EXPIRY_HOURS = 24
+
+# Background workers that build resized WebP/JPEG image variants (firstapp.images)
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', 2))
+
 # ============================================================
 # AUTHENTICATION
 # ============================================================
@@ -216,6 +229,16 @@ PAYPAL_CLIENT_SECRET = os.getenv('PAYPAL_CLIENT_SECRET')
 STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+STRIPE_EVENT_WORKERS = int(os.getenv('STRIPE_EVENT_WORKERS', 2))  # per-process pool for stored webhook events
+
+# Provider HTTP clients (firstapp/payment): timeouts in seconds, circuit breaker
+PAYMENT_CONNECT_TIMEOUT = float(os.getenv('PAYMENT_CONNECT_TIMEOUT', 3))
+PAYMENT_READ_TIMEOUT = float(os.getenv('PAYMENT_READ_TIMEOUT', 15))
+PAYMENT_BREAKER_THRESHOLD = int(os.getenv('PAYMENT_BREAKER_THRESHOLD', 5))  # consecutive failures before failing fast
+PAYMENT_BREAKER_COOLDOWN = int(os.getenv('PAYMENT_BREAKER_COOLDOWN', 30))
+# Point both providers at `manage.py fake_payment_provider` for offline load tests
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', '')
+PAYPAL_API_BASE = os.getenv('PAYPAL_API_BASE', '')
 
 # ============================================================
 # EMAIL & NOTIFICATIONS
@@ -228,6 +251,8 @@ SITE_URL = os.getenv('SITE_URL', 'http://winniecho-alb-1199297198.us-east-1.elb.
 
 AWS_SNS_REGION_NAME = AWS_REGION
 AWS_SNS_TOPIC_ARN = os.getenv('AWS_SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:049585066686:winniecho-alerts')
+AWS_SNS_ENDPOINT_URL = os.getenv('AWS_SNS_ENDPOINT_URL') or None  # e.g. local SNS stub
+SNS_PUBLISH_MAX_WORKERS = int(os.getenv('SNS_PUBLISH_MAX_WORKERS', 8))
 
 # ✅ ALWAYS USE SMTP (simpler than SNS)
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -253,6 +278,22 @@ if GEMINI_API_KEY:
 else:
     GEMINI_AVAILABLE = False
 
+# ============================================================
+# ENCRYPTION (KMS envelope encryption)
+# ============================================================
+
+AWS_KMS_KEY_ID = os.getenv('AWS_KMS_KEY_ID', 'YOUR_KMS_KEY_ID')
+AWS_KMS_ENDPOINT_URL = os.getenv('AWS_KMS_ENDPOINT_URL') or None  # e.g. local KMS stand-in
+ENCRYPTION_DATA_KEY_TTL = int(os.getenv('ENCRYPTION_DATA_KEY_TTL', 3600))  # seconds
+
+# ============================================================
+# PRODUCT SEARCH
+# ============================================================
+
+# 'mysql' (FULLTEXT index) or 'memory' (in-process inverted index).
+# Empty = pick by database vendor.
+PRODUCT_SEARCH_BACKEND = os.getenv('PRODUCT_SEARCH_BACKEND', '')
+
 # ============================================================
 # SECURITY SETTINGS
 # ============================================================
@@ -353,19 +394,73 @@ SESSION_SAVE_EVERY_REQUEST = False
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SAMESITE = 'Lax'
 
+# SESSION_MODE: 'cached_db' (cache reads, DB write-through), 'signed_cookies'
+# (identity + checkout ids in a signed cookie, no storage) or 'db' (Django default)
+SESSION_MODE = os.getenv('SESSION_MODE', 'cached_db')
+SESSION_ENGINE = {
+    'cached_db': 'firstapp.sessions.cached_db',
+    'signed_cookies': 'firstapp.sessions.signed_cookies',
+    'db': 'django.contrib.sessions.backends.db',
+}[SESSION_MODE]
+
 # ============================================================
 # CACHES
 # ============================================================
 
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
-        'OPTIONS': {
-            'MAX_ENTRIES': 1000
+# Shared by all gunicorn workers: Redis (REDIS_URL) or memcached
+# (MEMCACHED_LOCATION) in production. Without either, each process gets its
+# own in-memory cache (development only: nothing is shared between workers or
+# instances). firstapp.caching adds a small per-process LRU in front of it.
+REDIS_URL = os.getenv('REDIS_URL')
+MEMCACHED_LOCATION = os.getenv('MEMCACHED_LOCATION')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'winniecho',
         }
     }
-}
+elif MEMCACHED_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': MEMCACHED_LOCATION.split(','),
+            'KEY_PREFIX': 'winniecho',
+        }
+    }
+else:
+    print("⚠ No REDIS_URL or MEMCACHED_LOCATION: using a per-process cache (not shared between workers)")
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000
+            }
+        }
+    }
+
+CACHE_LOCAL_MAX_ENTRIES = 512  # per-process LRU tier
+CACHE_LOCAL_TTL = 5            # seconds a worker may serve a value without asking the shared cache
+
+# Analytics dashboard snapshots (firstapp.analytics)
+ANALYTICS_SNAPSHOT_MAX_AGE = 300        # older snapshots are served but refreshed in the background
+ANALYTICS_SNAPSHOT_TTL = 60 * 60 * 24   # how long a snapshot stays usable at all
+
+# Sales export (firstapp.exports): order items fetched per keyset query
+EXPORT_CHUNK_SIZE = 2000
+
+# ============================================================
+# ORDER EVENTS (server-sent events, firstapp.events)
+# ============================================================
+
+# /api/events/ needs the ASGI app: gunicorn -k uvicorn.workers.UvicornWorker firstproject.asgi:application
+# With Redis, events reach subscribers in every worker; "memory" only reaches
+# subscribers in the publishing process (tests, runserver).
+EVENT_BROKER = os.getenv('EVENT_BROKER', 'redis' if REDIS_URL else 'memory')
+EVENT_STREAM_HEARTBEAT = 20   # seconds between keepalive comments
+EVENT_STREAM_MAX_AGE = 600    # seconds before a stream ends and the client reconnects
 
 
 